@@ -2,6 +2,8 @@
 ASGI config for atomhacks project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serving the app through it lets the streaming endpoints in ``messaging``
+hold connections open without tying up a worker thread each.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
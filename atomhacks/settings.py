@@ -48,6 +48,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "messaging.middleware.metrics_middleware",
+    "messaging.middleware.rate_limit_middleware",
+    "messaging.middleware.read_your_writes_middleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -84,9 +87,157 @@ DATABASES: dict[str, dict[str, Any]] = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
-    }
+    },
+    # Reads go to this alias, which opens the same file read-only. Point it
+    # at a replica when using another backend. Tests read the test database
+    "read": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": f"file:{BASE_DIR / 'db.sqlite3'}?mode=ro",
+        "OPTIONS": {"uri": True},
+        "TEST": {"MIRROR": "default"},
+    },
 }
 
+DATABASE_ROUTERS = ["messaging.routers.ReadWriteRouter"]
+
+
+# Messaging
+# The number of verified credentials kept in memory, and how many seconds
+# each one is trusted for before the password is checked again
+
+MESSAGING_AUTH_CACHE_SIZE = int(os.environ.get("MESSAGING_AUTH_CACHE_SIZE", 10000))
+
+MESSAGING_AUTH_CACHE_TTL = float(os.environ.get("MESSAGING_AUTH_CACHE_TTL", 300))
+
+# The number of recently created messages kept in memory to answer reads of
+# the newest messages, how many seconds the memory may lag behind messages
+# created, changed or removed by other processes, and how many seconds
+# streaming clients may wait for a new one
+
+MESSAGING_TAIL_SIZE = int(os.environ.get("MESSAGING_TAIL_SIZE", 1000))
+
+MESSAGING_TAIL_CHECK_INTERVAL = float(
+    os.environ.get("MESSAGING_TAIL_CHECK_INTERVAL", 1)
+)
+
+MESSAGING_STREAM_KEEPALIVE = float(os.environ.get("MESSAGING_STREAM_KEEPALIVE", 15))
+
+MESSAGING_MAX_POLL_WAIT = float(os.environ.get("MESSAGING_MAX_POLL_WAIT", 60))
+
+# Pages of more than this many messages are streamed to the client while
+# they are read from the database, this many rows at a time
+
+MESSAGING_STREAM_THRESHOLD = int(os.environ.get("MESSAGING_STREAM_THRESHOLD", 1000))
+
+MESSAGING_STREAM_CHUNK_SIZE = int(os.environ.get("MESSAGING_STREAM_CHUNK_SIZE", 2000))
+
+# The largest number of messages that can be created in one batch request
+
+MESSAGING_MAX_BATCH_SIZE = int(os.environ.get("MESSAGING_MAX_BATCH_SIZE", 1000))
+
+# How many messages are removed per transaction when messages are purged, and
+# which messages are kept by the `enforce_retention` command: the newest
+# MESSAGING_RETENTION_MAX_MESSAGES messages that are at most
+# MESSAGING_RETENTION_MAX_AGE seconds old. Unset a limit to disable it
+
+MESSAGING_PURGE_BATCH_SIZE = int(os.environ.get("MESSAGING_PURGE_BATCH_SIZE", 1000))
+
+MESSAGING_RETENTION_MAX_MESSAGES = (
+    int(os.environ["MESSAGING_RETENTION_MAX_MESSAGES"])
+    if os.environ.get("MESSAGING_RETENTION_MAX_MESSAGES")
+    else None
+)
+
+MESSAGING_RETENTION_MAX_AGE = (
+    float(os.environ["MESSAGING_RETENTION_MAX_AGE"])
+    if os.environ.get("MESSAGING_RETENTION_MAX_AGE")
+    else None
+)
+
+# Whether created messages are queued and written in batches by a background
+# thread, how many can wait in the queue, and how many messages and seconds
+# a batch collects before it is written
+
+MESSAGING_WRITE_QUEUE_ENABLED = os.environ.get("MESSAGING_WRITE_QUEUE_ENABLED") == "1"
+
+MESSAGING_WRITE_QUEUE_SIZE = int(os.environ.get("MESSAGING_WRITE_QUEUE_SIZE", 10000))
+
+MESSAGING_WRITE_QUEUE_BATCH_SIZE = int(
+    os.environ.get("MESSAGING_WRITE_QUEUE_BATCH_SIZE", 500)
+)
+
+MESSAGING_WRITE_QUEUE_FLUSH_INTERVAL = float(
+    os.environ.get("MESSAGING_WRITE_QUEUE_FLUSH_INTERVAL", 0.01)
+)
+
+# How messages are searched. `fts5` uses SQLite's full-text index, `inverted`
+# uses a table of the words of every message, and `auto` uses `fts5` when the
+# database has the full-text index
+
+MESSAGING_SEARCH_BACKEND = os.environ.get("MESSAGING_SEARCH_BACKEND", "auto")
+
+# How many seconds the reads of a client that wrote to the database are sent
+# to the primary instead of the read database, so it sees its own writes
+
+MESSAGING_READ_YOUR_WRITES_SECONDS = float(
+    os.environ.get("MESSAGING_READ_YOUR_WRITES_SECONDS", 5)
+)
+
+# How many seconds a bearer token issued by /messaging/login is valid for
+
+MESSAGING_TOKEN_TTL = int(os.environ.get("MESSAGING_TOKEN_TTL", 7 * 24 * 60 * 60))
+
+# The request header that a trusted reverse proxy sets to the address of the
+# client, such as X-Forwarded-For, of which the last address is used. Unset
+# it if clients connect directly, since they could set the header themselves
+
+MESSAGING_CLIENT_ADDRESS_HEADER = (
+    os.environ.get("MESSAGING_CLIENT_ADDRESS_HEADER") or None
+)
+
+# The token bucket limits of the endpoints that write to the database: how
+# many requests per second each client address and each user may make, how
+# many more they may make in a burst, and how many clients are remembered.
+# Requests to other endpoints whose credentials are rejected also take a
+# token from their client address. A rate of 0 disables the limit. At most
+# MESSAGING_MAX_CONCURRENT_WRITES writes are served at once, or any number
+# if it is 0
+
+MESSAGING_RATE_LIMIT_IP_RATE = float(os.environ.get("MESSAGING_RATE_LIMIT_IP_RATE", 20))
+
+MESSAGING_RATE_LIMIT_IP_BURST = float(
+    os.environ.get("MESSAGING_RATE_LIMIT_IP_BURST", 100)
+)
+
+MESSAGING_RATE_LIMIT_USER_RATE = float(
+    os.environ.get("MESSAGING_RATE_LIMIT_USER_RATE", 10)
+)
+
+MESSAGING_RATE_LIMIT_USER_BURST = float(
+    os.environ.get("MESSAGING_RATE_LIMIT_USER_BURST", 50)
+)
+
+MESSAGING_RATE_LIMIT_MAX_CLIENTS = int(
+    os.environ.get("MESSAGING_RATE_LIMIT_MAX_CLIENTS", 100000)
+)
+
+MESSAGING_MAX_CONCURRENT_WRITES = int(
+    os.environ.get("MESSAGING_MAX_CONCURRENT_WRITES", 64)
+)
+
+# How many seconds clients may cache the documentation page for
+
+MESSAGING_DOCS_MAX_AGE = int(os.environ.get("MESSAGING_DOCS_MAX_AGE", 24 * 60 * 60))
+
+# Requests slower than this many seconds are logged with their SQL. Unset to
+# disable the log and stop recording the SQL of requests
+
+MESSAGING_SLOW_REQUEST_THRESHOLD = (
+    float(os.environ["MESSAGING_SLOW_REQUEST_THRESHOLD"])
+    if os.environ.get("MESSAGING_SLOW_REQUEST_THRESHOLD")
+    else None
+)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -0,0 +1,67 @@
+"""
+Lean production settings for serving only the messaging API.
+
+Select them with `DJANGO_SETTINGS_MODULE=atomhacks.settings_api`. The API
+endpoints are all CSRF exempt and authenticate with their own headers, so
+the admin, sessions, messages, auth and static file apps and their
+middleware are left out. Database connections are kept open between
+requests and SQLite is tuned for many readers and one writer.
+"""
+
+import os
+
+from .settings import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from .settings import DATABASES, TEMPLATES
+
+INSTALLED_APPS = [
+    "messaging.apps.MessagingConfig",
+]
+
+MIDDLEWARE = [
+    "messaging.middleware.metrics_middleware",
+    "messaging.middleware.rate_limit_middleware",
+    "messaging.middleware.read_your_writes_middleware",
+    "django.middleware.common.CommonMiddleware",
+]
+
+ROOT_URLCONF = "atomhacks.urls_api"
+
+TEMPLATES[0]["OPTIONS"]["context_processors"] = []
+
+# Keep connections open for this many seconds instead of reconnecting for
+# every request, and check that they still work before reusing them
+
+for alias in ("default", "read"):
+    DATABASES[alias]["CONN_MAX_AGE"] = int(os.environ.get("CONN_MAX_AGE", 600))
+    DATABASES[alias]["CONN_HEALTH_CHECKS"] = True
+
+# Write-ahead logging lets readers run while a message is written. With it,
+# `synchronous=NORMAL` only risks the latest transactions on power loss, not
+# corruption. Transactions take the write lock when they begin, so that
+# concurrent writers wait for up to `timeout` seconds instead of failing
+
+DATABASES["default"]["OPTIONS"] = {
+    "init_command": (
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA mmap_size=268435456;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA cache_size=-16000"
+    ),
+    "transaction_mode": "IMMEDIATE",
+    "timeout": 20,
+}
+
+# The read connections share the page cache settings of the primary, and
+# SQLite refuses any write sent through them
+
+DATABASES["read"]["OPTIONS"] = {
+    "init_command": (
+        "PRAGMA query_only=1;"
+        "PRAGMA mmap_size=268435456;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA cache_size=-16000"
+    ),
+    "uri": True,
+    "timeout": 20,
+}
@@ -3,7 +3,10 @@
 from django.contrib import admin
 from django.urls import include, path
 
+from messaging.views import get_metrics
+
 urlpatterns = [
     path("messaging/", include("messaging.urls")),
     path("admin/", admin.site.urls),
+    path("metrics", get_metrics, name="metrics"),
 ]
@@ -0,0 +1,11 @@
+"""Module for registering the endpoints of the lean API settings, without
+the admin site"""
+
+from django.urls import include, path
+
+from messaging.views import get_metrics
+
+urlpatterns = [
+    path("messaging/", include("messaging.urls")),
+    path("metrics", get_metrics, name="metrics"),
+]
@@ -0,0 +1 @@
+"""Scripts that measure the performance of the message board"""
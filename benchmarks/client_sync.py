@@ -0,0 +1,120 @@
+"""Measures the requests, bytes and connections of a typical polling session
+of a reader, polling the way the examples do against syncing with the
+client library
+
+Run it against a running server, for example:
+
+    python manage.py runserver 8000 --noreload
+    python -m benchmarks.client_sync --url http://localhost:8000 --polls 60
+
+The board is seeded with `--history` messages. Then each round, a writer
+posts `--burst` messages and a reader polls for them. The examples' reader
+downloads the newest 10000 messages with a bare `requests.get` every round,
+while the client reader calls `MessageBoardClient.sync`. Each run prints
+one JSON object with the requests sent, the bytes of response bodies
+received and the connections opened by both readers."""
+
+import argparse
+import json
+import logging
+import time
+from typing import Any, Callable
+
+import requests
+
+from messaging_client import MessageBoardClient
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark-password"
+
+
+class _ConnectionCounter(logging.Handler):
+    """Counts the connections that urllib3 opens while `counting` is set"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.counting = False
+        self.connections = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.counting and record.getMessage().startswith("Starting new"):
+            self.connections += 1
+
+
+def _run_session(
+    writer: MessageBoardClient,
+    poll: Callable[[], tuple[int, int]],
+    polls: int,
+    burst: int,
+    counter: _ConnectionCounter,
+) -> dict[str, Any]:
+    """Runs `polls` rounds in which the writer posts `burst` messages and the
+    reader polls once. `poll` returns the requests and bytes of a poll.
+    Returns the traffic of the reader"""
+    requests_sent = 0
+    bytes_received = 0
+    counter.connections = 0
+    start = time.perf_counter()
+    for round_number in range(polls):
+        writer.create_messages(
+            [f"round {round_number} message {i}" for i in range(burst)]
+        )
+        counter.counting = True
+        sent, received = poll()
+        counter.counting = False
+        requests_sent += sent
+        bytes_received += received
+    return {
+        "requests": requests_sent,
+        "bytes_received": bytes_received,
+        "connections": counter.connections,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def main() -> None:
+    """Seeds the board, then runs a polling session with both readers"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--history", type=int, default=5000)
+    parser.add_argument("--polls", type=int, default=60)
+    parser.add_argument("--burst", type=int, default=5)
+    args = parser.parse_args()
+
+    counter = _ConnectionCounter()
+    logger = logging.getLogger("urllib3.connectionpool")
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(counter)
+    url = args.url.rstrip("/")
+    requests.post(
+        url + "/messaging/user", json={"username": USERNAME, "password": PASSWORD}
+    ).raise_for_status()
+    with MessageBoardClient(url, USERNAME, PASSWORD) as writer:
+        for start in range(0, args.history, 1000):
+            count = min(1000, args.history - start)
+            writer.create_messages([f"history {start + i}" for i in range(count)])
+
+        def poll_bare() -> tuple[int, int]:
+            response = requests.get(url + "/messaging/message", params={"limit": 10000})
+            response.raise_for_status()
+            return 1, response.raw.tell()
+
+        bare = _run_session(writer, poll_bare, args.polls, args.burst, counter)
+        with MessageBoardClient(url) as reader:
+            reader.sync()  # Start from the newest messages, like the bare reader
+
+            def poll_client() -> tuple[int, int]:
+                before = reader.stats()
+                reader.sync()
+                after = reader.stats()
+                return (
+                    after["requests"] - before["requests"],
+                    after["bytes_received"] - before["bytes_received"],
+                )
+
+            client = _run_session(writer, poll_client, args.polls, args.burst, counter)
+    print(json.dumps({"bare": bare, "client": client}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Measures the throughput and latency of reads and writes served at the same
+time, with every query sent to the primary database and with reads routed to
+the read database by `messaging.routers.ReadWriteRouter`:
+
+    python -m benchmarks.read_write --readers 8 --writers 2 --requests 500
+
+Each routing runs in a fresh interpreter with the `atomhacks.settings_api`
+profile on a temporary file database in WAL mode, seeded with `--messages`
+messages. Readers get the messages of a user, the messages tagging a user
+and search results, each from its own address, while writers post batches
+of messages until the readers are done. Readers never write, so they are not
+pinned to the primary. The requests are sent in process through Django's
+test client, so they include the middleware and the views but no network.
+The report is printed as JSON."""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any
+
+from benchmarks.stats import summarize_latencies
+
+ROUTINGS = ("primary", "split")
+"""The routings compared. `primary` sends every query to the primary
+database, and `split` sends reads to the read database"""
+
+PASSWORD = "benchmark-password"
+"""The password of every seeded user"""
+
+WORDS = ("apple", "banana", "cherry", "grape", "lemon", "mango", "peach", "plum")
+"""The words that messages are made of, and that readers search for"""
+
+_MEASURE_ARGUMENTS = ("readers", "writers", "requests", "messages")
+"""The arguments passed on to the interpreters that measure a routing"""
+
+
+def _setup(routing: str, path: str) -> None:
+    """Sets up Django with both aliases pointing at the database file, or
+    only the primary alias for the `primary` routing, and migrates it"""
+    # pylint: disable=import-outside-toplevel
+    os.environ["DJANGO_SETTINGS_MODULE"] = "atomhacks.settings_api"
+    # Every writer would quickly run out of its rate limit
+    os.environ["MESSAGING_RATE_LIMIT_IP_RATE"] = "0"
+    os.environ["MESSAGING_RATE_LIMIT_USER_RATE"] = "0"
+    from django.conf import settings
+
+    settings.DATABASES["default"]["NAME"] = path
+    settings.DATABASES["read"]["NAME"] = f"file:{path}?mode=ro"
+    if routing == "primary":
+        del settings.DATABASES["read"]
+    settings.PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+    import django
+
+    django.setup()
+    from django.core.management import call_command
+
+    call_command("migrate", verbosity=0)
+
+
+def _seed(readers: int, writers: int, messages: int) -> None:
+    """Creates a user for every reader and writer, and `messages` messages
+    tagging the readers"""
+    # pylint: disable=import-outside-toplevel
+    from messaging.services import MESSAGE_SERVICE, USER_SERVICE
+
+    for i in range(readers):
+        USER_SERVICE.create_user(f"reader{i}", PASSWORD)
+    for i in range(writers):
+        USER_SERVICE.create_user(f"writer{i}", PASSWORD)
+    authors = [USER_SERVICE.get_user(f"reader{i}") for i in range(readers)]
+    for start in range(0, messages, 5000):
+        MESSAGE_SERVICE.create_messages_in_bulk(
+            [
+                (
+                    authors[i % readers],
+                    f"@reader{(i + 1) % readers} {WORDS[i % len(WORDS)]} {i}",
+                )
+                for i in range(start, min(start + 5000, messages))
+            ]
+        )
+
+
+def _measure(routing: str, args: argparse.Namespace) -> dict[str, Any]:
+    """Seeds a temporary database and serves the readers and writers at the
+    same time with the given routing. Returns their throughput and latency"""
+    # pylint: disable=import-outside-toplevel
+    directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+    try:
+        _setup(routing, os.path.join(directory.name, "benchmark.sqlite3"))
+        _seed(args.readers, args.writers, args.messages)
+        from django.db import connections
+        from django.test import Client
+
+        reads: list[float] = []
+        writes: list[float] = []
+        errors = 0
+        lock = threading.Lock()
+        reading = threading.Event()
+        reading.set()
+
+        def read(reader: int) -> None:
+            nonlocal errors
+            client = Client(REMOTE_ADDR=f"10.0.0.{reader + 1}")
+            headers = {"Username": f"reader{reader}", "Password": PASSWORD}
+            paths = (
+                "/messaging/message/me?limit=50",
+                "/messaging/message/tagged?limit=50",
+                f"/messaging/message/search?q={WORDS[reader % len(WORDS)]}",
+            )
+            for i in range(args.requests):
+                start = time.perf_counter()
+                response = client.get(paths[i % len(paths)], headers=headers)
+                elapsed = time.perf_counter() - start
+                with lock:
+                    reads.append(elapsed)
+                    errors += response.status_code >= 400
+            connections.close_all()
+
+        def write(writer: int) -> None:
+            nonlocal errors
+            client = Client(REMOTE_ADDR=f"10.0.1.{writer + 1}")
+            headers = {"Username": f"writer{writer}", "Password": PASSWORD}
+            body = {"messages": [f"@reader0 {word}" for word in WORDS] * 3}
+            while reading.is_set():
+                start = time.perf_counter()
+                response = client.post(
+                    "/messaging/message/batch",
+                    body,
+                    content_type="application/json",
+                    headers=headers,
+                )
+                elapsed = time.perf_counter() - start
+                with lock:
+                    writes.append(elapsed)
+                    errors += response.status_code >= 400
+            connections.close_all()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.readers + args.writers) as executor:
+            writers = [executor.submit(write, i) for i in range(args.writers)]
+            list(executor.map(read, range(args.readers)))
+            reading.clear()
+            for writer in writers:
+                writer.result()
+        duration = time.perf_counter() - start
+        return {
+            "errors": errors,
+            "reads": summarize_latencies(reads, duration),
+            "writes": summarize_latencies(writes, duration),
+        }
+    finally:
+        directory.cleanup()
+
+
+def main() -> None:
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--routings", nargs="+", choices=ROUTINGS, default=ROUTINGS)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument(
+        "--measure", choices=ROUTINGS, help="Only measure the given routing"
+    )
+    args = parser.parse_args()
+    if args.measure:
+        print(json.dumps(_measure(args.measure, args)))
+        return
+    report = {}
+    for routing in args.routings:
+        result = subprocess.run(
+            [sys.executable, "-m", "benchmarks.read_write", "--measure", routing]
+            + [f"--{name}={getattr(args, name)}" for name in _MEASURE_ARGUMENTS],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        report[routing] = json.loads(result.stdout)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+"""Seeds a message board with synthetic data and replays a mixed workload
+against it, reporting throughput, latency percentiles, queries per request
+and peak memory as JSON
+
+By default the workload runs in process through Django's test client on a
+temporary database, which also measures the queries of every request and
+the memory used by the server code:
+
+    python -m benchmarks.replay --users 100 --messages 100000 --requests 5000
+
+It can also run against a local server, in which case the server is seeded
+through the API and queries per request are not measured. Start the server
+with `MESSAGING_RATE_LIMIT_IP_RATE=0 MESSAGING_RATE_LIMIT_USER_RATE=0`, or
+the rate limits reject most of the writes:
+
+    python -m benchmarks.replay --url http://localhost:8000 --concurrency 16
+
+The operations are generated from `--seed`, so two runs with the same
+arguments send the same requests. `--save-trace` writes the operations to a
+JSON lines file, and `--trace` replays the operations of such a file."""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, NamedTuple, Optional, Protocol
+
+import requests
+
+from benchmarks.stats import summarize_latencies
+
+PASSWORD = "benchmark-password"
+"""The password of every seeded user"""
+
+OPERATIONS = ("poll", "large", "tagged", "create")
+"""The kinds of operation in a workload. `poll` gets the messages since a
+recently seen id, `large` gets the newest 10000 messages, `tagged` gets the
+messages that tag a user, and `create` posts a burst of messages"""
+
+
+class _Operation(NamedTuple):
+    """A single operation of a workload"""
+
+    kind: str
+    """The kind of operation, one of `OPERATIONS`"""
+    username: str
+    """The user that sends the operation"""
+    messages: list[str]
+    """The messages created by a `create` operation"""
+
+
+class _Response(NamedTuple):
+    """The measurements of a single request"""
+
+    status: int
+    """The status code of the response"""
+    latency: float
+    """The time the request took, in seconds"""
+    queries: Optional[int]
+    """The number of queries the request issued, if measured"""
+    body: Any
+    """The decoded JSON body of the response, or `None`"""
+
+
+class _Target(Protocol):
+    """A message board that a workload is replayed against"""
+
+    def seed(self, usernames: list[str], messages: list[tuple[str, str]]) -> None:
+        """Creates the given users and messages, each message as a pair of
+        its user's username and its text"""
+
+    def send(
+        self, method: str, path: str, username: str, body: Optional[Any]
+    ) -> _Response:
+        """Sends a request as the given user"""
+
+
+class _ClientTarget:
+    """Replays a workload in process through Django's test client, on a
+    temporary database that is destroyed afterwards"""
+
+    def __init__(self) -> None:
+        # pylint: disable=import-outside-toplevel
+        import django
+
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "atomhacks.settings")
+        # Every request comes from the same address, so the rate limits would
+        # reject most writes of the workload
+        os.environ.setdefault("MESSAGING_RATE_LIMIT_IP_RATE", "0")
+        os.environ.setdefault("MESSAGING_RATE_LIMIT_USER_RATE", "0")
+        django.setup()
+        from django.conf import settings
+        from django.db import connections
+        from django.test import Client
+        from django.test.utils import (
+            CaptureQueriesContext,
+            setup_databases,
+            teardown_databases,
+        )
+
+        # Seeding thousands of users must not be dominated by password hashing
+        settings.PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+        # Every alias gets a test database, and the read alias mirrors it
+        self._old_config = setup_databases(verbosity=0, interactive=False)
+        self._teardown = teardown_databases
+        self._connections = connections
+        self._client = Client()
+        self._capture = CaptureQueriesContext
+
+    def close(self) -> None:
+        """Destroys the temporary database"""
+        self._teardown(self._old_config, verbosity=0)
+
+    def seed(self, usernames: list[str], messages: list[tuple[str, str]]) -> None:
+        # pylint: disable=import-outside-toplevel
+        from django.contrib.auth.hashers import make_password
+        import uuid
+
+        from messaging.models import User
+        from messaging.services import MESSAGE_SERVICE
+
+        hashed_password = make_password(PASSWORD)
+        users = User.objects.bulk_create(
+            [
+                User(
+                    username=username,
+                    hashed_password=hashed_password,
+                    password_salt=uuid.uuid4(),
+                )
+                for username in usernames
+            ]
+        )
+        by_username = {user.username: user for user in users}
+        for start in range(0, len(messages), 5000):
+            MESSAGE_SERVICE.create_messages_in_bulk(
+                [
+                    (by_username[username], message)
+                    for username, message in messages[start : start + 5000]
+                ]
+            )
+
+    def send(
+        self, method: str, path: str, username: str, body: Optional[Any]
+    ) -> _Response:
+        headers = {"Username": username, "Password": PASSWORD}
+        with ExitStack() as stack:
+            contexts = [
+                stack.enter_context(self._capture(connection))
+                for connection in self._connections.all()
+            ]
+            start = time.perf_counter()
+            if method == "GET":
+                response = self._client.get(path, headers=headers)
+            else:
+                response = self._client.post(
+                    path, body, content_type="application/json", headers=headers
+                )
+            # Large pages are streamed, so the body is read while timing
+            content = b"".join(response) if response.streaming else response.content
+            latency = time.perf_counter() - start
+        decoded = json.loads(content) if response.status_code == 200 else None
+        queries = sum(len(context.captured_queries) for context in contexts)
+        return _Response(response.status_code, latency, queries, decoded)
+
+
+class _HttpTarget:
+    """Replays a workload against a server over HTTP, with one pooled
+    session per thread"""
+
+    def __init__(self, url: str) -> None:
+        self._url = url.rstrip("/")
+        self._local = threading.local()
+
+    def close(self) -> None:
+        """Nothing to clean up, the server keeps its data"""
+
+    def _get_session(self) -> requests.Session:
+        """Returns the session of the current thread"""
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        session: requests.Session = self._local.session
+        return session
+
+    def seed(self, usernames: list[str], messages: list[tuple[str, str]]) -> None:
+        for username in usernames:
+            self.send(
+                "POST",
+                "/messaging/user",
+                "",
+                {"username": username, "password": PASSWORD},
+            )
+        by_username: dict[str, list[str]] = {}
+        for username, message in messages:
+            by_username.setdefault(username, []).append(message)
+        for username, texts in by_username.items():
+            for start in range(0, len(texts), 1000):
+                self.send(
+                    "POST",
+                    "/messaging/message/batch",
+                    username,
+                    {"messages": texts[start : start + 1000]},
+                )
+
+    def send(
+        self, method: str, path: str, username: str, body: Optional[Any]
+    ) -> _Response:
+        headers = {"Username": username, "Password": PASSWORD} if username else {}
+        start = time.perf_counter()
+        response = self._get_session().request(
+            method, self._url + path, json=body, headers=headers
+        )
+        latency = time.perf_counter() - start
+        decoded = response.json() if response.status_code == 200 else None
+        return _Response(response.status_code, latency, None, decoded)
+
+
+def _generate_seed_data(
+    rng: random.Random, users: int, messages: int, mention_density: float
+) -> tuple[list[str], list[tuple[str, str]]]:
+    """Returns the usernames and messages to seed. Each message tags a random
+    user with probability `mention_density`"""
+    usernames = [f"user{i}" for i in range(users)]
+    seeded = []
+    for i in range(messages):
+        text = f"message {i} about {rng.choice(['cats', 'dogs', 'code', 'food'])}"
+        if rng.random() < mention_density:
+            text += f" @{rng.choice(usernames)}"
+        seeded.append((rng.choice(usernames), text))
+    return usernames, seeded
+
+
+def _generate_operations(
+    rng: random.Random,
+    usernames: list[str],
+    mix: dict[str, float],
+    count: int,
+    burst_size: int,
+) -> list[_Operation]:
+    """Returns `count` operations drawn from the weighted mix"""
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=count)
+    return [
+        _Operation(
+            kind,
+            rng.choice(usernames),
+            (
+                [
+                    f"burst message {i} @{rng.choice(usernames)}"
+                    for i in range(burst_size)
+                ]
+                if kind == "create"
+                else []
+            ),
+        )
+        for kind in kinds
+    ]
+
+
+class _Replayer:
+    """Sends the operations of a workload and collects their measurements.
+    Polling clients follow the newest id they have seen"""
+
+    def __init__(self, target: _Target) -> None:
+        self._target = target
+        self._lock = threading.Lock()
+        self._cursor = 0
+        self.measurements: dict[str, list[_Response]] = {
+            kind: [] for kind in OPERATIONS
+        }
+
+    def run(self, operation: _Operation) -> None:
+        """Sends a single operation"""
+        if operation.kind == "create":
+            responses = [
+                self._target.send(
+                    "POST",
+                    "/messaging/message/create",
+                    operation.username,
+                    {"message": message},
+                )
+                for message in operation.messages
+            ]
+        else:
+            responses = [
+                self._target.send(
+                    "GET", self._get_path(operation), operation.username, None
+                )
+            ]
+        with self._lock:
+            self.measurements[operation.kind].extend(responses)
+            for response in responses:
+                if response.body and response.body.get("messages"):
+                    self._cursor = max(
+                        self._cursor, response.body["messages"][-1]["id"]
+                    )
+
+    def _get_path(self, operation: _Operation) -> str:
+        """Returns the path requested by a read operation"""
+        if operation.kind == "poll":
+            with self._lock:
+                since = max(0, self._cursor - 5)  # A client a few messages behind
+            return f"/messaging/message?since={since}"
+        if operation.kind == "large":
+            return "/messaging/message?limit=10000"
+        return "/messaging/message/tagged"
+
+
+def _summarize(responses: list[_Response], duration: float) -> dict[str, Any]:
+    """Returns the measurements of a set of requests"""
+    queries = [
+        response.queries for response in responses if response.queries is not None
+    ]
+    return {
+        **summarize_latencies([response.latency for response in responses], duration),
+        "errors": sum(response.status >= 400 for response in responses),
+        "queries_per_request": (
+            round(sum(queries) / len(queries), 2) if queries else None
+        ),
+    }
+
+
+def _parse_mix(mix: str) -> dict[str, float]:
+    """Parses a mix such as `poll=60,large=5,tagged=15,create=20`"""
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {kind!r}")
+        weights[kind] = float(weight)
+    return weights
+
+
+def main() -> None:
+    """Seeds the target, replays the workload and prints the report"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--url", help="The server to replay against, if any")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--mention-density", type=float, default=0.2)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument(
+        "--mix",
+        type=_parse_mix,
+        default=_parse_mix("poll=60,large=5,tagged=15,create=20"),
+    )
+    parser.add_argument("--burst-size", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", help="Replay the operations of this file")
+    parser.add_argument("--save-trace", help="Write the operations to this file")
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Measure the peak Python allocations of the replay, which is slow",
+    )
+    parser.add_argument("--output", help="Write the report to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    usernames, seeded = _generate_seed_data(
+        rng, args.users, args.messages, args.mention_density
+    )
+    if args.trace:
+        with open(args.trace, "r", encoding="utf-8") as f:
+            operations = [_Operation(*json.loads(line)) for line in f]
+    else:
+        operations = _generate_operations(
+            rng, usernames, args.mix, args.requests, args.burst_size
+        )
+    if args.save_trace:
+        with open(args.save_trace, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(operation) + "\n" for operation in operations)
+
+    target = _HttpTarget(args.url) if args.url else _ClientTarget()
+    try:
+        seed_start = time.perf_counter()
+        target.seed(usernames, seeded)
+        seed_duration = time.perf_counter() - seed_start
+        replayer = _Replayer(target)
+        if args.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(replayer.run, operations))
+        duration = time.perf_counter() - start
+        peak_allocated = (
+            tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+        )
+        tracemalloc.stop()
+    finally:
+        target.close()
+
+    responses = [
+        response for measured in replayer.measurements.values() for response in measured
+    ]
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "target": args.url or "client",
+        "seed_seconds": round(seed_duration, 3),
+        "duration_seconds": round(duration, 3),
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "peak_allocated_bytes": peak_allocated,
+        "total": _summarize(responses, duration),
+        "operations": {
+            kind: _summarize(measured, duration)
+            for kind, measured in replayer.measurements.items()
+            if measured
+        },
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
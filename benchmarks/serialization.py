@@ -0,0 +1,120 @@
+"""Measures the CPU time spent reading and encoding a page of messages,
+encoding every message for each request as the views used to, against
+joining the representations stored when the messages were created:
+
+    python -m benchmarks.serialization --messages 20000 --requests 200
+
+The pages are read from a temporary database seeded with synthetic
+messages. Each run prints one JSON object with the CPU time per request in
+milliseconds of both approaches for every page size."""
+
+import argparse
+import json
+import os
+import random
+import time
+import uuid
+from typing import Any, Callable
+
+PAGE_SIZES = (10, 100, 1000, 10000)
+"""The numbers of messages per page that are measured"""
+
+
+def _encode_rows(limit: int) -> bytes:
+    """Returns a page of the newest messages, joining their usernames and
+    encoding every message, as the views did before messages were stored
+    encoded"""
+    # pylint: disable=import-outside-toplevel
+    from messaging.models import Message
+
+    rows = Message.objects.order_by("-id").values_list(
+        "id", "user__username", "message"
+    )[:limit]
+    messages = [
+        {"id": message_id, "username": username, "message": message}
+        for message_id, username, message in rows
+    ]
+    messages.reverse()
+    return json.dumps({"messages": messages, "next_cursor": None}).encode()
+
+
+def _join_stored(limit: int) -> bytes:
+    """Returns a page of the newest messages by joining their stored
+    representations, as the views do now"""
+    # pylint: disable=import-outside-toplevel
+    from messaging.models import Message
+    from messaging.serializers import serialize_messages
+
+    messages = serialize_messages(Message.objects.order_by("-id")[:limit])
+    messages.reverse()
+    joined = b", ".join([message.json for message in messages])
+    return b'{"messages": [' + joined + b'], "next_cursor": null}'
+
+
+def _measure(encode: Callable[[int], bytes], limit: int, requests: int) -> float:
+    """Returns the CPU time per page of the given approach, in milliseconds"""
+    start = time.process_time()
+    for _ in range(requests):
+        encode(limit)
+    return round((time.process_time() - start) / requests * 1000, 3)
+
+
+def main() -> None:
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # pylint: disable=import-outside-toplevel
+    import django
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "atomhacks.settings")
+    django.setup()
+    from django.test.utils import setup_databases, teardown_databases
+
+    from messaging.models import User
+    from messaging.services import MESSAGE_SERVICE
+
+    # Every alias gets a test database, and the read alias mirrors it
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        users = User.objects.bulk_create(
+            [
+                User(
+                    username=f"user{i}", hashed_password="", password_salt=uuid.uuid4()
+                )
+                for i in range(args.users)
+            ]
+        )
+        generator = random.Random(args.seed)
+        words = ["hello", "board", "message", "@user1", "café", '"quoted"']
+        for start in range(0, args.messages, 5000):
+            MESSAGE_SERVICE.create_messages_in_bulk(
+                [
+                    (
+                        generator.choice(users),
+                        " ".join(generator.choices(words, k=generator.randint(1, 30))),
+                    )
+                    for _ in range(start, min(start + 5000, args.messages))
+                ]
+            )
+        report: dict[str, Any] = {}
+        for limit in PAGE_SIZES:
+            assert json.loads(_join_stored(limit)) == json.loads(_encode_rows(limit))
+            before = _measure(_encode_rows, limit, args.requests)
+            after = _measure(_join_stored, limit, args.requests)
+            report[str(limit)] = {
+                "encode_ms": before,
+                "stored_ms": after,
+                "speedup": round(before / after, 2) if after else None,
+            }
+        print(json.dumps(report, indent=2))
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Measures the throughput and latency of a running message board server
+under concurrent load
+
+Run it once against the app served through WSGI and once through ASGI, for
+example:
+
+    python manage.py runserver 8000 --noreload
+    uvicorn atomhacks.asgi:application --port 8001
+
+    python -m benchmarks.server_load --url http://localhost:8000 --label wsgi
+    python -m benchmarks.server_load --url http://localhost:8001 --label asgi
+
+Each run prints one JSON object with the requests per second and the p50,
+p95 and p99 latency in milliseconds of every endpoint, so runs can be
+compared."""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+from typing import Any, Callable
+
+import requests
+
+from benchmarks.stats import summarize_latencies
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark-password"
+
+
+def _run_load(
+    request: Callable[[requests.Session], requests.Response],
+    concurrency: int,
+    total: int,
+) -> dict[str, Any]:
+    """Sends `total` requests from `concurrency` threads and returns the
+    throughput and latency of the requests"""
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(_: int) -> None:
+        nonlocal errors
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        response = request(local.session)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(total)))
+    duration = time.perf_counter() - start
+    return {"errors": errors, **summarize_latencies(latencies, duration)}
+
+
+def main() -> None:
+    """Seeds the server with a user and messages, then loads each endpoint"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--label", default="server")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--seed-messages", type=int, default=200)
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip("/") + "/messaging"
+    headers = {"Username": USERNAME, "Password": PASSWORD}
+    requests.post(
+        base_url + "/user", json={"username": USERNAME, "password": PASSWORD}
+    ).raise_for_status()
+    with requests.Session() as session:
+        for i in range(args.seed_messages):
+            session.post(
+                base_url + "/message/create",
+                json={"message": f"@{USERNAME} seed {i}"},
+                headers=headers,
+            ).raise_for_status()
+
+    endpoints: dict[str, Callable[[requests.Session], requests.Response]] = {
+        "get_all_messages": lambda session: session.get(base_url + "/message"),
+        "get_my_messages": lambda session: session.get(
+            base_url + "/message/me", headers=headers
+        ),
+        "get_tagged_messages": lambda session: session.get(
+            base_url + "/message/tagged", headers=headers
+        ),
+        "create_message": lambda session: session.post(
+            base_url + "/message/create",
+            json={"message": "benchmark"},
+            headers=headers,
+        ),
+    }
+    results = {
+        name: _run_load(request, args.concurrency, args.requests)
+        for name, request in endpoints.items()
+    }
+    print(json.dumps({"label": args.label, "endpoints": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Compares the worker startup time and the per-request overhead of the
+settings profiles of the project, by default the full profile in
+`atomhacks.settings` and the API-only profile in `atomhacks.settings_api`:
+
+    python -m benchmarks.settings_profiles --startups 20 --requests 2000
+
+Every measurement runs in a fresh interpreter with `DJANGO_SETTINGS_MODULE`
+set to the profile. Startup is the time to import Django, set it up, load
+the WSGI handler with its middleware and load the URLconf. The requests are
+sent in process through Django's test client on a temporary file database,
+so they include the middleware, the views and the SQLite pragmas of the
+profile but no network. The test client does not reuse connections between
+requests, so to see the effect of `CONN_MAX_AGE` serve each profile and
+compare them with `benchmarks.server_load`. The report is printed as JSON."""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable
+
+from benchmarks.stats import summarize_latencies
+
+PROFILES = ("atomhacks.settings", "atomhacks.settings_api")
+"""The settings modules compared by default"""
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark-password"
+
+_STARTUP_CODE = """
+from atomhacks.wsgi import application
+from django.urls import get_resolver
+get_resolver().url_patterns
+"""
+"""The code run by each measured worker startup"""
+
+
+def _run_python(profile: str, *args: str) -> str:
+    """Runs the Python interpreter with the given profile and arguments and
+    returns its output"""
+    environment = {
+        **os.environ,
+        "DJANGO_SETTINGS_MODULE": profile,
+        # The rate limits would reject most of the measured writes
+        "MESSAGING_RATE_LIMIT_IP_RATE": "0",
+        "MESSAGING_RATE_LIMIT_USER_RATE": "0",
+    }
+    result = subprocess.run(
+        [sys.executable, *args],
+        env=environment,
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    return result.stdout
+
+
+def _measure_startup(profile: str, startups: int) -> dict[str, float]:
+    """Returns the median and fastest startup time of a worker with the
+    given profile, in milliseconds"""
+    durations = []
+    for _ in range(startups):
+        start = time.perf_counter()
+        _run_python(profile, "-c", _STARTUP_CODE)
+        durations.append(time.perf_counter() - start)
+    return {
+        "p50_ms": round(statistics.median(durations) * 1000, 1),
+        "min_ms": round(min(durations) * 1000, 1),
+    }
+
+
+def _measure_requests(requests: int) -> dict[str, Any]:
+    """Sends `requests` requests to each endpoint with the profile of the
+    current process and returns their latency"""
+    # pylint: disable=import-outside-toplevel
+    import django
+
+    django.setup()
+    from django.conf import settings
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import setup_databases, teardown_databases
+
+    settings.PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+    # A file database, unlike the default in-memory test database, is
+    # affected by the pragmas of the profile
+    directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+    test_settings = connection.settings_dict.setdefault("TEST", {})
+    test_settings["NAME"] = os.path.join(directory.name, "benchmark.sqlite3")
+    # Every alias gets a test database, and the read alias mirrors it
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        client = Client()
+        headers = {"Username": USERNAME, "Password": PASSWORD}
+        client.post(
+            "/messaging/user",
+            {"username": USERNAME, "password": PASSWORD},
+            content_type="application/json",
+        )
+        endpoints: dict[str, Callable[[], Any]] = {
+            "GET /messaging/": lambda: client.get("/messaging/"),
+            "GET /messaging/message": lambda: client.get(
+                "/messaging/message", {"limit": 20}
+            ),
+            "GET /messaging/message/me": lambda: client.get(
+                "/messaging/message/me", {"limit": 20}, headers=headers
+            ),
+            "POST /messaging/message/create": lambda: client.post(
+                "/messaging/message/create",
+                {"message": "benchmark"},
+                content_type="application/json",
+                headers=headers,
+            ),
+        }
+        report: dict[str, Any] = {}
+        for name, send in endpoints.items():
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(requests):
+                request_start = time.perf_counter()
+                response = send()
+                latencies.append(time.perf_counter() - request_start)
+                assert response.status_code < 300, response.content
+            report[name] = summarize_latencies(latencies, time.perf_counter() - start)
+        return report
+    finally:
+        teardown_databases(old_config, verbosity=0)
+        directory.cleanup()
+
+
+def main() -> None:
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--profiles", nargs="+", default=PROFILES)
+    parser.add_argument("--startups", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument(
+        "--measure-requests",
+        action="store_true",
+        help="Only measure the requests of the current profile",
+    )
+    args = parser.parse_args()
+    if args.measure_requests:
+        print(json.dumps(_measure_requests(args.requests)))
+        return
+    report = {}
+    for profile in args.profiles:
+        requests = _run_python(
+            profile,
+            "-m",
+            "benchmarks.settings_profiles",
+            "--measure-requests",
+            "--requests",
+            str(args.requests),
+        )
+        report[profile] = {
+            "startup": _measure_startup(profile, args.startups),
+            "requests": json.loads(requests),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Helpers that summarize the measurements of a benchmark"""
+
+import statistics
+from typing import TypedDict
+
+
+class LatencySummary(TypedDict):
+    """The throughput and latency percentiles of a set of requests"""
+
+    requests: int
+    """The number of requests sent"""
+    requests_per_second: float
+    """The number of requests completed per second"""
+    p50_ms: float
+    """The median latency, in milliseconds"""
+    p95_ms: float
+    """The 95th percentile latency, in milliseconds"""
+    p99_ms: float
+    """The 99th percentile latency, in milliseconds"""
+
+
+def get_percentile(latencies: list[float], percentile: int) -> float:
+    """Returns the given percentile of the latencies in seconds, in
+    milliseconds"""
+    if len(latencies) < 2:
+        return latencies[0] * 1000 if latencies else 0.0
+    return statistics.quantiles(latencies, n=100)[percentile - 1] * 1000
+
+
+def summarize_latencies(latencies: list[float], duration: float) -> LatencySummary:
+    """Returns the throughput and latency percentiles of requests that took
+    `duration` seconds in total"""
+    return {
+        "requests": len(latencies),
+        "requests_per_second": round(len(latencies) / duration, 1) if duration else 0,
+        "p50_ms": round(get_percentile(latencies, 50), 3),
+        "p95_ms": round(get_percentile(latencies, 95), 3),
+        "p99_ms": round(get_percentile(latencies, 99), 3),
+    }
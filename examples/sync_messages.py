@@ -0,0 +1,13 @@
+from messaging_client import MessageBoardClient, MessageCache
+
+BASE_URL = "https://message-board.net"
+
+# Remember the messages already seen, so the next run only downloads new ones
+with MessageCache("messages.sqlite3") as cache:
+    with MessageBoardClient(BASE_URL, "Jacob", "testing123", cache=cache) as client:
+        for message in client.sync():
+            print(f"({message.id}) {message.username}: {message.message}")
+
+        # Wait up to 30 seconds for the next messages
+        for message in client.sync(wait=30):
+            print(f"({message.id}) {message.username}: {message.message}")
@@ -2,7 +2,8 @@
 
 from django.contrib import admin
 
-from .models import User, Message
+from .models import User, Message, Mention
 
 admin.site.register(User)
 admin.site.register(Message)
+admin.site.register(Mention)
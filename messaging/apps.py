@@ -8,3 +8,9 @@ class MessagingConfig(AppConfig):
 
     default_auto_field = "django.db.models.BigAutoField"
     name = "messaging"
+
+    def ready(self) -> None:
+        # Connect the signal receivers that keep in-process caches and the
+        # stored representations of messages up to date
+        # pylint: disable=import-outside-toplevel,unused-import
+        from . import auth, serializers, services
@@ -0,0 +1,133 @@
+"""A cache of recently verified credentials, so that authenticated requests
+from active clients skip the password hash
+
+Every entry remembers the stored password hash it was verified against. The
+user is still read on every request, and the entry is only used while the
+stored hash is unchanged, so a password changed or a user deleted by any
+process is noticed at once."""
+
+from collections import OrderedDict
+import hashlib
+import secrets
+import threading
+import time
+from typing import Any, Optional, TypedDict
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import User
+
+
+class CredentialCacheStats(TypedDict):
+    """The counters of a credential cache"""
+
+    hits: int
+    """The number of lookups that found a verified credential"""
+    misses: int
+    """The number of lookups that did not find a verified credential"""
+    size: int
+    """The number of credentials currently cached"""
+
+
+class _CredentialCache:
+    """A bounded LRU cache of verified (username, password) pairs whose
+    entries expire after a fixed time to live. Passwords are never stored,
+    only a keyed digest of them"""
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._key = secrets.token_bytes(32)
+        self._entries: OrderedDict[tuple[str, bytes], tuple[float, int, str]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        """The number of lookups that found a verified credential"""
+        self.misses = 0
+        """The number of lookups that did not find a verified credential"""
+
+    def _get_cache_key(self, username: str, password: str) -> tuple[str, bytes]:
+        """Returns the key of the entry for the given credentials"""
+        digest = hashlib.blake2b(
+            password.encode(), key=self._key, digest_size=16
+        ).digest()
+        return (username, digest)
+
+    def is_verified(self, user: User, password: str) -> bool:
+        """Returns if the password of the given user, just read from the
+        database, has been verified within the time to live against its
+        current stored hash"""
+        key = self._get_cache_key(user.username, password)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return False
+            if entry[1:] != (user.pk, user.hashed_password):  # Changed since
+                del self._entries[key]
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def put(self, user: User, password: str) -> None:
+        """Records that the given password was verified against the stored
+        hash of `user`"""
+        if self._max_size <= 0:
+            return
+        key = self._get_cache_key(user.username, password)
+        entry = (time.monotonic() + self._ttl, user.pk, user.hashed_password)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user: User) -> None:
+        """Removes every cached credential of the given user, including those
+        cached under a previous username"""
+        with self._lock:
+            stale = [
+                key
+                for key, (_, user_id, _) in self._entries.items()
+                if key[0] == user.username or user_id == user.pk
+            ]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        """Removes every cached credential"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> CredentialCacheStats:
+        """Returns the hit and miss counters and the size of the cache"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+
+CREDENTIAL_CACHE = _CredentialCache(
+    settings.MESSAGING_AUTH_CACHE_SIZE,
+    settings.MESSAGING_AUTH_CACHE_TTL,
+)
+"""The single instance of the credential cache"""
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def _invalidate_user_credentials(instance: User, **kwargs: Any) -> None:
+    """Removes the cached credentials of a user whenever it is created,
+    changed or deleted, so that they do not take up room. Entries are also
+    checked against the stored hash, which covers changes that send no
+    signals or are made by other processes"""
+    CREDENTIAL_CACHE.invalidate(instance)
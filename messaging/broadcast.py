@@ -0,0 +1,84 @@
+"""An in-process broadcaster that fans newly created messages out to the
+clients streaming from /messaging/message/stream and long-polling
+/messaging/message/poll
+
+Messages are published by `MESSAGE_SERVICE.create_message` once their
+transaction commits and kept in `MESSAGE_TAIL`, so subscribers receive them
+without querying the database. Only messages created by this process are
+published. Subscribers learn of the messages of other processes when
+`MESSAGE_SERVICE.await_message` checks the tail against the database, every
+`MESSAGING_TAIL_CHECK_INTERVAL` seconds."""
+
+import asyncio
+import threading
+
+from .models import EncodedMessage
+from .tail import MESSAGE_TAIL
+
+
+class _MessageBroadcaster:
+    """Wakes up the waiting subscribers whenever a message is published.
+    Messages may be published from any thread, while subscribers wait on
+    their own event loop"""
+
+    def __init__(self) -> None:
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    @property
+    def generation(self) -> int:
+        """A counter that increases every time the broadcaster is reset.
+        Subscribers compare it to detect that their cursor became invalid"""
+        return self._generation
+
+    def publish(self, message: EncodedMessage) -> None:
+        """Records a newly created message and wakes every subscriber"""
+        self.publish_all([message])
+
+    def publish_all(self, messages: list[EncodedMessage]) -> None:
+        """Records newly created messages, ordered by creation time, and
+        wakes every subscriber once"""
+        for message in messages:
+            MESSAGE_TAIL.append(message)
+        self._wake_all()
+
+    def reset(self) -> None:
+        """Forgets every published message, after all messages have been
+        removed, and wakes every subscriber"""
+        MESSAGE_TAIL.clear()
+        with self._lock:
+            self._generation += 1
+        self._wake_all()
+
+    async def wait(self, since: int, timeout: float) -> bool:
+        """Waits until a message with `id` larger than `since` is published,
+        the broadcaster is reset, or `timeout` seconds pass. Returns `False`
+        if the timeout passed first"""
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self._lock:
+            head = MESSAGE_TAIL.get_head()
+            if head is not None and head > since:
+                return True
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+    def _wake_all(self) -> None:
+        """Sets the event of every waiting subscriber on its own loop"""
+        with self._lock:
+            waiters = list(self._waiters)
+        for loop, event in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(event.set)
+
+
+BROADCASTER = _MessageBroadcaster()
+"""The single instance of the message broadcaster"""
@@ -0,0 +1,61 @@
+"""The documentation page of the API, built from `messaging.md` once and
+kept in memory with its compressed variants"""
+
+import functools
+import gzip
+import hashlib
+import importlib
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from django.template import loader
+
+from .metrics import METRICS
+
+_DOCS_PATH = Path(__file__).resolve().parent / "messaging.md"
+"""The markdown source of the documentation page"""
+
+
+class DocsPage(NamedTuple):
+    """The rendered documentation page"""
+
+    html: bytes
+    """The uncompressed HTML of the page"""
+    encoded: dict[str, bytes]
+    """The page compressed with each supported content coding, most
+    preferred first"""
+    etag: str
+    """The ETag of the page, shared by every content coding"""
+
+
+@functools.cache
+def get_docs_page() -> DocsPage:
+    """Returns the documentation page. It is rendered on first use and then
+    served from memory for the life of the process"""
+    # Imported here so that `markdown` does not slow down worker startup
+    import markdown  # pylint: disable=import-outside-toplevel
+
+    with open(_DOCS_PATH, "r", encoding="utf-8") as f:
+        # `markdown` does not remove language indicators from code blocks
+        content = f.read().replace("json", "")
+    with METRICS.time("render"):
+        body = markdown.markdown(content)
+        html = loader.render_to_string("messaging/docs.html", {"html": body}).encode()
+    encoded = {}
+    brotli = _compress_brotli(html)
+    if brotli is not None:
+        encoded["br"] = brotli
+    encoded["gzip"] = gzip.compress(html, compresslevel=9, mtime=0)
+    etag = f'"{hashlib.blake2b(html, digest_size=16).hexdigest()}"'
+    return DocsPage(html, encoded, etag)
+
+
+def _compress_brotli(content: bytes) -> Optional[bytes]:
+    """Returns the content compressed with Brotli, or `None` if the optional
+    `brotli` package is not installed"""
+    try:
+        brotli = importlib.import_module("brotli")
+    except ImportError:
+        return None
+    compressed: bytes = brotli.compress(content)
+    return compressed
@@ -0,0 +1,26 @@
+"""Management command that creates the mentions of messages that were
+posted before mentions were tracked"""
+
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from messaging.services import MESSAGE_SERVICE
+
+
+class Command(BaseCommand):
+    """Parses the tags of every existing message and stores its mentions"""
+
+    help = "Creates the mentions of every existing message"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of messages processed per transaction",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        processed = MESSAGE_SERVICE.create_missing_mentions(options["batch_size"])
+        self.stdout.write(f"Processed {processed} messages")
@@ -0,0 +1,53 @@
+"""Management command that removes the messages the retention policy no
+longer keeps, meant to be run periodically"""
+
+import time
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from messaging.services import MESSAGE_SERVICE
+
+
+class Command(BaseCommand):
+    """Removes messages beyond the configured count or age in batches
+
+    Running servers notice the removal the next time they check their
+    message tail, at most `MESSAGING_TAIL_CHECK_INTERVAL` seconds later"""
+
+    help = "Removes the messages that the retention policy no longer keeps"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--max-messages",
+            type=int,
+            default=settings.MESSAGING_RETENTION_MAX_MESSAGES,
+            help="The number of newest messages kept",
+        )
+        parser.add_argument(
+            "--max-age",
+            type=float,
+            default=settings.MESSAGING_RETENTION_MAX_AGE,
+            help="The age in seconds after which messages are removed",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.MESSAGING_PURGE_BATCH_SIZE,
+            help="The number of messages removed per transaction",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if options["max_messages"] is None and options["max_age"] is None:
+            self.stdout.write("No retention limit is configured")
+            return
+        start = time.perf_counter()
+        removed = MESSAGE_SERVICE.enforce_retention(
+            options["max_messages"], options["max_age"], options["batch_size"]
+        )
+        elapsed = time.perf_counter() - start
+        rate = removed / elapsed if elapsed > 0 else 0.0
+        self.stdout.write(
+            f"Removed {removed} messages in {elapsed:.2f}s ({rate:.0f} rows/s)"
+        )
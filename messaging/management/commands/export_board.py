@@ -0,0 +1,50 @@
+"""Management command that writes a snapshot of the whole board as
+newline-delimited JSON"""
+
+import time
+from typing import Any, Optional, TextIO
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from messaging.snapshot import export_board
+
+
+class Command(BaseCommand):
+    """Streams every user and message to a file or to standard output, in
+    chunks, so the board is exported in constant memory"""
+
+    help = "Exports every user and message as newline-delimited JSON"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--output",
+            help="The file the snapshot is written to, instead of standard output",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.MESSAGING_STREAM_CHUNK_SIZE,
+            help="The number of rows read per query",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        output: Optional[TextIO] = None
+        if options["output"]:
+            output = open(options["output"], "w", encoding="ascii")
+        start = time.perf_counter()
+        rows = 0
+        try:
+            for chunk in export_board(options["chunk_size"]):
+                rows += chunk.count(b"\n")
+                if output is not None:
+                    output.write(chunk.decode("ascii"))
+                else:
+                    self.stdout.write(chunk.decode("ascii"), ending="")
+        finally:
+            if output is not None:
+                output.close()
+        elapsed = time.perf_counter() - start
+        rate = rows / elapsed if elapsed > 0 else 0.0
+        # The snapshot may be written to standard output, so report elsewhere
+        self.stderr.write(f"Exported {rows} rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
@@ -0,0 +1,90 @@
+"""Management command that imports a snapshot of a board written by
+`export_board`"""
+
+import json
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Any, BinaryIO
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from messaging.services import MESSAGE_SERVICE
+from messaging.snapshot import ImportReport, import_board
+
+
+class Command(BaseCommand):
+    """Creates the users and messages of a snapshot in batched transactions
+
+    After every transaction, the progress is written to a checkpoint file.
+    If the import is interrupted, running it again resumes after the last
+    checkpoint, and the checkpoint is removed once the import completes.
+    Users and messages that already exist are skipped either way. Running
+    servers notice the imported messages the next time they check their
+    message tail, at most `MESSAGING_TAIL_CHECK_INTERVAL` seconds later"""
+
+    help = "Imports the users and messages of a newline-delimited JSON snapshot"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "path", help="The snapshot, or `-` to read it from standard input"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of rows created per transaction",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="The checkpoint file, by default the path followed by "
+            "`.checkpoint`",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        path = options["path"]
+        checkpoint = Path(options["checkpoint"] or f"{path}.checkpoint")
+        # Standard input cannot be read again, so it is never checkpointed
+        resumable = path != "-"
+        resumed = ImportReport(0, 0, 0)
+        if resumable and checkpoint.exists():
+            resumed = ImportReport(**json.loads(checkpoint.read_text(encoding="utf-8")))
+            self.stdout.write(f"Resuming after line {resumed.lines}")
+
+        def save_checkpoint(report: ImportReport) -> None:
+            if not resumable:
+                return
+            temporary = checkpoint.with_name(checkpoint.name + ".tmp")
+            progress = json.dumps(_add_reports(resumed, report)._asdict())
+            temporary.write_text(progress, encoding="utf-8")
+            os.replace(temporary, checkpoint)  # Never leave a partial checkpoint
+
+        lines: BinaryIO = open(path, "rb") if resumable else sys.stdin.buffer
+        start = time.perf_counter()
+        try:
+            report = import_board(
+                lines, options["batch_size"], resumed.lines, save_checkpoint
+            )
+        except (ValueError, MESSAGE_SERVICE.MissingUserException) as error:
+            raise CommandError(f"Import failed: {error!r}") from error
+        finally:
+            if resumable:
+                lines.close()
+        elapsed = time.perf_counter() - start
+        if resumable:
+            checkpoint.unlink(missing_ok=True)
+        rows = report.users + report.messages
+        rate = rows / elapsed if elapsed > 0 else 0.0
+        total = _add_reports(resumed, report)
+        self.stdout.write(
+            f"Imported {total.users} users and {total.messages} messages from "
+            f"{total.lines} lines, {rows} rows in {elapsed:.2f}s ({rate:.0f} rows/s)"
+        )
+
+
+def _add_reports(resumed: ImportReport, report: ImportReport) -> ImportReport:
+    """Returns the progress of an import that resumed from `resumed`"""
+    return ImportReport(
+        resumed.users + report.users, resumed.messages + report.messages, report.lines
+    )
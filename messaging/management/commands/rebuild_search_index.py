@@ -0,0 +1,26 @@
+"""Management command that rebuilds the search index of messages"""
+
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from messaging.search import get_search_backend
+
+
+class Command(BaseCommand):
+    """Rebuilds the index of the configured search backend from every
+    existing message"""
+
+    help = "Rebuilds the search index of every existing message"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of messages indexed per transaction",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        indexed = get_search_backend().rebuild(options["batch_size"])
+        self.stdout.write(f"Indexed {indexed} messages")
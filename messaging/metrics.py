@@ -0,0 +1,300 @@
+"""In-process performance metrics of every request, aggregated into
+histograms and rendered in the Prometheus text format. Requests are measured
+by `metrics_middleware`, which also counts the queries of the request, and
+the services report the time spent in each stage of a request"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional
+
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+_DURATION_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+"""The upper bounds of the histograms of durations, in seconds"""
+_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000)
+"""The upper bounds of the histograms of query and row counts"""
+_SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+"""The upper bounds of the histograms of payload sizes, in bytes"""
+_MAX_SLOW_REQUEST_QUERIES = 100
+"""The largest number of statements recorded for the slow request log"""
+
+
+class _Histogram:
+    """A cumulative histogram of observed values with fixed buckets"""
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)  # The last bucket is `+Inf`
+        self.sum = 0.0
+        """The sum of every observed value"""
+        self.count = 0
+        """The number of observed values"""
+
+    def observe(self, value: float) -> None:
+        """Adds a value to the histogram"""
+        self._counts[bisect_left(self._buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_buckets(self) -> Iterator[tuple[str, int]]:
+        """Yields the upper bound of every bucket with the number of values
+        less than or equal to it"""
+        total = 0
+        for bound, count in zip(self._buckets, self._counts):
+            total += count
+            yield f"{bound:g}", total
+        yield "+Inf", self.count
+
+
+class RequestMetrics:
+    """The measurements of the request being served"""
+
+    def __init__(self, record_queries: bool) -> None:
+        self.queries = 0
+        """The number of queries issued"""
+        self.query_time = 0.0
+        """The time spent executing queries, in seconds"""
+        self.rows = 0
+        """The number of messages read"""
+        self.stages: dict[str, float] = {}
+        """The time spent in each stage reported by the services"""
+        self.statements: Optional[list[tuple[float, str]]] = (
+            [] if record_queries else None
+        )
+        """The duration and SQL of every query, if recorded for the slow
+        request log"""
+
+
+_CURRENT_REQUEST: ContextVar[Optional[RequestMetrics]] = ContextVar(
+    "_CURRENT_REQUEST", default=None
+)
+"""The measurements of the request being served in the current context. The
+context is copied into the worker threads of `sync_to_async`, so queries
+issued there are counted towards the same request"""
+
+
+class _Metrics:
+    """A registry of the histograms and counters of every endpoint"""
+
+    _HISTOGRAMS = {
+        "messaging_request_duration_seconds": (
+            "The time taken to serve a request",
+            _DURATION_BUCKETS,
+        ),
+        "messaging_request_queries": (
+            "The number of database queries issued by a request",
+            _COUNT_BUCKETS,
+        ),
+        "messaging_request_query_duration_seconds": (
+            "The time a request spent executing database queries",
+            _DURATION_BUCKETS,
+        ),
+        "messaging_request_rows": (
+            "The number of messages read by a request",
+            _COUNT_BUCKETS,
+        ),
+        "messaging_response_size_bytes": (
+            "The size of the body of a response",
+            _SIZE_BUCKETS,
+        ),
+        "messaging_stage_duration_seconds": (
+            "The time a request spent in a stage such as password hashing, "
+            "serialization or rendering",
+            _DURATION_BUCKETS,
+        ),
+    }
+    """The help text and buckets of every histogram family"""
+    _COUNTERS = {
+        "messaging_requests_total": "The number of requests served",
+        "messaging_rate_limit_decisions_total": (
+            "The number of admission decisions made by the rate limiter"
+        ),
+    }
+    """The help text of every counter family"""
+
+    def __init__(self) -> None:
+        self._histograms: dict[tuple[str, tuple[tuple[str, str], ...]], _Histogram] = {}
+        self._counters: dict[tuple[str, tuple[tuple[str, str], ...]], int] = {}
+        self._lock = threading.Lock()
+
+    def start_request(self, record_queries: bool) -> "Token[Optional[RequestMetrics]]":
+        """Starts measuring a request in the current context. Returns a token
+        that must be passed to `finish_request`"""
+        return _CURRENT_REQUEST.set(RequestMetrics(record_queries))
+
+    def finish_request(
+        self,
+        token: "Token[Optional[RequestMetrics]]",
+        endpoint: str,
+        method: str,
+        status: int,
+        duration: float,
+        size: Optional[int],
+    ) -> RequestMetrics:
+        """Stops measuring the current request and records its measurements.
+        Returns the measurements"""
+        request = _CURRENT_REQUEST.get()
+        _CURRENT_REQUEST.reset(token)
+        assert request is not None
+        labels = (("endpoint", endpoint),)
+        with self._lock:
+            self._increment(
+                "messaging_requests_total",
+                (*labels, ("method", method), ("status", str(status))),
+            )
+            self._observe("messaging_request_duration_seconds", labels, duration)
+            self._observe("messaging_request_queries", labels, request.queries)
+            self._observe(
+                "messaging_request_query_duration_seconds", labels, request.query_time
+            )
+            self._observe("messaging_request_rows", labels, request.rows)
+            if size is not None:
+                self._observe("messaging_response_size_bytes", labels, size)
+            for stage, stage_duration in request.stages.items():
+                self._observe(
+                    "messaging_stage_duration_seconds",
+                    (*labels, ("stage", stage)),
+                    stage_duration,
+                )
+        return request
+
+    def increment(self, name: str, labels: tuple[tuple[str, str], ...]) -> None:
+        """Adds one to a counter"""
+        with self._lock:
+            self._increment(name, labels)
+
+    def _increment(self, name: str, labels: tuple[tuple[str, str], ...]) -> None:
+        """Adds one to a counter. The lock must be held"""
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + 1
+
+    def _observe(
+        self, name: str, labels: tuple[tuple[str, str], ...], value: float
+    ) -> None:
+        """Adds a value to a histogram. The lock must be held"""
+        histogram = self._histograms.get((name, labels))
+        if histogram is None:
+            histogram = _Histogram(self._HISTOGRAMS[name][1])
+            self._histograms[(name, labels)] = histogram
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        """Adds the time spent in the block to the given stage of the current
+        request. Does nothing outside of a request"""
+        request = _CURRENT_REQUEST.get()
+        if request is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            request.stages[stage] = request.stages.get(stage, 0.0) + elapsed
+
+    def add_rows(self, rows: int) -> None:
+        """Adds to the number of messages read by the current request"""
+        request = _CURRENT_REQUEST.get()
+        if request is not None:
+            request.rows += rows
+
+    def render(self, values: dict[str, tuple[str, str, float]]) -> str:
+        """Returns every metric in the Prometheus text format, followed by
+        the given values, each a name mapped to its type, help text and
+        value"""
+        lines = []
+        with self._lock:
+            for name, help_text in self._COUNTERS.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                for (family, labels), count in sorted(self._counters.items()):
+                    if family == name:
+                        lines.append(f"{name}{_format(labels)} {count}")
+            for name, (help_text, _) in self._HISTOGRAMS.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for (family, labels), histogram in sorted(
+                    self._histograms.items(), key=lambda item: item[0]
+                ):
+                    if family != name:
+                        continue
+                    for bound, count in histogram.get_buckets():
+                        bucket_labels = _format((*labels, ("le", bound)))
+                        lines.append(f"{name}_bucket{bucket_labels} {count}")
+                    lines.append(f"{name}_sum{_format(labels)} {histogram.sum:g}")
+                    lines.append(f"{name}_count{_format(labels)} {histogram.count}")
+        for name, (kind, help_text, value) in values.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        """Removes every recorded measurement"""
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+def _format(labels: tuple[tuple[str, str], ...]) -> str:
+    """Returns the Prometheus representation of a set of labels"""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _measure_query(
+    execute: Callable[..., Any],
+    sql: str,
+    params: Any,
+    many: bool,
+    context: dict[str, Any],
+) -> Any:
+    """Counts and times a query towards the request being served, if any"""
+    request = _CURRENT_REQUEST.get()
+    if request is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        request.queries += 1
+        request.query_time += elapsed
+        statements = request.statements
+        if statements is not None and len(statements) < _MAX_SLOW_REQUEST_QUERIES:
+            statements.append((elapsed, sql))
+
+
+@receiver(connection_created)
+def _install_query_wrapper(connection: BaseDatabaseWrapper, **kwargs: Any) -> None:
+    """Measures the queries of every database connection. A connection keeps
+    its wrappers when it reconnects, so the wrapper is installed once"""
+    if _measure_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_measure_query)
+
+
+METRICS = _Metrics()
+"""The single instance of the metrics registry"""
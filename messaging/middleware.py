@@ -0,0 +1,276 @@
+"""Middleware that applies to every request of the project"""
+
+from contextvars import Token
+import logging
+import time
+from typing import Any, Callable, Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.http.response import HttpResponseBase
+from django.utils.decorators import sync_and_async_middleware
+
+from .metrics import METRICS, RequestMetrics
+from .ratelimit import (
+    RATE_LIMITER,
+    get_client_address,
+    get_limited_paths,
+    get_retry_after,
+    get_user_key,
+)
+from .routers import READ_PINS, reset_primary, use_primary
+
+logger = logging.getLogger(__name__)
+
+_GetResponse = Callable[[HttpRequest], Any]
+"""A view or the next middleware, either synchronous or asynchronous"""
+
+_WRITE_METHODS = frozenset({"POST", "PUT", "PATCH", "DELETE"})
+"""The methods of requests that write to the database"""
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response: _GetResponse) -> _GetResponse:
+    """Records the duration, queries, rows read and payload size of every
+    request in `METRICS`, and logs requests slower than
+    `MESSAGING_SLOW_REQUEST_THRESHOLD` seconds with their SQL"""
+    if iscoroutinefunction(get_response):
+
+        async def async_middleware(request: HttpRequest) -> HttpResponseBase:
+            token = METRICS.start_request(_should_record_queries())
+            start = time.perf_counter()
+            response: HttpResponseBase = await get_response(request)
+            _finish_request(request, response, token, time.perf_counter() - start)
+            return response
+
+        markcoroutinefunction(async_middleware)
+        return async_middleware
+
+    def middleware(request: HttpRequest) -> HttpResponseBase:
+        token = METRICS.start_request(_should_record_queries())
+        start = time.perf_counter()
+        response: HttpResponseBase = get_response(request)
+        _finish_request(request, response, token, time.perf_counter() - start)
+        return response
+
+    return middleware
+
+
+def _should_record_queries() -> bool:
+    """Returns if the SQL of requests is recorded for the slow request log"""
+    return settings.MESSAGING_SLOW_REQUEST_THRESHOLD is not None
+
+
+def _finish_request(
+    request: HttpRequest,
+    response: HttpResponseBase,
+    token: "Token[Optional[RequestMetrics]]",
+    duration: float,
+) -> None:
+    """Records the measurements of a served request and logs it if it was
+    slow. The body of a streaming response is not measured"""
+    match = request.resolver_match
+    endpoint = "/" + match.route if match is not None else "unmatched"
+    size = len(response.content) if isinstance(response, HttpResponse) else None
+    measured = METRICS.finish_request(
+        token,
+        endpoint,
+        request.method or "",
+        response.status_code,
+        duration,
+        size,
+    )
+    threshold = settings.MESSAGING_SLOW_REQUEST_THRESHOLD
+    if threshold is None or duration < threshold:
+        return
+    statements = "".join(
+        f"\n  {elapsed * 1000:.1f}ms {sql}"
+        for elapsed, sql in measured.statements or []
+    )
+    logger.warning(
+        "Slow request %s %s took %.1fms: %d queries in %.1fms, %d rows, " "stages %s%s",
+        request.method,
+        request.get_full_path(),
+        duration * 1000,
+        measured.queries,
+        measured.query_time * 1000,
+        measured.rows,
+        {stage: round(elapsed * 1000, 1) for stage, elapsed in measured.stages.items()},
+        statements,
+    )
+
+
+@sync_and_async_middleware
+def rate_limit_middleware(get_response: _GetResponse) -> _GetResponse:
+    """Sheds requests to the endpoints that write to the database when their
+    client or user is over its rate limit, with `429 Too Many Requests`, or
+    when too many writes are being served, with `503 Service Unavailable`.
+    Requests to other endpoints that carry credentials are shed when their
+    client is over its rate limit, and charged if the credentials are
+    rejected"""
+    if iscoroutinefunction(get_response):
+
+        async def async_middleware(request: HttpRequest) -> HttpResponseBase:
+            if request.path_info not in get_limited_paths():
+                rejection = _admit_credentials(request)
+                if rejection is not None:
+                    return rejection
+                response: HttpResponseBase = await get_response(request)
+                _charge_rejected_credentials(request, response)
+                return response
+            rejection = _admit(request)
+            if rejection is not None:
+                return rejection
+            try:
+                response = await get_response(request)
+            finally:
+                RATE_LIMITER.finish_write()
+            _charge_user(request, response)
+            return response
+
+        markcoroutinefunction(async_middleware)
+        return async_middleware
+
+    def middleware(request: HttpRequest) -> HttpResponseBase:
+        if request.path_info not in get_limited_paths():
+            rejection = _admit_credentials(request)
+            if rejection is not None:
+                return rejection
+            response: HttpResponseBase = get_response(request)
+            _charge_rejected_credentials(request, response)
+            return response
+        rejection = _admit(request)
+        if rejection is not None:
+            return rejection
+        try:
+            response = get_response(request)
+        finally:
+            RATE_LIMITER.finish_write()
+        _charge_user(request, response)
+        return response
+
+    return middleware
+
+
+def _admit(request: HttpRequest) -> Optional[HttpResponse]:
+    """Decides whether a request to a limited endpoint is served. Returns the
+    response that rejects it, or `None` if it was admitted, in which case
+    `RATE_LIMITER.finish_write` must be called once it is served"""
+    wait = RATE_LIMITER.get_address_wait(request)
+    if wait > 0:
+        return _reject(request, "address", 429, wait)
+    wait = RATE_LIMITER.get_user_wait(request, charge=False)
+    if wait > 0:
+        return _reject(request, "user", 429, wait)
+    if not RATE_LIMITER.start_write():
+        return _reject(request, "concurrency", 503, 1)
+    _count_decision(request, "admitted")
+    return None
+
+
+def _admit_credentials(request: HttpRequest) -> Optional[HttpResponse]:
+    """Decides whether a request to an endpoint that is not limited is
+    served. Requests with credentials are rejected while their client
+    address has no token left. Returns the response that rejects it, or
+    `None` if it was admitted"""
+    if get_user_key(request) is None:
+        return None
+    wait = RATE_LIMITER.get_address_wait(request, charge=False)
+    if wait > 0:
+        return _reject(request, "address", 429, wait)
+    return None
+
+
+def _charge_rejected_credentials(
+    request: HttpRequest, response: HttpResponseBase
+) -> None:
+    """Takes a token from the client address of a request to an endpoint
+    that is not limited if its credentials were rejected, so that each
+    guessed password costs a token"""
+    if response.status_code == 401:
+        RATE_LIMITER.get_address_wait(request)
+
+
+def _charge_user(request: HttpRequest, response: HttpResponseBase) -> None:
+    """Takes a token from the user of a served request, unless it failed to
+    authenticate, so that guessing passwords does not lock out the user"""
+    if response.status_code != 401:
+        RATE_LIMITER.get_user_wait(request, charge=True)
+
+
+def _reject(
+    request: HttpRequest, reason: str, status: int, wait: float
+) -> HttpResponse:
+    """Returns the response that rejects a request, asking the client to
+    retry after `wait` seconds"""
+    _count_decision(request, reason)
+    error = "Too many requests" if status == 429 else "Too many pending writes"
+    response = JsonResponse({"error": error}, status=status)
+    response["Retry-After"] = get_retry_after(wait)
+    return response
+
+
+def _count_decision(request: HttpRequest, decision: str) -> None:
+    """Counts an admission decision in `METRICS`"""
+    METRICS.increment(
+        "messaging_rate_limit_decisions_total",
+        (("endpoint", request.path_info), ("decision", decision)),
+    )
+
+
+@sync_and_async_middleware
+def read_your_writes_middleware(get_response: _GetResponse) -> _GetResponse:
+    """Sends the reads of write requests to the primary database, and those
+    of clients that wrote in the last `MESSAGING_READ_YOUR_WRITES_SECONDS`
+    seconds, so that clients see their own writes even if the read database
+    lags behind. Other reads go to the read database"""
+    if iscoroutinefunction(get_response):
+
+        async def async_middleware(request: HttpRequest) -> HttpResponseBase:
+            keys = _get_client_keys(request)
+            token = use_primary(_is_write(request) or READ_PINS.is_pinned(keys))
+            try:
+                response: HttpResponseBase = await get_response(request)
+            finally:
+                reset_primary(token)
+            _pin_writer(request, response, keys)
+            return response
+
+        markcoroutinefunction(async_middleware)
+        return async_middleware
+
+    def middleware(request: HttpRequest) -> HttpResponseBase:
+        keys = _get_client_keys(request)
+        token = use_primary(_is_write(request) or READ_PINS.is_pinned(keys))
+        try:
+            response: HttpResponseBase = get_response(request)
+        finally:
+            reset_primary(token)
+        _pin_writer(request, response, keys)
+        return response
+
+    return middleware
+
+
+def _get_client_keys(request: HttpRequest) -> list[str]:
+    """Returns the keys of the client of a request: its address, which also
+    identifies it on endpoints that take no credentials, and its user"""
+    keys = ["address:" + get_client_address(request)]
+    user_key = get_user_key(request)
+    if user_key is not None:
+        keys.append(user_key)
+    return keys
+
+
+def _is_write(request: HttpRequest) -> bool:
+    """Returns if the request may write to the database"""
+    return request.method in _WRITE_METHODS
+
+
+def _pin_writer(
+    request: HttpRequest, response: HttpResponseBase, keys: list[str]
+) -> None:
+    """Pins the client of a successful write to the primary database"""
+    if _is_write(request) and response.status_code < 400:
+        READ_PINS.pin(keys, settings.MESSAGING_READ_YOUR_WRITES_SECONDS)
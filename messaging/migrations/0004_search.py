@@ -0,0 +1,102 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:38
+
+import django.db.models.deletion
+from django.apps.registry import Apps
+from django.db import migrations, models
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+from django.db.utils import OperationalError
+
+CREATE_FTS5_INDEX = [
+    """CREATE VIRTUAL TABLE messaging_message_fts USING fts5(
+        message, content='messaging_message', content_rowid='id'
+    )""",
+    """CREATE TRIGGER messaging_message_fts_insert AFTER INSERT ON messaging_message
+    BEGIN
+        INSERT INTO messaging_message_fts(rowid, message)
+        VALUES (new.id, new.message);
+    END""",
+    """CREATE TRIGGER messaging_message_fts_delete AFTER DELETE ON messaging_message
+    BEGIN
+        INSERT INTO messaging_message_fts(messaging_message_fts, rowid, message)
+        VALUES ('delete', old.id, old.message);
+    END""",
+    """CREATE TRIGGER messaging_message_fts_update
+    AFTER UPDATE OF message ON messaging_message
+    BEGIN
+        INSERT INTO messaging_message_fts(messaging_message_fts, rowid, message)
+        VALUES ('delete', old.id, old.message);
+        INSERT INTO messaging_message_fts(rowid, message)
+        VALUES (new.id, new.message);
+    END""",
+    "INSERT INTO messaging_message_fts(messaging_message_fts) VALUES ('rebuild')",
+]
+
+DROP_FTS5_INDEX = [
+    "DROP TRIGGER IF EXISTS messaging_message_fts_insert",
+    "DROP TRIGGER IF EXISTS messaging_message_fts_delete",
+    "DROP TRIGGER IF EXISTS messaging_message_fts_update",
+    "DROP TABLE IF EXISTS messaging_message_fts",
+]
+
+
+def create_fts5_index(apps: Apps, schema_editor: BaseDatabaseSchemaEditor) -> None:
+    """Creates the FTS5 index of messages and the triggers that keep it in
+    sync, if the database is SQLite and was built with FTS5"""
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+        except OperationalError:
+            return  # FTS5 is not available, so the inverted index is used
+        cursor.execute("DROP TABLE temp.fts5_probe")
+    for statement in CREATE_FTS5_INDEX:
+        schema_editor.execute(statement)
+
+
+def drop_fts5_index(apps: Apps, schema_editor: BaseDatabaseSchemaEditor) -> None:
+    """Drops the FTS5 index of messages and its triggers"""
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for statement in DROP_FTS5_INDEX:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("messaging", "0003_token"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SearchTerm",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("term", models.CharField(max_length=100)),
+                (
+                    "message",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="messaging.message",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("term", "message"), name="unique_search_term_message"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(create_fts5_index, drop_fts5_index),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:47
+
+import importlib
+
+import django.utils.timezone
+from django.db import migrations, models
+
+# SQLite adds the column by rebuilding the table, which drops the triggers of
+# the FTS5 index, so the index is dropped first and created again afterwards
+search = importlib.import_module("messaging.migrations.0004_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("messaging", "0004_search"),
+    ]
+
+    operations = [
+        migrations.RunPython(search.drop_fts5_index, search.create_fts5_index),
+        migrations.AddField(
+            model_name="message",
+            name="created_at",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+        migrations.RunPython(search.create_fts5_index, search.drop_fts5_index),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:48
+
+from django.apps.registry import Apps
+from django.db import migrations, models
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_messages(apps: Apps, schema_editor: BaseDatabaseSchemaEditor) -> None:
+    """Stores the number of messages of every existing user"""
+    User = apps.get_model("messaging", "User")
+    Message = apps.get_model("messaging", "Message")
+    counts = (
+        Message.objects.filter(user=OuterRef("pk"))
+        .order_by()
+        .values("user")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    User.objects.update(message_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("messaging", "0005_message_created_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="message_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_messages, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(fields=["user", "id"], name="message_user_id_idx"),
+        ),
+    ]
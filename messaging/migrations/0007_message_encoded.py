@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:57
+
+import importlib
+import json
+
+from django.apps.registry import Apps
+from django.db import migrations, models
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+
+# SQLite adds the column by rebuilding the table, which drops the triggers of
+# the FTS5 index, so the index is dropped first and created again afterwards.
+# Its update trigger now only fires when the text of a message changes
+search = importlib.import_module("messaging.migrations.0004_search")
+
+
+def encode_messages(apps: Apps, schema_editor: BaseDatabaseSchemaEditor) -> None:
+    """Stores the JSON representation of every existing message"""
+    Message = apps.get_model("messaging", "Message")
+    objects = Message.objects.select_related("user").order_by("id")
+    last_id = 0
+    while True:
+        batch = list(objects.filter(id__gt=last_id)[:1000])
+        if not batch:
+            return
+        for message in batch:
+            message.encoded = json.dumps(
+                {
+                    "id": message.id,
+                    "username": message.user.username,
+                    "message": message.message,
+                }
+            ).encode()
+        Message.objects.bulk_update(batch, ["encoded"])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("messaging", "0006_user_history"),
+    ]
+
+    operations = [
+        migrations.RunPython(search.drop_fts5_index, search.create_fts5_index),
+        migrations.AddField(
+            model_name="message",
+            name="encoded",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.RunPython(encode_messages, migrations.RunPython.noop),
+        migrations.RunPython(search.create_fts5_index, search.drop_fts5_index),
+    ]
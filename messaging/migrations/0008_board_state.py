@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:38
+
+from django.apps.registry import Apps
+from django.db import migrations, models
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+
+
+def create_board_state(apps: Apps, schema_editor: BaseDatabaseSchemaEditor) -> None:
+    """Creates the single row of the board state"""
+    apps.get_model("messaging", "BoardState").objects.create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("messaging", "0007_message_encoded"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BoardState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("changes", models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_board_state, migrations.RunPython.noop),
+    ]
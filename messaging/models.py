@@ -1,9 +1,14 @@
 """Model classes that represent the object model of the
 message board"""
 
-from typing import TypedDict
+import json
+from typing import NamedTuple, TypedDict
 
 from django.db import models
+from django.utils import timezone
+
+MESSAGE_MAX_LENGTH = 500
+"""The largest number of characters in the text of a message"""
 
 
 class MessageJSON(TypedDict):
@@ -17,15 +22,31 @@ class MessageJSON(TypedDict):
     """The text of the message"""
 
 
+class EncodedMessage(NamedTuple):
+    """A message with its JSON representation already encoded, which is
+    joined into responses as is"""
+
+    id: int
+    """The unique id of the message"""
+    json: bytes
+    """The encoded JSON representation of the message"""
+
+
 class User(models.Model):
     """A model that represents a user in the message board application"""
 
     username = models.CharField(max_length=100, unique=True)
     """The username of the user"""
     hashed_password = models.CharField(max_length=100)
-    """The hashed and salted password of the user"""
+    """The hashed and salted password of the user. Either an encoded password
+    from `django.contrib.auth.hashers`, or the legacy SHA-256 hex digest of
+    the password followed by `password_salt`"""
     password_salt = models.UUIDField()
-    """The salt of the password"""
+    """The salt of a legacy SHA-256 password"""
+    message_count = models.PositiveIntegerField(default=0)
+    """The number of messages the user has created, kept up to date when
+    messages are created, moved to another user or deleted so it can be read
+    without counting"""
 
 
 class Message(models.Model):
@@ -36,8 +57,22 @@ class Message(models.Model):
     """The unique id of the message"""
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     """The user that created this message"""
-    message = models.CharField(max_length=500)
+    message = models.CharField(max_length=MESSAGE_MAX_LENGTH)
     """The text of the message"""
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    """The time the message was created. Messages created before this field
+    existed have the time of the migration that added it"""
+    encoded = models.BinaryField(default=b"", editable=False)
+    """The result of `encode`, stored when the message is created so reads
+    do not encode messages again. It is updated when the message is saved
+    or its user changes username"""
+
+    class Meta:
+        indexes = [
+            # Serves the pages of a user's history, which filter by user and
+            # order by id
+            models.Index(fields=["user", "id"], name="message_user_id_idx"),
+        ]
 
     def json(self) -> MessageJSON:
         """Returns the JSON representation of this message"""
@@ -46,3 +81,64 @@ class Message(models.Model):
             "username": self.user.username,
             "message": self.message,
         }
+
+    def encode(self) -> bytes:
+        """Returns the encoded JSON representation of this message"""
+        return json.dumps(self.json()).encode()
+
+
+class Token(models.Model):
+    """A model that represents a bearer token issued to a user when they log
+    in, which authenticates their requests in place of their password"""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    """The user that the token was issued to"""
+    hashed_token = models.CharField(max_length=64, unique=True)
+    """The SHA-256 hex digest of the token. The token itself is never
+    stored"""
+    expires_at = models.DateTimeField(db_index=True)
+    """The time after which the token is no longer accepted"""
+
+
+class Mention(models.Model):
+    """A model that represents a user being tagged in a message with the `@`
+    symbol followed by their username"""
+
+    message = models.ForeignKey(Message, on_delete=models.CASCADE)
+    """The message that contains the tag"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    """The user that was tagged"""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "message"], name="unique_mention_user_message"
+            )
+        ]
+
+
+class SearchTerm(models.Model):
+    """A model that represents a word that appears in a message, used to
+    search messages when SQLite's FTS5 extension is not available"""
+
+    term = models.CharField(max_length=100)
+    """The word, in lowercase"""
+    message = models.ForeignKey(Message, on_delete=models.CASCADE)
+    """The message that contains the word"""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["term", "message"], name="unique_search_term_message"
+            )
+        ]
+
+
+class BoardState(models.Model):
+    """A model with a single row that counts the changes to messages which
+    the in-process message tails cannot observe, such as removals, so that
+    the tail of every process notices them"""
+
+    changes = models.PositiveBigIntegerField(default=0)
+    """The number of times messages were removed, changed or created without
+    being appended to the tail of the process that wrote them"""
@@ -0,0 +1,161 @@
+"""In-process admission control for the endpoints that write to the
+database or check passwords, so that a single client cannot monopolize
+SQLite's single writer or the password hasher
+
+Every client IP address and every authenticated user has a token bucket.
+A request takes a token from the bucket of its address, and a request that
+authenticated takes one from the bucket of its user once it completes, so
+failed logins cannot drain the bucket of the user they claim to be. On top
+of that, the number of write requests served at once is capped. Requests to
+the other endpoints are only admitted while their address has a token, and
+take one if their credentials are rejected, so passwords cannot be guessed
+without limit. Like the other in-process state, the limits apply to each
+process separately.
+
+Behind a reverse proxy, the client address is read from the header named by
+`MESSAGING_CLIENT_ADDRESS_HEADER`, so that clients do not share the bucket
+of the proxy."""
+
+from collections import OrderedDict
+import functools
+import hashlib
+import math
+import threading
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.http import HttpRequest
+from django.urls import reverse
+
+
+class _TokenBuckets:
+    """The token buckets of many clients, each refilled at `rate` tokens per
+    second up to `burst` tokens. Only the `max_size` most recently used
+    buckets are kept, and a client whose bucket was evicted starts again
+    with a full bucket"""
+
+    def __init__(self, rate: float, burst: float, max_size: int) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._max_size = max_size
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, charge: bool = True) -> float:
+        """Takes a token from the bucket of `key`, or only checks that it has
+        one if `charge` is false. Returns 0 if it has a token, otherwise how
+        many seconds until it does. Every key has a token if `rate` is 0"""
+        if self._rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self._burst, now))
+            tokens = min(self._burst, tokens + (now - updated) * self._rate)
+            if tokens < 1:
+                return (1 - tokens) / self._rate
+            self._buckets[key] = (tokens - 1 if charge else tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self._max_size:
+                self._buckets.popitem(last=False)
+            return 0.0
+
+    def clear(self) -> None:
+        """Refills every bucket"""
+        with self._lock:
+            self._buckets.clear()
+
+
+class _RateLimiter:
+    """Decides whether requests to the limited endpoints are admitted"""
+
+    def __init__(self) -> None:
+        self._addresses = _TokenBuckets(
+            settings.MESSAGING_RATE_LIMIT_IP_RATE,
+            settings.MESSAGING_RATE_LIMIT_IP_BURST,
+            settings.MESSAGING_RATE_LIMIT_MAX_CLIENTS,
+        )
+        self._users = _TokenBuckets(
+            settings.MESSAGING_RATE_LIMIT_USER_RATE,
+            settings.MESSAGING_RATE_LIMIT_USER_BURST,
+            settings.MESSAGING_RATE_LIMIT_MAX_CLIENTS,
+        )
+        self._max_writes = settings.MESSAGING_MAX_CONCURRENT_WRITES
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get_address_wait(self, request: HttpRequest, charge: bool = True) -> float:
+        """Takes, or only checks if `charge` is false, a token for the client
+        address of the request. Returns how many seconds the client must wait
+        if it has none left"""
+        return self._addresses.take(get_client_address(request), charge)
+
+    def get_user_wait(self, request: HttpRequest, charge: bool) -> float:
+        """Checks, or takes if `charge` is true, a token for the user the
+        request claims to be. Returns how many seconds the user must wait if
+        they have none left. Requests without credentials are not limited"""
+        key = get_user_key(request)
+        return self._users.take(key, charge) if key is not None else 0.0
+
+    def start_write(self) -> bool:
+        """Counts a write request as being served. Returns `False`, without
+        counting it, if the cap on concurrent writes is reached"""
+        with self._lock:
+            if self._writes >= self._max_writes > 0:
+                return False
+            self._writes += 1
+            return True
+
+    def finish_write(self) -> None:
+        """Counts a write request as served"""
+        with self._lock:
+            self._writes -= 1
+
+    def clear(self) -> None:
+        """Refills every bucket"""
+        self._addresses.clear()
+        self._users.clear()
+
+
+def get_client_address(request: HttpRequest) -> str:
+    """Returns the address of the client of a request. It is the last address
+    in the `MESSAGING_CLIENT_ADDRESS_HEADER` header, which the trusted proxy
+    added, if the header is configured and present, otherwise the address of
+    the connection"""
+    header: Optional[str] = settings.MESSAGING_CLIENT_ADDRESS_HEADER
+    if header:
+        key = "HTTP_" + header.upper().replace("-", "_")
+        forwarded: Optional[str] = request.META.get(key)
+        if forwarded:
+            return forwarded.rsplit(",", 1)[-1].strip()
+    address: str = request.META.get("REMOTE_ADDR", "")
+    return address
+
+
+def get_user_key(request: HttpRequest) -> Optional[str]:
+    """Returns the key of the user that the credentials of the request
+    belong to, or `None` if there are none. Tokens are hashed so that they
+    are not kept in memory"""
+    authorization = request.META.get("HTTP_AUTHORIZATION")
+    if authorization:
+        return "token:" + hashlib.blake2b(authorization.encode()).hexdigest()
+    username = request.META.get("HTTP_USERNAME")
+    return "user:" + username if username else None
+
+
+@functools.cache
+def get_limited_paths() -> frozenset[str]:
+    """Returns the paths of the rate limited endpoints, all of which write
+    to the database"""
+    return frozenset(
+        reverse(name) for name in ("user", "login", "create", "batch", "nuke")
+    )
+
+
+def get_retry_after(wait: float) -> str:
+    """Returns the `Retry-After` header value for a wait in seconds"""
+    return str(max(1, math.ceil(wait)))
+
+
+RATE_LIMITER = _RateLimiter()
+"""The single instance of the rate limiter"""
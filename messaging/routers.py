@@ -0,0 +1,107 @@
+"""Database routing that sends reads to a read-only connection and writes to
+the primary database, so that polling clients do not wait behind writes
+
+With SQLite, the `read` alias opens the same file read-only. In WAL mode,
+its readers run while a message is written. With other backends it may
+point at a replica, which can lag behind the primary. So a client that just
+wrote is pinned to the primary for `MESSAGING_READ_YOUR_WRITES_SECONDS` and
+sees its own writes. Like the other in-process state, pins apply to each
+process separately."""
+
+from collections import OrderedDict
+from contextvars import ContextVar, Token
+import threading
+import time
+from typing import Any, Iterable, Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Model
+
+READ_DB_ALIAS = "read"
+"""The alias of the database that reads are sent to"""
+
+_use_primary: ContextVar[bool] = ContextVar("use_primary", default=False)
+"""Whether the reads of the current request are sent to the primary"""
+
+
+class ReadWriteRouter:
+    """Sends writes and migrations to the primary database, and reads to the
+    `read` database if it is configured. Reads go to the primary while the
+    primary is in a transaction, so that they see its uncommitted writes,
+    and while the request is pinned to it"""
+
+    def db_for_read(self, model: type[Model], **hints: Any) -> str:
+        """Returns the primary while it is in an atomic block or the request
+        is pinned to it, otherwise the `read` database if it is configured"""
+        if (
+            READ_DB_ALIAS not in settings.DATABASES
+            or _use_primary.get()
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        return READ_DB_ALIAS
+
+    def db_for_write(self, model: type[Model], **hints: Any) -> str:
+        """Returns the primary, which every write goes to"""
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1: Model, obj2: Model, **hints: Any) -> bool:
+        """Allows every relation, since both aliases hold the same rows"""
+        return True
+
+    def allow_migrate(
+        self, db: str, app_label: str, model_name: Optional[str] = None, **hints: Any
+    ) -> bool:
+        """Only migrates the primary, since the `read` database is the same
+        file or a replica of it"""
+        return db == DEFAULT_DB_ALIAS
+
+
+class _ReadPins:
+    """The clients whose reads are sent to the primary because they wrote
+    recently, each until its pin expires. Only the `max_size` most recently
+    pinned clients are kept"""
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._pins: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pin(self, keys: Iterable[str], seconds: float) -> None:
+        """Pins the clients with the given keys for `seconds` seconds"""
+        if seconds <= 0:
+            return
+        expires = time.monotonic() + seconds
+        with self._lock:
+            for key in keys:
+                self._pins[key] = expires
+                self._pins.move_to_end(key)
+            while len(self._pins) > self._max_size:
+                self._pins.popitem(last=False)
+
+    def is_pinned(self, keys: Iterable[str]) -> bool:
+        """Returns if any of the clients with the given keys is pinned"""
+        now = time.monotonic()
+        with self._lock:
+            return any(self._pins.get(key, 0.0) > now for key in keys)
+
+    def clear(self) -> None:
+        """Removes every pin"""
+        with self._lock:
+            self._pins.clear()
+
+
+def use_primary(enabled: bool) -> "Token[bool]":
+    """Sends the reads of the current context to the primary if `enabled`.
+    Returns the token that `reset_primary` takes to undo it"""
+    return _use_primary.set(enabled)
+
+
+def reset_primary(token: "Token[bool]") -> None:
+    """Undoes a call to `use_primary`"""
+    _use_primary.reset(token)
+
+
+READ_PINS = _ReadPins(settings.MESSAGING_RATE_LIMIT_MAX_CLIENTS)
+"""The single instance of the read pins"""
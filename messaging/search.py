@@ -0,0 +1,136 @@
+"""Backends that find the messages containing the words of a search query.
+The FTS5 backend uses the SQLite full-text index created by the migrations,
+and the inverted index backend works on any database"""
+
+from abc import ABC, abstractmethod
+import functools
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, connections, router, transaction
+
+from .models import Message, SearchTerm
+
+_WORD_PATTERN = re.compile(r"\w+")
+"""The pattern of a searchable word"""
+
+_FTS5_TABLE = "messaging_message_fts"
+"""The name of the FTS5 table created by the migrations"""
+
+
+def _get_words(text: str) -> list[str]:
+    """Returns the distinct lowercase words of the given text, in order"""
+    words = (word[:100] for word in _WORD_PATTERN.findall(text.lower()))
+    return list(dict.fromkeys(words))
+
+
+class _SearchBackend(ABC):
+    """A way of finding the messages that contain every word of a query"""
+
+    def index(self, messages: list[Message]) -> None:
+        """Makes the given newly created messages searchable"""
+
+    @abstractmethod
+    def search(self, query: str, limit: int, offset: int) -> list[int]:
+        """Returns the ids of the messages that contain every word of the
+        query, best match first, skipping the first `offset` matches"""
+
+    @abstractmethod
+    def rebuild(self, batch_size: int) -> int:
+        """Rebuilds the index from every message in the system. Returns the
+        number of messages indexed"""
+
+
+class _FTS5SearchBackend(_SearchBackend):
+    """Searches the FTS5 index of messages, ranked by BM25. The index is kept
+    in sync by triggers on the message table, so nothing is done when
+    messages are created"""
+
+    def search(self, query: str, limit: int, offset: int) -> list[int]:
+        words = _get_words(query)
+        if not words:
+            return []
+        # Quote every word so the query cannot use FTS5 syntax
+        match = " ".join(f'"{word}"' for word in words)
+        with connections[router.db_for_read(Message)].cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {_FTS5_TABLE} WHERE {_FTS5_TABLE} MATCH %s "
+                "ORDER BY rank LIMIT %s OFFSET %s",
+                [match, limit, offset],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def rebuild(self, batch_size: int) -> int:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {_FTS5_TABLE}({_FTS5_TABLE}) VALUES ('rebuild')"
+            )
+        return Message.objects.count()
+
+
+class _InvertedIndexSearchBackend(_SearchBackend):
+    """Searches a table of the words of every message. Matches are ranked
+    newest first"""
+
+    def index(self, messages: list[Message]) -> None:
+        SearchTerm.objects.bulk_create(
+            [
+                SearchTerm(term=word, message_id=message.id)
+                for message in messages
+                for word in _get_words(message.message)
+            ],
+            ignore_conflicts=True,
+        )
+
+    def search(self, query: str, limit: int, offset: int) -> list[int]:
+        words = _get_words(query)
+        if not words:
+            return []
+        objects = Message.objects.all()
+        for word in words:  # Each filter joins the words again, so all must match
+            objects = objects.filter(searchterm__term=word)
+        ids = objects.order_by("-id").values_list("id", flat=True)
+        return list(ids[offset : offset + limit])
+
+    def rebuild(self, batch_size: int) -> int:
+        SearchTerm.objects.all().delete()
+        indexed = 0
+        last_id = 0
+        while True:
+            batch = list(
+                Message.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .only("id", "message")[:batch_size]
+            )
+            if not batch:
+                return indexed
+            with transaction.atomic():
+                self.index(batch)
+            indexed += len(batch)
+            last_id = batch[-1].id
+
+
+def _has_fts5_index() -> bool:
+    """Returns if the database has the FTS5 index of messages"""
+    return (
+        connection.vendor == "sqlite"
+        and _FTS5_TABLE in connection.introspection.table_names()
+    )
+
+
+@functools.cache
+def get_search_backend() -> _SearchBackend:
+    """Returns the search backend chosen by the `MESSAGING_SEARCH_BACKEND`
+    setting. `auto` uses FTS5 if the database has the FTS5 index, and the
+    inverted index otherwise"""
+    backend = settings.MESSAGING_SEARCH_BACKEND
+    if backend == "auto":
+        backend = "fts5" if _has_fts5_index() else "inverted"
+    if backend == "fts5":
+        if not _has_fts5_index():
+            raise ImproperlyConfigured("The database has no FTS5 index of messages")
+        return _FTS5SearchBackend()
+    if backend == "inverted":
+        return _InvertedIndexSearchBackend()
+    raise ImproperlyConfigured(f"Unknown search backend {backend!r}")
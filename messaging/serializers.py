@@ -0,0 +1,111 @@
+"""Functions that convert model querysets into their JSON representations
+in bulk. Every message stores its encoded representation, so reading a
+message only fetches it, and responses join the stored representations"""
+
+from typing import Any, AsyncIterator, Optional
+
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .metrics import METRICS
+from .models import EncodedMessage, Message, User
+from .tail import MESSAGE_TAIL
+
+_MESSAGE_FIELDS = ("id", "encoded")
+"""The fields of a message that make up its JSON representation"""
+_ENCODE_BATCH_SIZE = 1000
+"""The number of messages encoded again per query when a user is renamed"""
+
+
+def serialize_messages(messages: "QuerySet[Message]") -> list[EncodedMessage]:
+    """Returns the JSON representations of the given messages, in the order
+    of the queryset. Only the stored representations are read, so no model
+    instances are created and no `User` rows are joined"""
+    with METRICS.time("serialize"):
+        rows = messages.values_list(*_MESSAGE_FIELDS)
+        serialized = [EncodedMessage(*row) for row in rows]
+    METRICS.add_rows(len(serialized))
+    return serialized
+
+
+async def aserialize_messages(
+    messages: "QuerySet[Message]",
+) -> list[EncodedMessage]:
+    """Asynchronous version of `serialize_messages`"""
+    with METRICS.time("serialize"):
+        rows = messages.values_list(*_MESSAGE_FIELDS)
+        serialized = [EncodedMessage(*row) async for row in rows]
+    METRICS.add_rows(len(serialized))
+    return serialized
+
+
+async def aiter_messages(
+    messages: "QuerySet[Message]", chunk_size: int, key: str = "id"
+) -> AsyncIterator[EncodedMessage]:
+    """Yields the JSON representations of the given messages, ordered by
+    `id`. The messages are read `chunk_size` at a time, each chunk with its
+    own query that resumes after the last `id` read, so only one chunk is
+    held in memory and no cursor is kept open between chunks. The chunks are
+    ordered by `key`, a column equal to the `id` of the messages"""
+    rows = messages.order_by(key).values_list(*_MESSAGE_FIELDS)
+    last_id = 0
+    while True:
+        chunk = [row async for row in rows.filter(id__gt=last_id)[:chunk_size]]
+        for row in chunk:
+            yield EncodedMessage(*row)
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1][0]
+
+
+def encode_messages(messages: "QuerySet[Message]", batch_size: int) -> int:
+    """Stores the JSON representation of the given messages again, `batch_size`
+    messages at a time. Returns the number of messages encoded"""
+    encoded = 0
+    last_id = 0
+    objects = messages.select_related("user").only("id", "message", "user__username")
+    while True:
+        batch = list(objects.filter(id__gt=last_id).order_by("id")[:batch_size])
+        if not batch:
+            return encoded
+        for message in batch:
+            message.encoded = message.encode()
+        Message.objects.bulk_update(batch, ["encoded"])
+        encoded += len(batch)
+        last_id = batch[-1].id
+
+
+@receiver(post_save, sender=User)
+def _encode_renamed_user_messages(
+    instance: User,
+    created: bool,
+    update_fields: Optional[frozenset[str]],
+    **kwargs: Any
+) -> None:
+    """Encodes the messages of a user again when their username changed. The
+    newest message tells whether it did, so saves that leave the username
+    alone cost one indexed read"""
+    if created or (update_fields is not None and "username" not in update_fields):
+        return
+    messages = Message.objects.filter(user=instance)
+    newest = messages.order_by("-id").select_related("user").first()
+    if newest is None or newest.encode() == newest.encoded:
+        return
+    with transaction.atomic():
+        encode_messages(messages, _ENCODE_BATCH_SIZE)
+        MESSAGE_TAIL.invalidate()  # Tails hold the old username
+
+
+@receiver(post_save, sender=Message)
+def _encode_saved_message(instance: Message, **kwargs: Any) -> None:
+    """Encodes a message that was saved on its own, such as through the admin
+    site. Messages created by the services are encoded in bulk instead, which
+    sends no signals"""
+    encoded = instance.encode()
+    if encoded == instance.encoded:
+        return
+    instance.encoded = encoded
+    Message.objects.filter(pk=instance.pk).update(encoded=encoded)
+    MESSAGE_TAIL.invalidate()  # Tails may hold the old text
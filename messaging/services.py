@@ -1,10 +1,43 @@
 """Service classes used to interact with model objects"""
 
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timedelta
 import hashlib
-from typing import Optional
+import hmac
+import re
+import secrets
+import time
+from typing import Any, AsyncIterator, NamedTuple, Optional
 import uuid
 
-from .models import User, Message
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, OuterRef, Q, QuerySet, Subquery
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .auth import CREDENTIAL_CACHE
+from .broadcast import BROADCASTER
+from .metrics import METRICS
+from .models import BoardState, User, Message, EncodedMessage, Mention, Token
+from .search import get_search_backend
+from .serializers import aiter_messages, aserialize_messages, serialize_messages
+from .tail import MESSAGE_TAIL
+
+
+class MessageStream(NamedTuple):
+    """A page of messages that are read from the database as they are
+    consumed"""
+
+    messages: AsyncIterator[EncodedMessage]
+    """The messages of the page, ordered by creation time"""
+    next_cursor: Optional[int]
+    """The `before` cursor of the previous page, or `None` if there are no
+    older messages"""
 
 
 class _UserService:
@@ -14,10 +47,40 @@ class _UserService:
         """An exception thrown if a user already exists when creating a
         new user"""
 
-    def _get_hashed_password(self, password: str, salt: uuid.UUID) -> str:
-        """Returns the hashed and salted password"""
+    class InvalidUsernameException(Exception):
+        """An exception thrown if a username contains characters other than
+        letters, digits and underscores, which would end a tag of the user
+        early"""
+
+    def _get_legacy_hashed_password(self, password: str, salt: uuid.UUID) -> str:
+        """Returns the password hashed and salted with the legacy SHA-256
+        scheme"""
         return hashlib.sha256((password + str(salt)).encode()).hexdigest()
 
+    def _check_password(self, user: User, password: str) -> bool:
+        """Returns if `password` is the password of the given user. Passwords
+        stored with the legacy SHA-256 scheme are rehashed with the current
+        password hasher once they are verified"""
+        with METRICS.time("auth"):  # Hashing dominates authentication
+            if "$" in user.hashed_password:  # Encoded by `make_password`
+
+                def upgrade(new_password: str) -> None:
+                    user.hashed_password = make_password(new_password)
+                    user.save(update_fields=["hashed_password"])
+
+                return check_password(password, user.hashed_password, upgrade)
+            legacy_hash = self._get_legacy_hashed_password(password, user.password_salt)
+            if not hmac.compare_digest(legacy_hash, user.hashed_password):
+                return False
+            user.hashed_password = make_password(password)
+            user.save(update_fields=["hashed_password"])
+            return True
+
+    def _get_hashed_token(self, token: str) -> str:
+        """Returns the digest of a token that is stored in the database.
+        Tokens are random, so a fast hash is enough"""
+        return hashlib.sha256(token.encode()).hexdigest()
+
     def does_user_exist(self, username: str) -> bool:
         """Returns if a user exists with the given username"""
         return User.objects.filter(username=username).exists()
@@ -28,57 +91,682 @@ class _UserService:
 
     def create_user(self, username: str, password: str) -> None:
         """Creates a new user with the given username and password"""
+        if not _USERNAME_PATTERN.fullmatch(username):
+            raise _UserService.InvalidUsernameException()
         if self.does_user_exist(username):
             raise _UserService.UserAlreadyExistsException()
-        salt = uuid.uuid4()
-        hashed_password = self._get_hashed_password(password, salt)
         User.objects.create(
-            username=username, hashed_password=hashed_password, password_salt=salt
+            username=username,
+            hashed_password=make_password(password),
+            password_salt=uuid.uuid4(),
         )
 
+    def import_users(self, users: list[User]) -> int:
+        """Creates the given users of a snapshot of the board, skipping those
+        whose username is already taken. Returns the number of users
+        created"""
+        usernames = [user.username for user in users]
+        existing = set(
+            User.objects.filter(username__in=usernames).values_list(
+                "username", flat=True
+            )
+        )
+        created = User.objects.bulk_create(
+            [user for user in users if user.username not in existing]
+        )
+        return len(created)
+
     def check_user_login(self, username: str, password: str) -> bool:
         """Returns if a user exists with the given username and has
         the given password"""
-        if not self.does_user_exist(username):
-            return False
-        user = User.objects.get(username=username)
-        salt = user.password_salt
-        hashed_password = self._get_hashed_password(password, salt)
-        return hashed_password == user.hashed_password
+        return self.authenticate(username, password) is not None
+
+    def authenticate(self, username: str, password: str) -> Optional[User]:
+        """Returns the user with the given username if it has the given
+        password, otherwise `None`. Recently verified credentials are served
+        from the credential cache without hashing the password"""
+        user = User.objects.filter(username=username).first()
+        if user is None:
+            return None
+        if CREDENTIAL_CACHE.is_verified(user, password):
+            return user
+        if not self._check_password(user, password):
+            return None
+        CREDENTIAL_CACHE.put(user, password)
+        return user
+
+    async def aauthenticate(self, username: str, password: str) -> Optional[User]:
+        """Asynchronous version of `authenticate`. The password is checked in
+        a worker thread, so hashing does not block the event loop"""
+        user = await User.objects.filter(username=username).afirst()
+        if user is None:
+            return None
+        if CREDENTIAL_CACHE.is_verified(user, password):
+            return user
+        if not await sync_to_async(self._check_password)(user, password):
+            return None
+        CREDENTIAL_CACHE.put(user, password)
+        return user
+
+    def create_token(self, user: User) -> tuple[str, datetime]:
+        """Issues a new bearer token to the given user. Returns the token and
+        the time it expires at. Expired tokens of the user are removed"""
+        now = timezone.now()
+        Token.objects.filter(user=user, expires_at__lte=now).delete()
+        token = secrets.token_urlsafe(32)
+        expires_at = now + timedelta(seconds=settings.MESSAGING_TOKEN_TTL)
+        Token.objects.create(
+            user=user, hashed_token=self._get_hashed_token(token), expires_at=expires_at
+        )
+        return token, expires_at
+
+    def get_user_from_token(self, token: str) -> Optional[User]:
+        """Returns the user that the given unexpired token was issued to,
+        otherwise `None`"""
+        found = self._get_unexpired_tokens(token).first()
+        return found.user if found is not None else None
+
+    async def aget_user_from_token(self, token: str) -> Optional[User]:
+        """Asynchronous version of `get_user_from_token`"""
+        found = await self._get_unexpired_tokens(token).afirst()
+        return found.user if found is not None else None
+
+    def _get_unexpired_tokens(self, token: str) -> "QuerySet[Token]":
+        """Returns the unexpired tokens matching `token`, joined with their
+        user"""
+        return Token.objects.select_related("user").filter(
+            hashed_token=self._get_hashed_token(token),
+            expires_at__gt=timezone.now(),
+        )
 
 
 class _MessageService:
     """A service that operates on messages"""
 
-    def get_all_messages(self, limit: int, since: Optional[int]) -> list[Message]:
+    class MissingUserException(Exception):
+        """An exception thrown if a message is imported for a user that does
+        not exist"""
+
+    def get_all_messages(
+        self, limit: int, since: Optional[int], before: Optional[int] = None
+    ) -> list[EncodedMessage]:
         """Returns a list of all of the messages in the system, ordered
         by creation time. Returns only the most recent `limit` number of
         messages. If `since` is passed in, only returns messages with `id`
-        larger than `since`"""
-        if since:
-            objects = Message.objects.filter(id__gt=since)
-        else:
-            objects = Message.objects.all()
-        return list(objects)[-limit:]
+        larger than `since`. If `before` is passed in, only returns messages
+        with `id` smaller than `before`. Reads of recent messages are
+        answered from `MESSAGE_TAIL` without querying the database"""
+        self._check_tail()
+        messages = MESSAGE_TAIL.get_newest(limit, since, before)
+        if messages is not None:
+            METRICS.add_rows(len(messages))
+            return messages
+        epoch = MESSAGE_TAIL.epoch
+        objects = self._get_newest(Message.objects.all(), limit, since, before)
+        messages = _oldest_first(serialize_messages(objects))
+        if not since and not before:
+            MESSAGE_TAIL.prime(messages, limit, epoch)
+        return messages
+
+    async def aget_all_messages(
+        self, limit: int, since: Optional[int], before: Optional[int] = None
+    ) -> list[EncodedMessage]:
+        """Asynchronous version of `get_all_messages`"""
+        await self._acheck_tail()
+        messages = MESSAGE_TAIL.get_newest(limit, since, before)
+        if messages is not None:
+            METRICS.add_rows(len(messages))
+            return messages
+        epoch = MESSAGE_TAIL.epoch
+        objects = self._get_newest(Message.objects.all(), limit, since, before)
+        messages = _oldest_first(await aserialize_messages(objects))
+        if not since and not before:
+            MESSAGE_TAIL.prime(messages, limit, epoch)
+        return messages
+
+    def get_version(self) -> str:
+        """Returns a value that changes whenever any process creates, changes
+        or removes messages. It is read from `MESSAGE_TAIL` when possible,
+        otherwise from the database"""
+        self._check_tail()
+        version = MESSAGE_TAIL.get_version()
+        if version is None:
+            epoch = MESSAGE_TAIL.epoch
+            changes, high_water_mark = self._get_board_state()
+            self._update_tail(changes, high_water_mark, epoch)
+            version = f"{changes}.{high_water_mark}"
+        return version
+
+    async def aget_version(self) -> str:
+        """Asynchronous version of `get_version`"""
+        await self._acheck_tail()
+        version = MESSAGE_TAIL.get_version()
+        if version is None:
+            epoch = MESSAGE_TAIL.epoch
+            changes, high_water_mark = await self._aget_board_state()
+            await self._aupdate_tail(changes, high_water_mark, epoch)
+            version = f"{changes}.{high_water_mark}"
+        return version
+
+    def get_messages_since(self, since: int, limit: int) -> list[EncodedMessage]:
+        """Returns the oldest `limit` messages with `id` larger than `since`,
+        ordered by creation time. Unlike `get_all_messages`, no messages are
+        skipped when more than `limit` messages were created since `since`"""
+        self._check_tail()
+        messages = MESSAGE_TAIL.get_since(since, limit)
+        if messages is not None:
+            METRICS.add_rows(len(messages))
+            return messages
+        return serialize_messages(
+            Message.objects.filter(id__gt=since).order_by("id")[:limit]
+        )
+
+    async def aget_messages_since(self, since: int, limit: int) -> list[EncodedMessage]:
+        """Asynchronous version of `get_messages_since`"""
+        await self._acheck_tail()
+        messages = MESSAGE_TAIL.get_since(since, limit)
+        if messages is not None:
+            METRICS.add_rows(len(messages))
+            return messages
+        return await aserialize_messages(
+            Message.objects.filter(id__gt=since).order_by("id")[:limit]
+        )
+
+    async def await_message(self, since: int, timeout: float) -> bool:
+        """Waits until a message with `id` larger than `since` is created or
+        `timeout` seconds pass. Messages created by this process wake the
+        waiter at once, and those of other processes are noticed by checking
+        `MESSAGE_TAIL` every `MESSAGING_TAIL_CHECK_INTERVAL` seconds. Returns
+        `False` if the timeout passed first"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            interval = max(settings.MESSAGING_TAIL_CHECK_INTERVAL, 0.1)
+            if await BROADCASTER.wait(since, min(remaining, interval)):
+                return True
+            await self._acheck_tail()
+            high_water_mark = MESSAGE_TAIL.get_high_water_mark()
+            if high_water_mark is not None and high_water_mark > since:
+                return True
+
+    def get_user_messages(
+        self,
+        user: User,
+        limit: int,
+        since: Optional[int],
+        before: Optional[int] = None,
+    ) -> list[EncodedMessage]:
+        """Returns a list of messages sent by the given user, ordered by
+        creation time. `limit`, `since` and `before` behave the same as in
+        `get_all_messages`"""
+        objects = self._get_newest(
+            Message.objects.filter(user=user), limit, since, before
+        )
+        return _oldest_first(serialize_messages(objects))
+
+    async def aget_user_messages(
+        self,
+        user: User,
+        limit: int,
+        since: Optional[int],
+        before: Optional[int] = None,
+    ) -> list[EncodedMessage]:
+        """Asynchronous version of `get_user_messages`"""
+        objects = self._get_newest(
+            Message.objects.filter(user=user), limit, since, before
+        )
+        return _oldest_first(await aserialize_messages(objects))
 
-    def get_user_messages(self, user: User) -> list[Message]:
-        """Returns a list of messages sent by the given user, ordered
-        by creation time"""
-        return list(Message.objects.filter(user=user))
+    def get_user_message_count(self, user: User) -> int:
+        """Returns the number of messages sent by the given user"""
+        return User.objects.values_list("message_count", flat=True).get(pk=user.pk)
+
+    async def aget_user_message_count(self, user: User) -> int:
+        """Asynchronous version of `get_user_message_count`"""
+        return await User.objects.values_list("message_count", flat=True).aget(
+            pk=user.pk
+        )
 
-    def get_tagged_messages(self, user: User) -> list[Message]:
+    def get_tagged_messages(
+        self,
+        user: User,
+        limit: int,
+        since: Optional[int],
+        before: Optional[int] = None,
+    ) -> list[EncodedMessage]:
         """Returns a list of messages that tagged the given user's username,
-        ordered by creation time"""
-        tagged_string = f"@{user.username}"
-        return list(Message.objects.filter(message__icontains=tagged_string))
+        ordered by creation time. `limit`, `since` and `before` behave the
+        same as in `get_all_messages`"""
+        objects = Message.objects.filter(mention__user=user)
+        # Ordering by the mention walks the mention index, without sorting
+        objects = self._get_newest(objects, limit, since, before, _MENTION_KEY)
+        return _oldest_first(serialize_messages(objects))
+
+    async def aget_tagged_messages(
+        self,
+        user: User,
+        limit: int,
+        since: Optional[int],
+        before: Optional[int] = None,
+    ) -> list[EncodedMessage]:
+        """Asynchronous version of `get_tagged_messages`"""
+        objects = Message.objects.filter(mention__user=user)
+        # Ordering by the mention walks the mention index, without sorting
+        objects = self._get_newest(objects, limit, since, before, _MENTION_KEY)
+        return _oldest_first(await aserialize_messages(objects))
+
+    async def astream_all_messages(
+        self, limit: int, since: Optional[int], before: Optional[int]
+    ) -> MessageStream:
+        """Streaming version of `aget_all_messages`, for pages too large to
+        hold in memory"""
+        return await self._astream_newest(Message.objects.all(), limit, since, before)
+
+    async def astream_user_messages(
+        self, user: User, limit: int, since: Optional[int], before: Optional[int]
+    ) -> MessageStream:
+        """Streaming version of `aget_user_messages`"""
+        objects = Message.objects.filter(user=user)
+        return await self._astream_newest(objects, limit, since, before)
+
+    async def astream_tagged_messages(
+        self, user: User, limit: int, since: Optional[int], before: Optional[int]
+    ) -> MessageStream:
+        """Streaming version of `aget_tagged_messages`"""
+        objects = Message.objects.filter(mention__user=user)
+        return await self._astream_newest(objects, limit, since, before, _MENTION_KEY)
+
+    def search_messages(
+        self, query: str, limit: int, offset: int
+    ) -> list[EncodedMessage]:
+        """Returns the messages that contain every word of the query, best
+        match first, skipping the first `offset` matches"""
+        ids = get_search_backend().search(query, limit, offset)
+        found = {
+            message.id: message
+            for message in serialize_messages(Message.objects.filter(id__in=ids))
+        }
+        return [found[message_id] for message_id in ids if message_id in found]
 
-    def create_message(self, user: User, message: str) -> None:
-        """Creates a new message on the message board from the given user"""
-        Message.objects.create(user=user, message=message)
+    def create_message(self, user: User, message: str) -> int:
+        """Creates a new message on the message board from the given user.
+        Returns the id of the message"""
+        return self.create_messages(user, [message])[0]
+
+    def create_messages(self, user: User, messages: list[str]) -> list[int]:
+        """Creates new messages on the message board from the given user in a
+        single transaction. Returns the ids of the messages, in order"""
+        return self.create_messages_in_bulk([(user, message) for message in messages])
+
+    def create_messages_in_bulk(self, messages: list[tuple[User, str]]) -> list[int]:
+        """Creates new messages on the message board, each from its own user,
+        in a single transaction. Returns the ids of the messages, in order"""
+        with transaction.atomic():
+            created = Message.objects.bulk_create(
+                [Message(user=user, message=message) for user, message in messages]
+            )
+            self._create_mentions(created)
+            self._count_messages(created)
+            get_search_backend().index(created)
+            # The ids are only known once the messages are inserted
+            encoded = [
+                EncodedMessage(message.id, message.encode()) for message in created
+            ]
+            for message, (_, content) in zip(created, encoded):
+                message.encoded = content
+            Message.objects.bulk_update(created, ["encoded"])
+            transaction.on_commit(lambda: BROADCASTER.publish_all(encoded))
+        return [message.id for message in created]
+
+    def import_messages(self, messages: list[tuple[int, str, str, datetime]]) -> int:
+        """Creates the given messages of a snapshot of the board, each as its
+        id, the username of its user, its text and its creation time, in a
+        single transaction. Messages whose id already exists are skipped, so
+        a snapshot can be imported again. Returns the number of messages
+        created. Raises `MissingUserException` if a user does not exist"""
+        with transaction.atomic():
+            ids = [message_id for message_id, _, _, _ in messages]
+            existing = set(
+                Message.objects.filter(id__in=ids).values_list("id", flat=True)
+            )
+            users = User.objects.in_bulk(
+                {username for _, username, _, _ in messages}, field_name="username"
+            )
+            created: list[Message] = []
+            for message_id, username, message, created_at in messages:
+                if message_id in existing:
+                    continue
+                if username not in users:
+                    raise _MessageService.MissingUserException(username)
+                created.append(
+                    Message(
+                        id=message_id,
+                        user=users[username],
+                        message=message,
+                        created_at=created_at,
+                    )
+                )
+            # The ids are known before the insert, so the messages are encoded
+            # without updating them afterwards
+            for created_message in created:
+                created_message.encoded = created_message.encode()
+            Message.objects.bulk_create(created)
+            self._create_mentions(created)
+            self._count_messages(created)
+            get_search_backend().index(created)
+            if created:
+                MESSAGE_TAIL.invalidate()  # Tails miss the new ones
+        return len(created)
+
+    async def acreate_message(self, user: User, message: str) -> int:
+        """Asynchronous version of `create_message`. The async ORM does not
+        support transactions, so the message is created in a worker thread"""
+        return await sync_to_async(self.create_message)(user, message)
+
+    async def acreate_messages(self, user: User, messages: list[str]) -> list[int]:
+        """Asynchronous version of `create_messages`"""
+        return await sync_to_async(self.create_messages)(user, messages)
+
+    def create_missing_mentions(self, batch_size: int = 1000) -> int:
+        """Parses the tags of every message in the system and creates the
+        mentions that do not exist yet. Returns the number of messages
+        processed"""
+        processed = 0
+        last_id = 0
+        while True:
+            batch = list(
+                Message.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .only("id", "message")[:batch_size]
+            )
+            if not batch:
+                return processed
+            with transaction.atomic():
+                self._create_mentions(batch)
+            processed += len(batch)
+            last_id = batch[-1].id
 
     def remove_all_messages(self) -> None:
         """Removes all messages in the system"""
-        Message.objects.all().delete()
+        self.purge_messages(Message.objects.all(), settings.MESSAGING_PURGE_BATCH_SIZE)
+        transaction.on_commit(BROADCASTER.reset)
+
+    def purge_messages(self, objects: "QuerySet[Message]", batch_size: int) -> int:
+        """Removes the given messages, oldest first, in transactions of at
+        most `batch_size` messages each, so that the database is never locked
+        for long and only one batch is held in memory. Returns the number of
+        messages removed"""
+        removed = 0
+        last_id = 0
+        while True:
+            batch = objects.filter(id__gt=last_id)
+            ids = batch.order_by("id").values_list("id", flat=True)
+            # The id that ends the batch, if there are more messages after it
+            end = list(ids[batch_size - 1 : batch_size])
+            if end:
+                batch = batch.filter(id__lte=end[0])
+            with transaction.atomic():
+                # Subtract the messages of every user in the batch in one query
+                counts = (
+                    batch.filter(user=OuterRef("pk"))
+                    .order_by()
+                    .values("user")
+                    .annotate(count=Count("id"))
+                    .values("count")
+                )
+                User.objects.filter(pk__in=batch.values("user")).update(
+                    message_count=F("message_count") - Subquery(counts)
+                )
+                # The receivers of deleted messages are skipped, so only their
+                # ids are read
+                token = _purging.set(True)
+                try:
+                    _, deleted = batch.only("id").delete()
+                finally:
+                    _purging.reset(token)
+                count = deleted.get(Message._meta.label, 0)
+                if count:
+                    MESSAGE_TAIL.invalidate()  # Tails may hold removed ones
+            removed += count
+            if not end:
+                break
+            last_id = end[0]
+        return removed
+
+    def enforce_retention(
+        self,
+        max_messages: Optional[int],
+        max_age: Optional[float],
+        batch_size: int,
+    ) -> int:
+        """Removes every message that is not among the newest `max_messages`
+        messages or is older than `max_age` seconds. Either limit may be
+        `None` to disable it. Returns the number of messages removed"""
+        expired = Q(pk__in=[])  # Matches nothing until a limit is added
+        if max_messages is not None and max_messages <= 0:
+            expired |= Q(id__gt=0)
+        elif max_messages is not None:
+            newest = Message.objects.order_by("-id").values_list("id", flat=True)
+            oldest_kept = list(newest[max_messages - 1 : max_messages])
+            if oldest_kept:
+                expired |= Q(id__lt=oldest_kept[0])
+        if max_age is not None:
+            expired |= Q(created_at__lt=timezone.now() - timedelta(seconds=max_age))
+        return self.purge_messages(Message.objects.filter(expired), batch_size)
+
+    def _get_newest(
+        self,
+        objects: "QuerySet[Message]",
+        limit: int,
+        since: Optional[int],
+        before: Optional[int],
+        key: str = "id",
+    ) -> "QuerySet[Message]":
+        """Returns the most recent `limit` messages of `objects` with `id`
+        between `since` and `before`, newest first. The messages are ordered
+        by `key`, a column equal to their `id` that the index walked by the
+        query ends with"""
+        if since:
+            objects = objects.filter(id__gt=since)
+        if before:
+            objects = objects.filter(id__lt=before)
+        # Walk the index backwards so only `limit` rows are read
+        return objects.order_by(f"-{key}")[:limit]
+
+    def _check_tail(self) -> None:
+        """Checks `MESSAGE_TAIL` against the database if it is due, so that it
+        forgets messages that other processes removed or changed and adds
+        the messages they created"""
+        if MESSAGE_TAIL.claim_check():
+            epoch = MESSAGE_TAIL.epoch
+            self._update_tail(*self._get_board_state(), epoch)
+
+    async def _acheck_tail(self) -> None:
+        """Asynchronous version of `_check_tail`"""
+        if MESSAGE_TAIL.claim_check():
+            epoch = MESSAGE_TAIL.epoch
+            await self._aupdate_tail(*await self._aget_board_state(), epoch)
+
+    def _get_board_state(self) -> tuple[int, int]:
+        """Returns the change counter of `BoardState` and the largest `id` of
+        any message, read with one query"""
+        state = self._get_board_state_query().first()
+        if state is None:  # The row was removed, such as by flushing the database
+            return 0, Message.objects.aggregate(Max("id"))["id__max"] or 0
+        return state[0], state[1] or 0
+
+    async def _aget_board_state(self) -> tuple[int, int]:
+        """Asynchronous version of `_get_board_state`"""
+        state = await self._get_board_state_query().afirst()
+        if state is None:
+            aggregate = await Message.objects.aaggregate(Max("id"))
+            return 0, aggregate["id__max"] or 0
+        return state[0], state[1] or 0
+
+    def _get_board_state_query(
+        self,
+    ) -> "QuerySet[BoardState, tuple[int, Optional[int]]]":
+        """Returns a query for the change counter of `BoardState` and the
+        largest `id` of any message"""
+        newest = Message.objects.order_by("-id").values("id")[:1]
+        return BoardState.objects.filter(pk=1).values_list("changes", Subquery(newest))
+
+    def _update_tail(self, changes: int, high_water_mark: int, epoch: int) -> None:
+        """Passes the board state read from the database by a read that
+        started at the given `epoch` to `MESSAGE_TAIL`, and reads the
+        messages it is missing"""
+        since = MESSAGE_TAIL.check(changes, high_water_mark, epoch)
+        if since is None:
+            return
+        epoch = MESSAGE_TAIL.epoch  # The check may have emptied the buffer
+        objects = self._get_newest(
+            Message.objects.all(), MESSAGE_TAIL.max_size, since, None
+        )
+        MESSAGE_TAIL.extend(since, _oldest_first(serialize_messages(objects)), epoch)
+
+    async def _aupdate_tail(
+        self, changes: int, high_water_mark: int, epoch: int
+    ) -> None:
+        """Asynchronous version of `_update_tail`"""
+        since = MESSAGE_TAIL.check(changes, high_water_mark, epoch)
+        if since is None:
+            return
+        epoch = MESSAGE_TAIL.epoch  # The check may have emptied the buffer
+        objects = self._get_newest(
+            Message.objects.all(), MESSAGE_TAIL.max_size, since, None
+        )
+        newer = _oldest_first(await aserialize_messages(objects))
+        MESSAGE_TAIL.extend(since, newer, epoch)
+
+    async def _astream_newest(
+        self,
+        objects: "QuerySet[Message]",
+        limit: int,
+        since: Optional[int],
+        before: Optional[int],
+        key: str = "id",
+    ) -> MessageStream:
+        """Returns the stream of the most recent `limit` messages of `objects`
+        with `id` between `since` and `before`, oldest first. The ids bounding
+        the page are found first, so the page can be read in ascending order
+        in chunks instead of being reversed in memory"""
+        newest = self._get_newest(objects, limit, since, before, key)
+        bounds = await newest.aaggregate(Min("id"), Max("id"), Count("id"))
+        if not bounds["id__count"]:
+            return MessageStream(aiter_messages(objects.none(), 1), None)
+        page = objects.filter(id__gte=bounds["id__min"], id__lte=bounds["id__max"])
+        next_cursor = bounds["id__min"] if bounds["id__count"] == limit else None
+        chunk_size = settings.MESSAGING_STREAM_CHUNK_SIZE
+        return MessageStream(aiter_messages(page, chunk_size, key), next_cursor)
+
+    def _count_messages(self, messages: list[Message]) -> None:
+        """Adds newly created messages to the message counts of their users"""
+        for user_id, count in Counter(message.user_id for message in messages).items():
+            User.objects.filter(pk=user_id).update(
+                message_count=F("message_count") + count
+            )
+
+    def _create_mentions(self, messages: list[Message]) -> None:
+        """Creates a mention for every user tagged in the given messages"""
+        tagged = {message.id: _parse_tags(message.message) for message in messages}
+        usernames = set().union(*tagged.values())
+        if not usernames:
+            return
+        user_ids = dict(
+            User.objects.filter(username__in=usernames).values_list("username", "id")
+        )
+        Mention.objects.bulk_create(
+            [
+                Mention(message_id=message_id, user_id=user_ids[username])
+                for message_id, names in tagged.items()
+                for username in names
+                if username in user_ids
+            ],
+            ignore_conflicts=True,
+        )
+
+
+_purging: ContextVar[bool] = ContextVar("purging", default=False)
+"""Whether messages are being deleted by `purge_messages`, which updates the
+message counts and the message tails for the whole batch instead of for
+each message"""
+_USERNAME_PATTERN = re.compile(r"\w{1,100}")
+"""The pattern of a valid username. A tag ends at the first character that
+cannot be part of a username, so `@jake.` tags `jake`"""
+_TAG_PATTERN = re.compile(r"@(\w+)")
+"""The pattern of a tag in a message, the `@` symbol followed by a username"""
+_MENTION_KEY = "mention__message_id"
+"""The column that orders tagged messages. It equals their `id`, but unlike
+`id` it is the last column of the mention index that the query walks"""
+
+
+def _oldest_first(newest_first: list[EncodedMessage]) -> list[EncodedMessage]:
+    """Reverses a list of messages that is ordered newest first in place and
+    returns it"""
+    newest_first.reverse()
+    return newest_first
+
+
+def _parse_tags(message: str) -> set[str]:
+    """Returns the usernames tagged in the given message"""
+    return set(_TAG_PATTERN.findall(message))
+
+
+@receiver(post_save, sender=Message)
+def _count_created_message(
+    instance: Message, created: bool, raw: bool, **kwargs: Any
+) -> None:
+    """Adds a message created on its own, such as through the admin site, to
+    the message count of its user. Messages created by the services are
+    counted in bulk instead, which sends no signals"""
+    if created and not raw:
+        User.objects.filter(pk=instance.user_id).update(
+            message_count=F("message_count") + 1
+        )
+
+
+@receiver(pre_save, sender=Message)
+def _count_moved_message(
+    instance: Message, raw: bool, update_fields: Optional[frozenset[str]], **kwargs: Any
+) -> None:
+    """Moves a saved message from the message count of its previous user to
+    that of its new user when it changes user, such as through the admin
+    site"""
+    if instance.pk is None or raw:
+        return
+    if update_fields is not None and "user" not in update_fields:
+        return
+    previous = (
+        Message.objects.filter(pk=instance.pk).values_list("user_id", flat=True).first()
+    )
+    if previous is None or previous == instance.user_id:
+        return
+    User.objects.filter(pk=previous).update(message_count=F("message_count") - 1)
+    User.objects.filter(pk=instance.user_id).update(
+        message_count=F("message_count") + 1
+    )
+
+
+@receiver(pre_delete, sender=Message)
+def _uncount_deleted_message(instance: Message, **kwargs: Any) -> None:
+    """Subtracts a message deleted outside of `purge_messages` from the
+    message count of its user, while the message can still be read.
+    `purge_messages` subtracts every message of a batch at once instead"""
+    if not _purging.get():
+        User.objects.filter(pk=instance.user_id).update(
+            message_count=F("message_count") - 1
+        )
+
+
+@receiver(post_delete, sender=Message)
+def _forget_deleted_message(**kwargs: Any) -> None:
+    """Empties the message tails when a message is deleted outside of
+    `purge_messages`, such as through the admin site, by deleting a queryset
+    or when its user is deleted"""
+    if not _purging.get():
+        MESSAGE_TAIL.invalidate()  # Tails may hold the deleted message
 
 
 USER_SERVICE = _UserService()
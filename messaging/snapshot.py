@@ -0,0 +1,194 @@
+"""Export and import of the whole board as newline-delimited JSON, used to
+back up, migrate or seed a board without going through the API
+
+A snapshot has one JSON object per line: every user, then every message in
+the order it was created. Users carry their password hash, so they can log
+in to the board the snapshot is imported into, and messages keep their id,
+so cursors held by clients stay valid. Tokens are not exported, and
+mentions and the search index are rebuilt on import:
+
+    {"type": "user", "username": str, "hashed_password": str,
+     "password_salt": str}
+    {"type": "message", "id": int, "username": str, "message": str,
+     "created_at": str}"""
+
+from datetime import datetime
+import json
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Union,
+)
+import uuid
+
+from django.db import transaction
+from django.db.models import QuerySet
+
+from .models import Message, User
+from .services import MESSAGE_SERVICE, USER_SERVICE
+
+_USER_FIELDS = ("id", "username", "hashed_password", "password_salt")
+"""The fields of a user that are exported, starting with the key that the
+users are read in order of"""
+_MESSAGE_FIELDS = ("id", "user__username", "message", "created_at")
+"""The fields of a message that are exported, starting with the key that
+the messages are read in order of"""
+
+_ImportedMessage = tuple[int, str, str, datetime]
+"""A message of a snapshot, as its id, the username of its user, its text
+and its creation time"""
+
+
+class ImportReport(NamedTuple):
+    """The outcome of importing a snapshot"""
+
+    users: int
+    """The number of users created"""
+    messages: int
+    """The number of messages created"""
+    lines: int
+    """The number of lines of the snapshot that were processed"""
+
+
+def _encode_user(row: tuple[Any, ...]) -> bytes:
+    """Returns the line of a user of the snapshot"""
+    _, username, hashed_password, password_salt = row
+    user = {
+        "type": "user",
+        "username": username,
+        "hashed_password": hashed_password,
+        "password_salt": str(password_salt),
+    }
+    return json.dumps(user).encode() + b"\n"
+
+
+def _encode_message(row: tuple[Any, ...]) -> bytes:
+    """Returns the line of a message of the snapshot"""
+    message_id, username, message, created_at = row
+    message_json = {
+        "type": "message",
+        "id": message_id,
+        "username": username,
+        "message": message,
+        "created_at": created_at.isoformat(),
+    }
+    return json.dumps(message_json).encode() + b"\n"
+
+
+def _get_sections() -> list[tuple["QuerySet[Any]", Callable[[Any], bytes]]]:
+    """Returns the rows of every section of a snapshot, in order, with the
+    function that encodes them"""
+    return [
+        (User.objects.order_by("id").values_list(*_USER_FIELDS), _encode_user),
+        (
+            Message.objects.order_by("id").values_list(*_MESSAGE_FIELDS),
+            _encode_message,
+        ),
+    ]
+
+
+def export_board(chunk_size: int) -> Iterator[bytes]:
+    """Yields the lines of a snapshot of the board, `chunk_size` lines at a
+    time. Each chunk is read with its own query that resumes after the last
+    row read, so only one chunk is held in memory"""
+    for rows, encode in _get_sections():
+        last_id = 0
+        while True:
+            chunk = list(rows.filter(id__gt=last_id)[:chunk_size])
+            if chunk:
+                yield b"".join(map(encode, chunk))
+            if len(chunk) < chunk_size:
+                break
+            last_id = chunk[-1][0]
+
+
+async def aexport_board(chunk_size: int) -> AsyncIterator[bytes]:
+    """Asynchronous version of `export_board`"""
+    for rows, encode in _get_sections():
+        last_id = 0
+        while True:
+            chunk = [row async for row in rows.filter(id__gt=last_id)[:chunk_size]]
+            if chunk:
+                yield b"".join(map(encode, chunk))
+            if len(chunk) < chunk_size:
+                break
+            last_id = chunk[-1][0]
+
+
+def import_board(
+    lines: Iterable[bytes],
+    batch_size: int,
+    skip: int = 0,
+    on_checkpoint: Callable[[ImportReport], None] = lambda report: None,
+) -> ImportReport:
+    """Imports a snapshot of the board. Users and messages are created in
+    transactions of at most `batch_size` rows each, and after every
+    transaction `on_checkpoint` is called with the progress so far. The
+    first `skip` lines are not imported, so an interrupted import resumes
+    from the `lines` of its last checkpoint. Users and messages that already
+    exist are skipped. Raises `ValueError` if a line is invalid"""
+    report = ImportReport(0, 0, skip)
+    users: list[User] = []
+    messages: list[_ImportedMessage] = []
+
+    def flush(processed: int) -> None:
+        nonlocal report
+        with transaction.atomic():
+            created_users = USER_SERVICE.import_users(users)
+            created_messages = MESSAGE_SERVICE.import_messages(messages)
+        report = ImportReport(
+            report.users + created_users,
+            report.messages + created_messages,
+            processed,
+        )
+        users.clear()
+        messages.clear()
+        on_checkpoint(report)
+
+    processed = skip
+    for number, line in enumerate(lines, start=1):
+        if number <= skip:
+            continue
+        if line.strip():
+            record = _parse_line(number, line)
+            if isinstance(record, User):
+                if messages:  # Messages may only refer to users already created
+                    flush(processed)
+                users.append(record)
+            else:
+                if users:
+                    flush(processed)
+                messages.append(record)
+        processed = number
+        if len(users) + len(messages) >= batch_size:
+            flush(processed)
+    if users or messages:
+        flush(processed)
+    return report._replace(lines=processed)
+
+
+def _parse_line(number: int, line: bytes) -> Union[User, _ImportedMessage]:
+    """Returns the user or the message of a line of a snapshot. Raises
+    `ValueError` if the line is invalid"""
+    try:
+        record = json.loads(line)
+        if record["type"] == "user":
+            return User(
+                username=record["username"],
+                hashed_password=record["hashed_password"],
+                password_salt=uuid.UUID(record["password_salt"]),
+            )
+        if record["type"] == "message":
+            return (
+                int(record["id"]),
+                record["username"],
+                record["message"],
+                datetime.fromisoformat(record["created_at"]),
+            )
+        raise ValueError(f"Unknown type {record['type']!r}")
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError(f"Invalid line {number}: {error}") from error
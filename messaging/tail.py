@@ -0,0 +1,315 @@
+"""An in-process ring buffer of the most recently created messages, which
+answers the reads of the newest messages without querying the database
+
+Every process keeps its own buffer and appends the messages it creates. The
+messages that other processes create, change or remove are learned by
+checking the buffer against the database at most every
+`MESSAGING_TAIL_CHECK_INTERVAL` seconds, so reads lag behind other processes
+by at most that long."""
+
+from collections import deque
+import sys
+import threading
+import time
+from typing import Optional, TypedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .models import BoardState, EncodedMessage
+
+
+class MessageTailStats(TypedDict):
+    """The counters of a message tail"""
+
+    hits: int
+    """The number of reads answered from the buffer"""
+    misses: int
+    """The number of reads that had to fall back to the database"""
+    hit_rate: float
+    """The fraction of reads answered from the buffer"""
+    size: int
+    """The number of messages in the buffer"""
+    bytes: int
+    """The approximate memory used by the messages in the buffer"""
+
+
+def _get_row_size(row: EncodedMessage) -> int:
+    """Returns the approximate memory used by a row and its values"""
+    return sum(map(sys.getsizeof, row)) + sys.getsizeof(row)
+
+
+class _MessageTail:
+    """Keeps the most recent messages, oldest first. Every message with `id`
+    larger than the floor of the buffer is in the buffer, so a read can be
+    answered from it whenever it does not reach below the floor. The floor
+    is unknown until a message is appended or the buffer is primed or
+    checked, and rises as old messages are evicted or when an appended
+    message does not follow the newest one, since another process may have
+    created the messages in between"""
+
+    def __init__(self, max_size: int) -> None:
+        self._rows: deque[EncodedMessage] = deque()
+        self._max_size = max_size
+        self._floor: Optional[int] = None
+        self._bytes = 0
+        self._changes = 0
+        self._checked_at: Optional[float] = None
+        self._shared_changes: Optional[int] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        """The number of reads answered from the buffer"""
+        self.misses = 0
+        """The number of reads that had to fall back to the database"""
+
+    @property
+    def max_size(self) -> int:
+        """The largest number of messages kept in the buffer"""
+        return self._max_size
+
+    def append(self, message: EncodedMessage) -> None:
+        """Adds a newly created message to the head of the buffer"""
+        with self._lock:
+            self._append(message)
+
+    def prime(self, newest: list[EncodedMessage], limit: int, epoch: int) -> None:
+        """Fills the buffer with the result of a database read of the newest
+        `limit` messages, ordered by creation time, that started at the given
+        `epoch`. The buffer is left alone if it was emptied since, or holds
+        newer messages or at least as many"""
+        if limit <= 0:
+            return
+        head = newest[-1].id if newest else 0
+        kept = newest[-self._max_size :]
+        with self._lock:
+            known = self._get_high_water_mark()
+            if self.epoch != epoch or (
+                known is not None
+                and (head < known or (head == known and len(self._rows) >= len(kept)))
+            ):
+                return
+            self._rows.clear()
+            self._bytes = 0
+            if len(kept) < len(newest):
+                self._floor = newest[-len(kept) - 1].id
+            elif len(newest) >= limit:
+                self._floor = newest[0].id - 1
+            else:  # If fewer than `limit` messages exist, they are all of them
+                self._floor = 0
+            for message in kept:
+                self._push(message)
+
+    def claim_check(self) -> bool:
+        """Returns if the buffer must be checked against the database with
+        `check`, because it never was or was last checked more than
+        `MESSAGING_TAIL_CHECK_INTERVAL` seconds ago. Only one caller is told
+        to check at a time"""
+        now = time.monotonic()
+        with self._lock:
+            if (
+                self._checked_at is not None
+                and now - self._checked_at < settings.MESSAGING_TAIL_CHECK_INTERVAL
+            ):
+                return False
+            self._checked_at = now
+            return True
+
+    def check(
+        self, shared_changes: int, high_water_mark: int, epoch: int
+    ) -> Optional[int]:
+        """Compares the buffer with the change counter of `BoardState` and the
+        largest `id` of any message, both read from the database by a read
+        that started at the given `epoch`. Empties the buffer if messages
+        were removed or changed since the last check. Returns the `id` after
+        which messages created by other processes are missing from the
+        buffer, to be added with `extend`, or `None` if no message is
+        missing"""
+        with self._lock:
+            if self.epoch != epoch:
+                return None  # The buffer was emptied while the state was read
+            if self._shared_changes not in (None, shared_changes):
+                self._empty(floor=None)
+            self._shared_changes = shared_changes
+            known = self._get_high_water_mark()
+            if known is None:  # No message is newer than the one just read
+                self._floor = high_water_mark
+                return None
+            return known if high_water_mark > known else None
+
+    def extend(self, since: int, newer: list[EncodedMessage], epoch: int) -> None:
+        """Adds the newest messages with `id` larger than `since`, ordered by
+        creation time, read from the database after `check` returned `since`
+        at the given `epoch`. At most `max_size` messages are read, so if
+        that many were read, older ones may be missing"""
+        with self._lock:
+            if self.epoch != epoch or self._get_high_water_mark() != since:
+                return  # The buffer changed while the messages were read
+            if len(newer) >= self._max_size:
+                self._rows.clear()
+                self._bytes = 0
+                self._floor = newer[0].id - 1
+            for message in newer:
+                self._push(message)
+
+    def invalidate(self) -> None:
+        """Records that messages were removed or changed, or created without
+        being appended, by the current transaction. The buffer of every
+        other process is emptied at its next check, and the buffer of this
+        process once the transaction commits. It is only recorded once per
+        atomic block, so deleting many messages costs one query"""
+        connection = transaction.get_connection()
+        savepoints = set(connection.savepoint_ids)
+        if connection.in_atomic_block and any(
+            sids == savepoints and func == self._forget
+            for sids, func, _ in connection.run_on_commit
+        ):
+            return
+        changed = BoardState.objects.filter(pk=1).update(changes=F("changes") + 1)
+        if not changed:  # The row was removed, such as by flushing the database
+            BoardState.objects.create(pk=1, changes=1)
+        transaction.on_commit(self._forget)
+
+    def clear(self) -> None:
+        """Empties the buffer after every message has been removed"""
+        with self._lock:
+            self._empty(floor=0)
+
+    def _forget(self) -> None:
+        """Empties the buffer and forgets the change counter of `BoardState`
+        after the current process changed it, so that the version is read
+        from the database again"""
+        with self._lock:
+            self._empty(floor=None)
+            self._shared_changes = None
+
+    def reset(self) -> None:
+        """Empties the buffer after messages were created or removed without
+        going through `append`, so that reads fall back to the database until
+        the buffer is primed again"""
+        with self._lock:
+            self._empty(floor=None)
+
+    def get_newest(
+        self, limit: int, since: Optional[int], before: Optional[int]
+    ) -> Optional[list[EncodedMessage]]:
+        """Returns the most recent `limit` messages with `id` between `since`
+        and `before`, ordered by creation time, or `None` if the buffer does
+        not hold all of them"""
+        with self._lock:
+            newest: list[EncodedMessage] = []
+            if limit > 0:
+                for row in reversed(self._rows):
+                    if before and row.id >= before:
+                        continue
+                    if since and row.id <= since:
+                        break
+                    newest.append(row)
+                    if len(newest) == limit:
+                        break
+            complete = len(newest) == limit or (
+                self._floor is not None and (since or 0) >= self._floor
+            )
+            self._count(complete)
+        if not complete:
+            return None
+        newest.reverse()
+        return newest
+
+    def get_since(self, since: int, limit: int) -> Optional[list[EncodedMessage]]:
+        """Returns the oldest `limit` messages with `id` larger than `since`,
+        or `None` if the buffer does not hold all of them"""
+        with self._lock:
+            complete = self._floor is not None and since >= self._floor
+            self._count(complete)
+            if not complete:
+                return None
+            return [row for row in self._rows if row.id > since][:limit]
+
+    @property
+    def epoch(self) -> int:
+        """A value that changes whenever the buffer is emptied, so that reads
+        of the database that started before can be told apart"""
+        return self._changes
+
+    def get_head(self) -> Optional[int]:
+        """Returns the `id` of the newest message in the buffer"""
+        with self._lock:
+            return self._rows[-1].id if self._rows else None
+
+    def get_version(self) -> Optional[str]:
+        """Returns a value that changes whenever any process creates, changes
+        or removes messages, made of the change counter of `BoardState` and
+        the largest `id` of any message, so that it is the same in every
+        process. Returns `None` if the buffer does not know them"""
+        with self._lock:
+            high_water_mark = self._get_high_water_mark()
+            if self._shared_changes is None or high_water_mark is None:
+                return None
+            return f"{self._shared_changes}.{high_water_mark}"
+
+    def get_high_water_mark(self) -> Optional[int]:
+        """Returns the largest `id` of any message, or `None` if the buffer
+        does not know it"""
+        with self._lock:
+            return self._get_high_water_mark()
+
+    def stats(self) -> MessageTailStats:
+        """Returns the hit and miss counters and the footprint of the buffer"""
+        with self._lock:
+            reads = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / reads if reads else 0.0,
+                "size": len(self._rows),
+                "bytes": self._bytes + sys.getsizeof(self._rows),
+            }
+
+    def _get_high_water_mark(self) -> Optional[int]:
+        """Returns the largest `id` known to the buffer. Must hold the lock"""
+        return self._rows[-1].id if self._rows else self._floor
+
+    def _append(self, message: EncodedMessage) -> None:
+        """Adds a message created by this process to the head of the buffer.
+        Must hold the lock"""
+        known = self._get_high_water_mark()
+        if known is not None and known >= message.id:
+            return  # Already read from the database by `prime` or `extend`
+        if known is None or message.id > known + 1:
+            # Messages in between may have been created by another process,
+            # so only the messages after this one are known to be complete
+            self._rows.clear()
+            self._bytes = 0
+            self._floor = message.id - 1
+        self._push(message)
+
+    def _push(self, message: EncodedMessage) -> None:
+        """Adds a message that is known to follow the newest one to the head
+        of the buffer, evicting the oldest if it is full. Must hold the
+        lock"""
+        self._rows.append(message)
+        self._bytes += _get_row_size(message)
+        while len(self._rows) > self._max_size:
+            evicted = self._rows.popleft()
+            self._bytes -= _get_row_size(evicted)
+            self._floor = evicted.id
+
+    def _empty(self, floor: Optional[int]) -> None:
+        """Removes every message from the buffer and sets its floor. Must
+        hold the lock"""
+        self._rows.clear()
+        self._bytes = 0
+        self._floor = floor
+        self._changes += 1
+
+    def _count(self, hit: bool) -> None:
+        """Counts a read as a hit or a miss. Must hold the lock"""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+
+MESSAGE_TAIL = _MessageTail(settings.MESSAGING_TAIL_SIZE)
+"""The single instance of the message tail"""
@@ -1 +1,1578 @@
 """Tests for the messaging app"""
+
+import asyncio
+from datetime import timedelta
+import gzip
+import hashlib
+from io import StringIO
+import json
+import math
+import os
+from pathlib import Path
+import random
+import re
+import tempfile
+from typing import Any, AsyncIterator, Awaitable, Callable, cast
+from unittest import mock
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from asgiref.sync import async_to_sync, sync_to_async
+from django.http import StreamingHttpResponse
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .auth import CREDENTIAL_CACHE
+from .docs import get_docs_page
+from .metrics import METRICS
+from .models import EncodedMessage, Mention, Message, Token, User
+from .ratelimit import RATE_LIMITER, _RateLimiter
+from .routers import READ_PINS, reset_primary, use_primary
+from .search import (
+    _FTS5SearchBackend,
+    _InvertedIndexSearchBackend,
+    get_search_backend,
+)
+from .services import USER_SERVICE, MESSAGE_SERVICE, MessageStream
+from .snapshot import ImportReport, export_board, import_board
+from .tail import MESSAGE_TAIL, _MessageTail
+from .urls import urlpatterns
+from .writer import MESSAGE_WRITER
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    MESSAGING_TAIL_CHECK_INTERVAL=math.inf,
+)
+class _MessagingTestCase(TestCase):
+    """A test case that hashes passwords with a fast hasher, so that creating
+    users does not dominate the run time of the tests. The message tail is
+    only checked against the database in `setUp`, so that queries can be
+    counted"""
+
+    def setUp(self) -> None:
+        MESSAGE_TAIL.reset()  # Forget messages of previous tests
+        MESSAGE_TAIL.claim_check()
+        MESSAGE_SERVICE.get_version()  # Checks the tail, as it never was
+        RATE_LIMITER.clear()
+
+    def _create_message(self, user: User, message: str) -> None:
+        """Creates a message and runs its commit hooks, which `TestCase`
+        would otherwise never run"""
+        with self.captureOnCommitCallbacks(execute=True):
+            MESSAGE_SERVICE.create_message(user, message)
+
+
+class MessageListQueryCountTests(_MessagingTestCase):
+    """Checks that the number of queries issued by the message list endpoints
+    does not grow with the number of messages returned"""
+
+    headers = {"Username": "Jacob", "Password": "testing123"}
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        USER_SERVICE.create_user("Other", "testing123")
+
+    def _create_messages(self, count: int) -> None:
+        """Creates `count` messages from each user, each tagging `Jacob`"""
+        for username in ("Jacob", "Other"):
+            user = USER_SERVICE.get_user(username)
+            for i in range(count):
+                self._create_message(user, f"@Jacob message {i}")
+
+    def _count_queries(self, path: str) -> int:
+        """Returns the number of queries issued by a GET to `path` with a
+        cold credential cache"""
+        CREDENTIAL_CACHE.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(path, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_query_count_is_constant(self) -> None:
+        """Every list endpoint issues the same number of queries for one
+        message as it does for many messages"""
+        paths = [
+            "/messaging/message?limit=1000",
+            "/messaging/message/me",
+            "/messaging/message/tagged",
+        ]
+        self._create_messages(1)
+        few = [self._count_queries(path) for path in paths]
+        self._create_messages(50)
+        many = [self._count_queries(path) for path in paths]
+        self.assertEqual(few, many)
+
+    def test_all_messages_is_single_query(self) -> None:
+        """The messages and their usernames are fetched in one query"""
+        self._create_messages(50)
+        MESSAGE_TAIL.reset()
+        with self.assertNumQueries(1):
+            messages = MESSAGE_SERVICE.get_all_messages(1000, None)
+        self.assertEqual(len(messages), 100)
+        self.assertEqual(json.loads(messages[0].json)["username"], "Jacob")
+        self.assertEqual(json.loads(messages[-1].json)["username"], "Other")
+
+
+class MessagePagingTests(_MessagingTestCase):
+    """Checks that the message list is paged back through with `before` and
+    `next_cursor`"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        user = USER_SERVICE.get_user("Jacob")
+        for i in range(10):
+            self._create_message(user, f"message {i}")
+
+    def test_pages_walk_back_through_every_message(self) -> None:
+        """Following `next_cursor` returns every message once, newest page
+        first, and each page read from the database costs the same number of
+        queries however far back it is"""
+        pages: list[list[str]] = []
+        path = "/messaging/message?limit=3"
+        while True:
+            MESSAGE_TAIL.reset()  # Read every page from the database
+            with self.assertNumQueries(2):  # The version, then the page
+                response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            body = response.json()
+            pages.append([message["message"] for message in body["messages"]])
+            if body["next_cursor"] is None:
+                break
+            path = f"/messaging/message?limit=3&before={body['next_cursor']}"
+        self.assertEqual([len(page) for page in pages], [3, 3, 3, 1])
+        texts = [text for page in reversed(pages) for text in page]
+        self.assertEqual(texts, [f"message {i}" for i in range(10)])
+
+    def test_invalid_cursor_is_rejected(self) -> None:
+        """A `before` cursor that is not an integer is a bad request"""
+        response = self.client.get("/messaging/message?before=abc")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Invalid `before` param"})
+
+
+class MentionTests(_MessagingTestCase):
+    """Checks that tags are stored as mentions and looked up by user"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jake", "testing123")
+        USER_SERVICE.create_user("Jakejack", "testing123")
+
+    def _get_tagged(self, username: str) -> list[str]:
+        """Returns the text of the messages that tagged `username`"""
+        response = self.client.get(
+            "/messaging/message/tagged",
+            headers={"Username": username, "Password": "testing123"},
+        )
+        return [message["message"] for message in response.json()["messages"]]
+
+    def test_tag_matches_whole_username(self) -> None:
+        """A tag of `@Jakejack` does not tag `Jake`, and vice versa"""
+        user = USER_SERVICE.get_user("Jake")
+        MESSAGE_SERVICE.create_message(user, "hi @Jakejack!")
+        MESSAGE_SERVICE.create_message(user, "hi @Jake, @Jake")
+        self.assertEqual(self._get_tagged("Jake"), ["hi @Jake, @Jake"])
+        self.assertEqual(self._get_tagged("Jakejack"), ["hi @Jakejack!"])
+
+    def test_usernames_cannot_break_tags(self) -> None:
+        """Usernames with characters that end a tag are rejected, so a tag
+        always names the whole username"""
+        for username in ("jake.s", "jake-s", "jake s", ""):
+            response = self.client.post(
+                "/messaging/user",
+                {"username": username, "password": "testing123"},
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 400, username)
+        user = USER_SERVICE.get_user("Jakejack")
+        MESSAGE_SERVICE.create_message(user, "hi @Jake.")
+        self.assertEqual(self._get_tagged("Jake"), ["hi @Jake."])
+
+    def test_backfill_creates_missing_mentions(self) -> None:
+        """Messages created without mentions are found after a backfill"""
+        user = USER_SERVICE.get_user("Jake")
+        Message.objects.create(user=user, message="old @Jakejack")
+        self.assertEqual(self._get_tagged("Jakejack"), [])
+        call_command("backfill_mentions", stdout=StringIO())
+        call_command("backfill_mentions", stdout=StringIO())
+        self.assertEqual(self._get_tagged("Jakejack"), ["old @Jakejack"])
+
+
+class CredentialCacheTests(_MessagingTestCase):
+    """Checks that verified credentials are cached and invalidated"""
+
+    headers = {"Username": "Jacob", "Password": "testing123"}
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+
+    def test_cached_credentials_skip_the_hash(self) -> None:
+        """A second request with the same credentials does not hash the
+        password again"""
+        self.client.get("/messaging/message/me", headers=self.headers)
+        hits = CREDENTIAL_CACHE.hits
+        with mock.patch("messaging.services.check_password") as check:
+            # The user, the messages and the message count
+            with self.assertNumQueries(3):
+                response = self.client.get(
+                    "/messaging/message/me", headers=self.headers
+                )
+        check.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(CREDENTIAL_CACHE.hits, hits + 1)
+
+    def test_changed_password_invalidates_cache(self) -> None:
+        """Credentials are no longer accepted once the password changes"""
+        self.client.get("/messaging/message/me", headers=self.headers)
+        user = User.objects.get(username="Jacob")
+        user.hashed_password = "changed"
+        user.save()
+        response = self.client.get("/messaging/message/me", headers=self.headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_password_changed_without_signal_invalidates_cache(self) -> None:
+        """Credentials are no longer accepted once the password changes in
+        the database, such as by another process, even though no signal
+        reached this process"""
+        self.client.get("/messaging/message/me", headers=self.headers)
+        User.objects.filter(username="Jacob").update(
+            hashed_password=make_password("changed123")
+        )
+        response = self.client.get("/messaging/message/me", headers=self.headers)
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get(
+            "/messaging/message/me",
+            headers={"Username": "Jacob", "Password": "changed123"},
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_wrong_password_is_rejected(self) -> None:
+        """A cached credential does not accept a different password"""
+        self.client.get("/messaging/message/me", headers=self.headers)
+        response = self.client.get(
+            "/messaging/message/me",
+            headers={"Username": "Jacob", "Password": "wrong"},
+        )
+        self.assertEqual(response.status_code, 401)
+
+
+class TokenTests(_MessagingTestCase):
+    """Checks that bearer tokens issued at login authenticate requests"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+
+    def _login(self, password: str) -> Any:
+        """Logs in as `Jacob` with the given password"""
+        return self.client.post(
+            "/messaging/login",
+            {"username": "Jacob", "password": password},
+            content_type="application/json",
+        )
+
+    def test_token_authenticates_requests(self) -> None:
+        """A token from a successful login is accepted by other endpoints"""
+        token = self._login("testing123").json()["token"]
+        response = self.client.get(
+            "/messaging/message/me", headers={"Authorization": f"Bearer {token}"}
+        )
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(1):
+            user = USER_SERVICE.get_user_from_token(token)
+        self.assertEqual(user, User.objects.get(username="Jacob"))
+
+    def test_wrong_password_is_rejected(self) -> None:
+        """A login with the wrong password does not issue a token"""
+        self.assertEqual(self._login("wrong").status_code, 401)
+
+    def test_expired_token_is_rejected(self) -> None:
+        """A token is not accepted after it expires"""
+        token = self._login("testing123").json()["token"]
+        Token.objects.update(expires_at=timezone.now())
+        response = self.client.get(
+            "/messaging/message/me", headers={"Authorization": f"Bearer {token}"}
+        )
+        self.assertEqual(response.status_code, 401)
+
+    def test_legacy_password_is_upgraded(self) -> None:
+        """A password stored with the legacy SHA-256 scheme is accepted and
+        rehashed with the current password hasher"""
+        user = User.objects.get(username="Jacob")
+        salt = uuid.uuid4()
+        legacy_hash = hashlib.sha256(("testing123" + str(salt)).encode()).hexdigest()
+        User.objects.filter(pk=user.pk).update(
+            hashed_password=legacy_hash, password_salt=salt
+        )
+        self.assertEqual(self._login("testing123").status_code, 201)
+        user.refresh_from_db()
+        self.assertNotEqual(user.hashed_password, legacy_hash)
+        self.assertEqual(self._login("testing123").status_code, 201)
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class BroadcastTests(TransactionTestCase):
+    """Checks that waiting clients receive new messages once they are
+    committed. Uses a `TransactionTestCase` so that commit hooks run"""
+
+    databases = {"default", "read"}
+
+    def setUp(self) -> None:
+        MESSAGE_TAIL.reset()  # Forget messages of previous tests
+        USER_SERVICE.create_user("Jacob", "testing123")
+        self.user = USER_SERVICE.get_user("Jacob")
+
+    async def _create_message_later(self, message: str) -> None:
+        """Creates a message after the waiting client has subscribed"""
+        await asyncio.sleep(0.1)
+        await sync_to_async(MESSAGE_SERVICE.create_message)(self.user, message)
+
+    async def test_poll_wakes_on_new_message(self) -> None:
+        """A long-poll returns as soon as a message is created"""
+        await sync_to_async(MESSAGE_SERVICE.create_message)(self.user, "old")
+        since = (await sync_to_async(MESSAGE_SERVICE.get_all_messages)(1, None))[0]
+        response, _ = await asyncio.gather(
+            self.async_client.get(f"/messaging/message/poll?since={since.id}&wait=5"),
+            self._create_message_later("new"),
+        )
+        messages = response.json()["messages"]
+        self.assertEqual([message["message"] for message in messages], ["new"])
+
+    async def test_poll_times_out(self) -> None:
+        """A long-poll with no new messages returns an empty list"""
+        response = await self.async_client.get(
+            "/messaging/message/poll?since=1000&wait=0.1"
+        )
+        self.assertEqual(response.json()["messages"], [])
+
+    async def test_stream_sends_new_messages(self) -> None:
+        """The event stream sends the backlog and then new messages"""
+        await sync_to_async(MESSAGE_SERVICE.create_message)(self.user, "old")
+        response = await self.async_client.get("/messaging/message/stream")
+        content = cast(StreamingHttpResponse, response).streaming_content
+        events = cast(AsyncIterator[bytes], content)
+        self.assertIn(b'"message": "old"', await anext(events))
+        _, event = await asyncio.gather(
+            self._create_message_later("new"), anext(events)
+        )
+        self.assertIn(b'"message": "new"', event)
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class ReadWriteRoutingTests(TransactionTestCase):
+    """Checks that reads go to the read database unless the client must see
+    its own writes. Uses a `TransactionTestCase` so that reads run outside
+    of a transaction"""
+
+    databases = {"default", "read"}
+    headers = {"Username": "Jacob", "Password": "testing123"}
+
+    def setUp(self) -> None:
+        MESSAGE_TAIL.reset()  # Forget messages of previous tests
+        RATE_LIMITER.clear()
+        READ_PINS.clear()
+        USER_SERVICE.create_user("Jacob", "testing123")
+
+    def _count_queries(self, function: Callable[[], Any]) -> tuple[int, int]:
+        """Calls the function. Returns the number of queries it sent to the
+        primary and to the read database"""
+        with CaptureQueriesContext(connections["default"]) as primary:
+            with CaptureQueriesContext(connections["read"]) as replica:
+                function()
+        return len(primary), len(replica)
+
+    def _get_my_messages(self, address: str = "127.0.0.1") -> None:
+        """Gets the messages of the user from the given address"""
+        response = self.client.get(
+            "/messaging/message/me", headers=self.headers, REMOTE_ADDR=address
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def _search(self, query: str, address: str) -> None:
+        """Searches the messages anonymously from the given address"""
+        response = self.client.get(
+            "/messaging/message/search", {"q": query}, REMOTE_ADDR=address
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_reads_go_to_read_database(self) -> None:
+        """Reads use the read database, except in a transaction or when the
+        context is sent to the primary"""
+        get_user = lambda: USER_SERVICE.get_user("Jacob")
+        self.assertEqual(self._count_queries(get_user), (0, 1))
+        with transaction.atomic():
+            self.assertEqual(self._count_queries(get_user), (1, 0))
+        token = use_primary(True)
+        try:
+            self.assertEqual(self._count_queries(get_user), (1, 0))
+        finally:
+            reset_primary(token)
+
+    def test_writer_reads_own_writes(self) -> None:
+        """After a successful write, the reads of its client go to the
+        primary, while other clients keep using the read database"""
+        self.assertEqual(self._count_queries(self._get_my_messages)[0], 0)
+        response = self.client.post(
+            "/messaging/message/create",
+            {"message": "hello"},
+            content_type="application/json",
+            headers=self.headers,
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self._count_queries(self._get_my_messages)[1], 0)
+        other_address = lambda: self._get_my_messages("10.0.0.1")
+        self.assertEqual(self._count_queries(other_address)[1], 0)  # Same user
+        other_client = lambda: self._search("hello", "10.0.0.2")
+        self.assertEqual(self._count_queries(other_client), (0, 2))
+
+    def test_failed_write_does_not_pin(self) -> None:
+        """A write that fails leaves its client on the read database"""
+        response = self.client.post(
+            "/messaging/message/create",
+            {"message": "hello"},
+            content_type="application/json",
+            headers={**self.headers, "Password": "wrong"},
+        )
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self._count_queries(self._get_my_messages)[0], 0)
+
+
+class MessageTailTests(_MessagingTestCase):
+    """Checks that reads of recent messages are answered from memory"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        self.user = USER_SERVICE.get_user("Jacob")
+
+    def _get_ids(self, path: str) -> list[int]:
+        """Returns the ids of the messages returned by a GET to `path`"""
+        response = self.client.get(path)
+        return [message["id"] for message in response.json()["messages"]]
+
+    def test_recent_reads_skip_the_database(self) -> None:
+        """Once primed, the newest messages and messages since a recent id
+        are read without queries"""
+        for i in range(5):
+            self._create_message(self.user, f"message {i}")
+        expected = self._get_ids("/messaging/message")
+        with self.assertNumQueries(0):
+            self.assertEqual(self._get_ids("/messaging/message?limit=3"), expected[2:])
+            self.assertEqual(
+                self._get_ids(f"/messaging/message?since={expected[3]}"), expected[4:]
+            )
+        self.assertGreater(MESSAGE_TAIL.stats()["hit_rate"], 0)
+
+    def test_reads_past_the_window_use_the_database(self) -> None:
+        """Messages created before the buffer was primed are read from the
+        database"""
+        for i in range(5):
+            self._create_message(self.user, f"message {i}")
+        expected = self._get_ids("/messaging/message")
+        MESSAGE_TAIL.reset()
+        self._create_message(self.user, "new")
+        with self.assertNumQueries(1):
+            ids = self._get_ids(f"/messaging/message?since={expected[0]}")
+        self.assertEqual(ids[:-1], expected[1:])
+
+
+@override_settings(MESSAGING_TAIL_CHECK_INTERVAL=0)
+class TailCheckTests(_MessagingTestCase):
+    """Checks that the message tail learns of the writes of other processes.
+    A write whose commit hooks are not run stands in for the write of another
+    process, since this process never appends it to its tail"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        self.user = USER_SERVICE.get_user("Jacob")
+        for i in range(3):
+            self._create_message(self.user, f"message {i}")
+        self.ids = [message.id for message in MESSAGE_SERVICE.get_all_messages(3, None)]
+
+    def _get_ids(self, messages: list[EncodedMessage]) -> list[int]:
+        """Returns the ids of the given messages"""
+        return [message.id for message in messages]
+
+    def test_messages_of_other_processes_are_read(self) -> None:
+        """Messages created by another process are added to the tail"""
+        other_id = MESSAGE_SERVICE.create_message(self.user, "from another process")
+        newest = MESSAGE_SERVICE.get_all_messages(3, None)
+        self.assertEqual(self._get_ids(newest), self.ids[1:] + [other_id])
+        since = MESSAGE_SERVICE.get_messages_since(self.ids[-1], 10)
+        self.assertEqual(self._get_ids(since), [other_id])
+        self.assertIn(str(other_id), MESSAGE_SERVICE.get_version())
+        with self.assertNumQueries(1):  # Only the check, the tail has them
+            MESSAGE_SERVICE.get_all_messages(4, None)
+
+    def test_changes_of_other_processes_empty_the_tail(self) -> None:
+        """Messages changed by another process are read again"""
+        self.user.username = "Renamed"
+        self.user.save()  # Records the change, but does not reset this tail
+        messages = MESSAGE_SERVICE.get_all_messages(3, None)
+        self.assertEqual(json.loads(messages[0].json)["username"], "Renamed")
+
+    def test_deleted_messages_are_forgotten(self) -> None:
+        """Messages deleted directly, such as through the admin site, are no
+        longer read from the tail and change the ETag, however many are
+        deleted at once"""
+        headers = {"Username": "Jacob", "Password": "testing123"}
+        etag = self.client.get("/messaging/message", headers=headers)["ETag"]
+        with CaptureQueriesContext(connection) as context, transaction.atomic():
+            Message.objects.filter(id__in=self.ids[:2]).delete()
+        Message.objects.get(id=self.ids[-1]).delete()
+        updates = [
+            query
+            for query in context.captured_queries
+            if query["sql"].startswith('UPDATE "messaging_boardstate"')
+        ]
+        self.assertEqual(len(updates), 1)
+        response = self.client.get(
+            "/messaging/message", headers={**headers, "If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["messages"], [])
+
+    @override_settings(MESSAGING_TAIL_CHECK_INTERVAL=60)
+    def test_tail_is_checked_once_per_interval(self) -> None:
+        """Between checks, reads of the tail send no queries, so messages of
+        other processes are only seen once the interval has passed"""
+        MESSAGE_SERVICE.create_message(self.user, "from another process")
+        with self.assertNumQueries(0):
+            newest = MESSAGE_SERVICE.get_all_messages(3, None)
+        self.assertEqual(self._get_ids(newest), self.ids)
+
+    def test_gap_raises_the_floor(self) -> None:
+        """An appended message that does not follow the newest one may skip
+        messages of other processes, so older reads use the database"""
+        tail = _MessageTail(10)
+        for message_id in (1, 2, 5):
+            tail.append(EncodedMessage(message_id, b"{}"))
+        self.assertIsNone(tail.get_since(1, 10))
+        self.assertEqual(self._get_ids(tail.get_since(4, 10) or []), [5])
+
+    def test_version_is_shared_by_processes(self) -> None:
+        """Tails of different processes that were emptied a different number
+        of times give the same version of the same board"""
+        first, second = _MessageTail(10), _MessageTail(10)
+        for _ in range(3):
+            second.reset()
+        for tail in (first, second):
+            tail.check(4, 7, tail.epoch)
+        self.assertNotEqual(first.epoch, second.epoch)
+        self.assertEqual(first.get_version(), "4.7")
+        self.assertEqual(second.get_version(), first.get_version())
+        version = MESSAGE_SERVICE.get_version()
+        MESSAGE_TAIL.reset()  # As in a process that just started
+        self.assertEqual(MESSAGE_SERVICE.get_version(), version)
+
+    async def test_poll_wakes_on_message_of_other_process(self) -> None:
+        """A waiting client is woken by a message of another process"""
+
+        async def create_later() -> int:
+            await asyncio.sleep(0.1)
+            return await sync_to_async(MESSAGE_SERVICE.create_message)(
+                self.user, "from another process"
+            )
+
+        response, other_id = await asyncio.gather(
+            self.async_client.get(
+                f"/messaging/message/poll?since={self.ids[-1]}&wait=5"
+            ),
+            create_later(),
+        )
+        messages = response.json()["messages"]
+        self.assertEqual([message["id"] for message in messages], [other_id])
+
+
+class ConditionalGetTests(_MessagingTestCase):
+    """Checks that unchanged message lists are answered with 304"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        self.user = USER_SERVICE.get_user("Jacob")
+        self._create_message(self.user, "@Jacob hello")
+
+    def _get(self, path: str, etag: str = "") -> Any:
+        """Sends a GET to `path` as `Jacob` with the given `If-None-Match`"""
+        headers = {"Username": "Jacob", "Password": "testing123"}
+        if etag:
+            headers["If-None-Match"] = etag
+        return self.client.get(path, headers=headers)
+
+    def test_unchanged_list_is_not_modified(self) -> None:
+        """A repeated request with the ETag gets a 304 without querying
+        messages, only reading the user of the lists that authenticate"""
+        for path, queries in [
+            ("/messaging/message", 0),
+            ("/messaging/message/me", 1),
+            ("/messaging/message/tagged", 1),
+        ]:
+            etag = self._get(path)["ETag"]
+            with self.assertNumQueries(queries):
+                response = self._get(path, etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertNotEqual(self._get(path + "?limit=1", etag).status_code, 304)
+
+    def test_new_message_changes_etag(self) -> None:
+        """Creating a message invalidates the ETag"""
+        etag = self._get("/messaging/message")["ETag"]
+        self._create_message(self.user, "new")
+        response = self._get("/messaging/message", etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["messages"]), 2)
+
+    @override_settings(MESSAGING_TAIL_CHECK_INTERVAL=0)
+    def test_changes_of_other_processes_change_etag(self) -> None:
+        """Messages created or changed by another process, whose commit hooks
+        are not run, invalidate the ETag"""
+        etag = self._get("/messaging/message")["ETag"]
+        MESSAGE_SERVICE.create_message(self.user, "from another process")
+        response = self._get("/messaging/message", etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["messages"]), 2)
+        etag = response["ETag"]
+        self.user.username = "Renamed"
+        self.user.save()
+        response = self.client.get(
+            "/messaging/message",
+            headers={
+                "Username": "Renamed",
+                "Password": "testing123",
+                "If-None-Match": etag,
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_removing_messages_changes_etag(self) -> None:
+        """Removing every message and creating as many new ones does not
+        reuse an old ETag"""
+        etag = self._get("/messaging/message")["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            MESSAGE_SERVICE.remove_all_messages()
+        self._create_message(self.user, "replacement")
+        response = self._get("/messaging/message", etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class BatchCreateTests(_MessagingTestCase):
+    """Checks that many messages are created with one request"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+
+    def _post_batch(self, body: dict[str, Any]) -> Any:
+        """Posts a batch of messages as `Jacob`"""
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                "/messaging/message/batch",
+                body,
+                content_type="application/json",
+                headers={"Username": "Jacob", "Password": "testing123"},
+            )
+
+    def test_invalid_messages_are_skipped(self) -> None:
+        """Valid messages are created and invalid ones are reported"""
+        response = self._post_batch({"messages": ["one", 2, "x" * 501, "@Jacob"]})
+        self.assertEqual(response.status_code, 201)
+        ids = response.json()["ids"]
+        self.assertEqual([index for index, id in enumerate(ids) if id is None], [1, 2])
+        self.assertEqual(
+            [error["index"] for error in response.json()["errors"]], [1, 2]
+        )
+        messages = self.client.get("/messaging/message").json()["messages"]
+        self.assertEqual([message["id"] for message in messages], [ids[0], ids[3]])
+        tagged = self.client.get(
+            "/messaging/message/tagged",
+            headers={"Username": "Jacob", "Password": "testing123"},
+        ).json()["messages"]
+        self.assertEqual([message["id"] for message in tagged], [ids[3]])
+
+    def test_atomic_batch_is_rejected(self) -> None:
+        """An atomic batch with an invalid message creates nothing"""
+        response = self._post_batch({"messages": ["one", 2], "atomic": True})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.exists())
+
+    def test_atomic_must_be_boolean(self) -> None:
+        """An `atomic` value that is not true or false is a bad request,
+        rather than being read as true or false"""
+        for atomic in ("false", 0.0001, None):
+            response = self._post_batch({"messages": ["a"], "atomic": atomic})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {"error": "Invalid `atomic` param"})
+        self.assertFalse(Message.objects.exists())
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    MESSAGING_WRITE_QUEUE_ENABLED=True,
+)
+class WriteQueueTests(TransactionTestCase):
+    """Checks that queued messages are written in batches by the writer
+    thread. Uses a `TransactionTestCase` so that the thread sees the user"""
+
+    databases = {"default", "read"}
+
+    headers = {"Username": "Jacob", "Password": "testing123"}
+
+    def setUp(self) -> None:
+        MESSAGE_TAIL.reset()  # Forget messages of previous tests
+        USER_SERVICE.create_user("Jacob", "testing123")
+
+    def tearDown(self) -> None:
+        MESSAGE_WRITER.stop()
+
+    async def _post(self, message: Any, headers: dict[str, str]) -> Any:
+        """Posts a message as `Jacob` with the given extra headers"""
+        return await self.async_client.post(
+            "/messaging/message/create",
+            {"message": message},
+            content_type="application/json",
+            headers=self.headers | headers,
+        )
+
+    async def test_concurrent_messages_are_written(self) -> None:
+        """Concurrently posted messages are all written and get their ids"""
+        responses = await asyncio.gather(
+            *[self._post(f"message {i}", {}) for i in range(20)]
+        )
+        self.assertEqual({response.status_code for response in responses}, {201})
+        ids = [response.json()["id"] for response in responses]
+        self.assertEqual(len(set(ids)), 20)
+        self.assertEqual(await Message.objects.acount(), 20)
+
+    async def test_fire_and_forget(self) -> None:
+        """A client that prefers not to wait gets 202 and the message is
+        written once the queue is flushed"""
+        response = await self._post("later", {"Prefer": "respond-async"})
+        self.assertEqual(response.status_code, 202)
+        await sync_to_async(MESSAGE_WRITER.stop)()
+        self.assertEqual(await Message.objects.acount(), 1)
+
+    async def test_invalid_messages_are_not_queued(self) -> None:
+        """Invalid messages are rejected before they are queued, so they do
+        not fail the batch of the valid messages written with them"""
+        invalid, valid = await asyncio.gather(
+            self._post({"text": "hello"}, {}), self._post("hello", {})
+        )
+        self.assertEqual(invalid.status_code, 400)
+        self.assertEqual(valid.status_code, 201)
+        self.assertEqual(await Message.objects.acount(), 1)
+
+
+class SearchTests(_MessagingTestCase):
+    """Checks that messages are found by the words they contain, with both
+    search backends"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        get_search_backend.cache_clear()
+        self.addCleanup(get_search_backend.cache_clear)
+        USER_SERVICE.create_user("Jacob", "testing123")
+        self.user = USER_SERVICE.get_user("Jacob")
+
+    def _search(self, query: str) -> list[str]:
+        """Returns the text of the messages found by the query"""
+        response = self.client.get("/messaging/message/search", {"q": query})
+        return [message["message"] for message in response.json()["messages"]]
+
+    def _check_search(self) -> None:
+        """Checks that only messages with every word of the query match"""
+        self._create_message(self.user, "the quick brown fox")
+        self._create_message(self.user, "a quick hello")
+        self._create_message(self.user, "Brown bread")
+        self.assertEqual(self._search("QUICK brown"), ["the quick brown fox"])
+        self.assertCountEqual(
+            self._search("brown"), ["the quick brown fox", "Brown bread"]
+        )
+        self.assertEqual(self._search('"quick" OR'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            MESSAGE_SERVICE.remove_all_messages()
+        self.assertEqual(self._search("brown"), [])
+
+    def test_fts5_search(self) -> None:
+        """The FTS5 index finds messages and forgets removed ones"""
+        self.assertIsInstance(get_search_backend(), _FTS5SearchBackend)
+        self._check_search()
+
+    @override_settings(MESSAGING_SEARCH_BACKEND="inverted")
+    def test_inverted_index_search(self) -> None:
+        """The inverted index finds messages and forgets removed ones"""
+        self.assertIsInstance(get_search_backend(), _InvertedIndexSearchBackend)
+        self._check_search()
+
+    def test_missing_query_is_rejected(self) -> None:
+        """A search without a query returns 400"""
+        response = self.client.get("/messaging/message/search")
+        self.assertEqual(response.status_code, 400)
+
+
+class MetricsTests(_MessagingTestCase):
+    """Checks that requests are measured and exposed on the metrics
+    endpoint"""
+
+    headers = {"Username": "Jacob", "Password": "testing123"}
+
+    def setUp(self) -> None:
+        super().setUp()
+        METRICS.clear()
+        CREDENTIAL_CACHE.clear()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        self._create_message(USER_SERVICE.get_user("Jacob"), "hello")
+
+    def test_request_is_measured(self) -> None:
+        """The request count, queries and rows of an endpoint are exported"""
+        self.client.get("/messaging/message/me", headers=self.headers)
+        metrics = self.client.get("/metrics").content.decode()
+        labels = '{endpoint="/messaging/message/me"}'
+        self.assertIn(
+            'messaging_requests_total{endpoint="/messaging/message/me",'
+            'method="GET",status="200"} 1',
+            metrics,
+        )
+        # The user, the messages and the count are queried in worker threads
+        self.assertIn(f"messaging_request_queries_sum{labels} 3", metrics)
+        self.assertIn(f"messaging_request_rows_sum{labels} 1", metrics)
+        self.assertIn("messaging_credential_cache_misses_total", metrics)
+
+    @override_settings(MESSAGING_SLOW_REQUEST_THRESHOLD=0)
+    def test_slow_request_is_logged_with_sql(self) -> None:
+        """Requests over the threshold are logged with their queries"""
+        with self.assertLogs("messaging.middleware", "WARNING") as logs:
+            self.client.get("/messaging/message/me", headers=self.headers)
+        self.assertIn("/messaging/message/me", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+
+
+@override_settings(MESSAGING_STREAM_THRESHOLD=2, MESSAGING_STREAM_CHUNK_SIZE=2)
+class StreamingResponseTests(_MessagingTestCase):
+    """Checks that large pages are streamed with the same body as buffered
+    ones"""
+
+    headers = {"Username": "Jacob", "Password": "testing123"}
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        user = USER_SERVICE.get_user("Jacob")
+        for i in range(5):
+            self._create_message(user, f"@Jacob message {i}")
+
+    async def _get_body(self, path: str, limit: int, **headers: str) -> bytes:
+        """Returns the body of a list request, joining streamed chunks"""
+        response = await self.async_client.get(
+            path, {"limit": limit}, headers={**self.headers, **headers}
+        )
+        self.assertEqual(response.status_code, 200)
+        if not response.streaming:
+            return response.content
+        streaming = cast(StreamingHttpResponse, response).streaming_content
+        content = cast(AsyncIterator[bytes], streaming)
+        return b"".join([chunk async for chunk in content])
+
+    async def test_streamed_page_matches_buffered_page(self) -> None:
+        """Both endpoints stream pages over the threshold with the same body,
+        including the cursor of the previous page"""
+        for path in ("/messaging/message", "/messaging/message/tagged"):
+            with override_settings(MESSAGING_STREAM_THRESHOLD=100):
+                buffered = await self._get_body(path, 3)
+            streamed = await self._get_body(path, 3)
+            self.assertEqual(streamed, buffered)
+            self.assertEqual(len(json.loads(streamed)["messages"]), 3)
+            everything = json.loads(await self._get_body(path, 10))
+            self.assertEqual(len(everything["messages"]), 5)
+            self.assertIsNone(everything["next_cursor"])
+
+    async def test_streamed_page_is_compressed(self) -> None:
+        """Clients that accept gzip get a compressed stream"""
+        streamed = await self._get_body("/messaging/message", 3)
+        compressed = await self._get_body(
+            "/messaging/message", 3, **{"Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(gzip.decompress(compressed), streamed)
+
+
+class DocsTests(_MessagingTestCase):
+    """Checks that the documentation page is rendered once and served with
+    compression and caching headers"""
+
+    def test_docs_are_compressed_and_cached(self) -> None:
+        """The page is served compressed to clients that accept gzip and is
+        not sent again to clients that have it"""
+        response = self.client.get("/messaging/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Get all messages", response.content)
+        self.assertIn("max-age", response["Cache-Control"])
+        compressed = self.client.get("/messaging/", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(compressed["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(compressed.content), response.content)
+        cached = self.client.get(
+            "/messaging/", headers={"If-None-Match": response["ETag"]}
+        )
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(get_docs_page.cache_info().currsize, 1)
+
+
+class PurgeTests(_MessagingTestCase):
+    """Checks that messages are removed in batches, with their mentions, and
+    that the retention policy keeps the right messages"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        self.user = USER_SERVICE.get_user("Jacob")
+        for i in range(5):
+            self._create_message(self.user, f"@Jacob message {i}")
+
+    def _get_remaining(self) -> list[str]:
+        """Returns the text of the remaining messages, oldest first"""
+        return list(Message.objects.order_by("id").values_list("message", flat=True))
+
+    def test_purge_removes_in_batches(self) -> None:
+        """Every batch is deleted in its own transaction"""
+        with CaptureQueriesContext(connection) as context:
+            removed = MESSAGE_SERVICE.purge_messages(Message.objects.all(), 2)
+        self.assertEqual(removed, 5)
+        self.assertEqual(self._get_remaining(), [])
+        self.assertFalse(Mention.objects.exists())
+        savepoints = [
+            query for query in context.captured_queries if "SAVEPOINT" in query["sql"]
+        ]
+        self.assertEqual(len(savepoints), 6)  # Created and released per batch
+
+    def test_retention_keeps_newest_messages(self) -> None:
+        """Only the newest messages are kept"""
+        removed = MESSAGE_SERVICE.enforce_retention(2, None, 2)
+        self.assertEqual(removed, 3)
+        self.assertEqual(
+            self._get_remaining(), ["@Jacob message 3", "@Jacob message 4"]
+        )
+
+    def test_retention_removes_old_messages(self) -> None:
+        """Messages older than the maximum age are removed by the command"""
+        old = Message.objects.order_by("id")[:2].values_list("id", flat=True)
+        Message.objects.filter(id__in=list(old)).update(
+            created_at=timezone.now() - timedelta(days=2)
+        )
+        output = StringIO()
+        call_command("enforce_retention", "--max-age", "86400", stdout=output)
+        self.assertIn("Removed 2 messages", output.getvalue())
+        self.assertEqual(len(self._get_remaining()), 3)
+
+    @override_settings(MESSAGING_TAIL_CHECK_INTERVAL=0)
+    def test_running_servers_forget_removed_messages(self) -> None:
+        """Messages removed by the command, whose commit hooks are not run as
+        in another process, are no longer read from the message tail"""
+        newest = MESSAGE_SERVICE.get_all_messages(5, None)
+        self.assertEqual(len(newest), 5)
+        Message.objects.filter(id__in=[newest[0].id, newest[-1].id]).update(
+            created_at=timezone.now() - timedelta(days=2)
+        )
+        call_command("enforce_retention", "--max-age", "86400", stdout=StringIO())
+        remaining = [message.id for message in newest[1:-1]]
+        newest = MESSAGE_SERVICE.get_all_messages(5, None)
+        self.assertEqual([message.id for message in newest], remaining)
+        self.assertEqual(MESSAGE_SERVICE.get_messages_since(remaining[-1], 5), [])
+
+
+class UserHistoryTests(_MessagingTestCase):
+    """Checks that a user's messages are paginated and counted"""
+
+    headers = {"Username": "Jacob", "Password": "testing123"}
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        USER_SERVICE.create_user("Other", "testing123")
+        self.user = USER_SERVICE.get_user("Jacob")
+        for i in range(5):
+            self._create_message(self.user, f"message {i}")
+            self._create_message(USER_SERVICE.get_user("Other"), f"other {i}")
+
+    def _get_page(self, **params: Any) -> Any:
+        """Returns the decoded response of a page of the user's messages"""
+        response = self.client.get(
+            "/messaging/message/me", params, headers=self.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_pages_walk_back_through_history(self) -> None:
+        """Following `next_cursor` returns every message once, with the
+        count of all of them"""
+        first = self._get_page(limit=3)
+        self.assertEqual(first["count"], 5)
+        second = self._get_page(limit=3, before=first["next_cursor"])
+        texts = [m["message"] for m in second["messages"] + first["messages"]]
+        self.assertEqual(texts, [f"message {i}" for i in range(5)])
+        self.assertIsNone(second["next_cursor"])
+        newer = self._get_page(since=first["messages"][0]["id"])
+        self.assertEqual(len(newer["messages"]), 2)
+
+    def test_count_follows_purges(self) -> None:
+        """The count is kept up to date when messages are purged"""
+        MESSAGE_SERVICE.enforce_retention(4, None, 2)
+        self.assertEqual(MESSAGE_SERVICE.get_user_message_count(self.user), 2)
+        self.assertEqual(
+            User.objects.get(username="Other").message_count,
+            Message.objects.filter(user__username="Other").count(),
+        )
+
+    def test_count_follows_direct_changes(self) -> None:
+        """The count is kept up to date when messages are created, moved to
+        another user or deleted directly, such as through the admin site"""
+
+        def assert_counts() -> None:
+            for user in User.objects.all():
+                self.assertEqual(
+                    user.message_count, Message.objects.filter(user=user).count()
+                )
+
+        first, second = Message.objects.filter(user=self.user).order_by("id")[:2]
+        first.delete()
+        assert_counts()
+        second.user = USER_SERVICE.get_user("Other")
+        second.save()
+        assert_counts()
+        Message.objects.create(user=self.user, message="created directly")
+        assert_counts()
+        other = Message.objects.filter(user__username="Other")
+        Message.objects.filter(
+            id__in=list(other.values_list("id", flat=True)[:2])
+        ).delete()
+        assert_counts()
+        self.assertEqual(self._get_page()["count"], 4)
+
+
+class RateLimitTests(_MessagingTestCase):
+    """Checks that clients over their limits are shed with `Retry-After`"""
+
+    headers = {"Username": "Jacob", "Password": "testing123"}
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+
+    def _use_limiter(self, **limits: Any) -> _RateLimiter:
+        """Replaces the rate limiter with one built from the given settings"""
+        with override_settings(**limits):
+            limiter = _RateLimiter()
+        patcher = mock.patch("messaging.middleware.RATE_LIMITER", limiter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return limiter
+
+    def _create(self, **headers: str) -> Any:
+        """Creates a message with the given headers"""
+        return self.client.post(
+            "/messaging/message/create",
+            {"message": "hello"},
+            content_type="application/json",
+            headers={**self.headers, **headers},
+        )
+
+    def test_user_over_limit_is_rejected(self) -> None:
+        """Once a user has spent their burst, they must wait, while failed
+        logins in their name do not spend it"""
+        self._use_limiter(
+            MESSAGING_RATE_LIMIT_USER_RATE=0.01, MESSAGING_RATE_LIMIT_USER_BURST=2
+        )
+        for _ in range(3):
+            self.assertEqual(self._create(Password="wrong").status_code, 401)
+        self.assertEqual(self._create().status_code, 201)
+        self.assertEqual(self._create().status_code, 201)
+        response = self._create()
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response["Retry-After"]), 1)
+        self.assertEqual(self.client.get("/messaging/message").status_code, 200)
+
+    def test_address_over_limit_is_rejected(self) -> None:
+        """Requests from one address are limited whoever they claim to be"""
+        self._use_limiter(
+            MESSAGING_RATE_LIMIT_IP_RATE=0.01, MESSAGING_RATE_LIMIT_IP_BURST=1
+        )
+        self.assertEqual(self._create().status_code, 201)
+        self.assertEqual(self._create(Username="Other").status_code, 429)
+        metrics = self.client.get("/metrics").content.decode()
+        self.assertIn('decision="address"', metrics)
+
+    def test_failed_logins_on_reads_are_limited(self) -> None:
+        """Reads whose credentials are rejected take a token from their
+        address, and once it has none left, reads with credentials are shed
+        until it refills, while reads that authenticate take none"""
+        self._use_limiter(
+            MESSAGING_RATE_LIMIT_IP_RATE=0.01, MESSAGING_RATE_LIMIT_IP_BURST=2
+        )
+        wrong = {**self.headers, "Password": "wrong"}
+        for _ in range(3):
+            response = self.client.get("/messaging/message/me", headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+        for _ in range(2):
+            response = self.client.get("/messaging/message/tagged", headers=wrong)
+            self.assertEqual(response.status_code, 401)
+        response = self.client.get("/messaging/message/me", headers=self.headers)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.client.get("/messaging/message").status_code, 200)
+
+    @override_settings(MESSAGING_CLIENT_ADDRESS_HEADER="X-Forwarded-For")
+    def test_address_is_read_from_proxy_header(self) -> None:
+        """Behind a proxy, clients are told apart by the last address of the
+        configured header, which the proxy added"""
+        self._use_limiter(
+            MESSAGING_RATE_LIMIT_IP_RATE=0.01, MESSAGING_RATE_LIMIT_IP_BURST=1
+        )
+        for address in ("10.0.0.1", "1.1.1.1, 10.0.0.2"):
+            self.assertEqual(self._create(X_Forwarded_For=address).status_code, 201)
+        response = self._create(X_Forwarded_For="1.1.1.1, 10.0.0.1")
+        self.assertEqual(response.status_code, 429)
+
+    def test_concurrent_writes_are_capped(self) -> None:
+        """Writes beyond the concurrency cap are shed with 503"""
+        limiter = self._use_limiter(MESSAGING_MAX_CONCURRENT_WRITES=1)
+        limiter.start_write()  # Another write is being served
+        response = self._create()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+        limiter.finish_write()
+        self.assertEqual(self._create().status_code, 201)
+
+
+class EncodedMessageTests(_MessagingTestCase):
+    """Checks that responses are built from the stored representations of
+    messages, and that they are kept up to date"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        self.user = USER_SERVICE.get_user("Jacob")
+
+    def _get_usernames(self) -> list[str]:
+        """Returns the usernames of the messages returned by the API"""
+        response = self.client.get("/messaging/message")
+        return [message["username"] for message in response.json()["messages"]]
+
+    def test_response_matches_encoded_messages(self) -> None:
+        """The joined representations form the same document as encoding the
+        whole response, whether they are read from the tail or the database"""
+        texts = ['Café "quoted" \\ @Jacob', "second"]
+        for text in texts:
+            self._create_message(self.user, text)
+        ids = Message.objects.order_by("id").values_list("id", flat=True)
+        expected = json.dumps(
+            {
+                "messages": [
+                    {"id": message_id, "username": "Jacob", "message": text}
+                    for message_id, text in zip(ids, texts)
+                ],
+                "next_cursor": None,
+            }
+        ).encode()
+        self.assertEqual(self.client.get("/messaging/message").content, expected)
+        MESSAGE_TAIL.reset()
+        self.assertEqual(self.client.get("/messaging/message").content, expected)
+
+    def test_rename_encodes_messages_again(self) -> None:
+        """Messages show the new username of their user once it is saved"""
+        self._create_message(self.user, "hello")
+        self.assertEqual(self._get_usernames(), ["Jacob"])
+        self.user.username = "Jake"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(self._get_usernames(), ["Jake"])
+
+    def test_other_saves_do_not_encode_messages(self) -> None:
+        """Saving other fields of a user costs no reads of their messages"""
+        self._create_message(self.user, "hello")
+        with self.assertNumQueries(1):
+            self.user.save(update_fields=["hashed_password"])
+        with self.assertNumQueries(2):  # The update and the newest message
+            self.user.save()
+
+    def test_saved_message_is_encoded(self) -> None:
+        """A message saved on its own, such as by the admin site, is encoded"""
+        message = Message.objects.create(user=self.user, message="old")
+        message.message = "new"
+        message.save()
+        message.refresh_from_db()
+        encoded = json.loads(bytes(message.encoded))
+        self.assertEqual(
+            encoded, {"id": message.id, "username": "Jacob", "message": "new"}
+        )
+
+
+class SnapshotTests(_MessagingTestCase):
+    """Checks that a board exported as a snapshot is imported back unchanged,
+    and that interrupted imports resume"""
+
+    headers = {"Username": "Jacob", "Password": "testing123"}
+
+    def setUp(self) -> None:
+        super().setUp()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        USER_SERVICE.create_user("Jake", "testing123")
+        jacob = USER_SERVICE.get_user("Jacob")
+        jake = USER_SERVICE.get_user("Jake")
+        for i in range(5):
+            self._create_message(jacob if i % 2 else jake, f"@Jacob message {i}")
+        self.directory = Path(tempfile.mkdtemp())
+        self.path = self.directory / "board.ndjson"
+
+    def tearDown(self) -> None:
+        for path in self.directory.iterdir():
+            path.unlink()
+        self.directory.rmdir()
+
+    def _export(self) -> bytes:
+        """Exports the board to the snapshot file and returns its contents"""
+        call_command(
+            "export_board",
+            "--output",
+            str(self.path),
+            "--chunk-size",
+            "2",
+            stderr=StringIO(),
+        )
+        return self.path.read_bytes()
+
+    def _clear_board(self) -> None:
+        """Deletes every user and message"""
+        Message.objects.all().delete()
+        User.objects.all().delete()
+
+    def test_round_trip(self) -> None:
+        """Importing a snapshot into an empty board restores its users,
+        messages, mentions and search index, so exporting it again gives the
+        same snapshot and the users can log in"""
+        snapshot = self._export()
+        self.assertEqual(len(snapshot.splitlines()), 7)
+        self._clear_board()
+        output = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("import_board", str(self.path), stdout=output)
+        self.assertIn("Imported 2 users and 5 messages from 7 lines", output.getvalue())
+        self.assertEqual(self._export(), snapshot)
+        self.assertEqual(USER_SERVICE.get_user("Jacob").message_count, 2)
+        self.assertEqual(Mention.objects.count(), 5)
+        response = self.client.get("/messaging/message", headers=self.headers)
+        self.assertEqual(len(response.json()["messages"]), 5)
+        response = self.client.get(
+            "/messaging/message/search", {"q": "message"}, headers=self.headers
+        )
+        self.assertEqual(len(response.json()["messages"]), 5)
+
+    @override_settings(MESSAGING_TAIL_CHECK_INTERVAL=0)
+    def test_running_servers_read_imported_messages(self) -> None:
+        """Messages imported by the command, whose commit hooks are not run as
+        in another process, are read from the message tail even when they
+        are older than the messages it holds"""
+        self._export()
+        ids = [message.id for message in MESSAGE_SERVICE.get_all_messages(5, None)]
+        MESSAGE_SERVICE.purge_messages(Message.objects.filter(id__in=ids[:2]), 2)
+        self.assertEqual(len(MESSAGE_SERVICE.get_all_messages(5, None)), 3)
+        call_command("import_board", str(self.path), stdout=StringIO())
+        newest = MESSAGE_SERVICE.get_all_messages(5, None)
+        self.assertEqual([message.id for message in newest], ids)
+
+    def test_import_skips_existing_rows(self) -> None:
+        """Importing a snapshot into the board it came from creates nothing"""
+        self._export()
+        report = import_board(self.path.read_bytes().splitlines(), 3)
+        self.assertEqual(report, ImportReport(0, 0, 7))
+        self.assertEqual(Message.objects.count(), 5)
+
+    def test_interrupted_import_resumes(self) -> None:
+        """An import that fails after a checkpoint resumes after it"""
+        lines = self._export().splitlines()
+        self._clear_board()
+        checkpoints: list[ImportReport] = []
+        broken = lines[:5] + [b'{"type": "message"}']
+        with self.assertRaises(ValueError):
+            import_board(broken, 2, on_checkpoint=checkpoints.append)
+        self.assertEqual(checkpoints[-1], ImportReport(2, 2, 4))
+        report = import_board(lines, 2, checkpoints[-1].lines)
+        self.assertEqual(report, ImportReport(0, 3, 7))
+        self.assertEqual(Message.objects.count(), 5)
+
+    def test_command_resumes_from_checkpoint(self) -> None:
+        """The command resumes from its checkpoint file and removes it"""
+        lines = self._export().splitlines()
+        self._clear_board()
+        import_board(lines[:4], 2)
+        checkpoint = self.directory / "board.ndjson.checkpoint"
+        checkpoint.write_text(
+            json.dumps(ImportReport(2, 2, 4)._asdict()), encoding="utf-8"
+        )
+        output = StringIO()
+        call_command("import_board", str(self.path), stdout=output)
+        self.assertIn("Resuming after line 4", output.getvalue())
+        self.assertIn("Imported 2 users and 5 messages", output.getvalue())
+        self.assertFalse(checkpoint.exists())
+        self.assertEqual(Message.objects.count(), 5)
+
+    async def test_export_endpoint(self) -> None:
+        """Only the superuser can download the snapshot"""
+        snapshot = await sync_to_async(lambda: b"".join(export_board(100)))()
+        with mock.patch.dict(os.environ, {"SUPERUSER": "Jake"}):
+            response = await self.async_client.get(
+                "/messaging/export", headers=self.headers
+            )
+            self.assertEqual(response.status_code, 403)
+            response = await self.async_client.get(
+                "/messaging/export",
+                headers={"Username": "Jake", "Password": "testing123"},
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        streaming = cast(StreamingHttpResponse, response).streaming_content
+        content = cast(AsyncIterator[bytes], streaming)
+        self.assertEqual(b"".join([chunk async for chunk in content]), snapshot)
+
+
+class QueryBudgetTests(_MessagingTestCase):
+    """Checks every endpoint against a fixed maximum number of queries, and
+    the query plans of the service layer against full table scans, on a
+    board large enough for an unbounded query to stand out"""
+
+    headers = {"Username": "Jacob", "Password": "testing123"}
+
+    budgets = {
+        "docs": 0,
+        "user": 3,  # Whether the username is taken, twice, then the insert
+        "login": 3,  # The user, the expired tokens, then the new token
+        "message": 2,  # The version, then the page
+        "stream": 1,  # The first page
+        "poll": 1,
+        "search": 2,  # The matching ids, then the messages
+        "me": 4,  # The user, the version, the count, then the page
+        "tagged": 3,  # The user, the version, then the page
+        "create": 8,
+        "batch": 8,
+        "nuke": 22,  # The user, then per batch of purged messages
+        "export": 9,  # The user, then one query per chunk of each table
+    }
+    """The maximum number of queries of a request to each endpoint, by the
+    name of its URL pattern, with a cold credential cache"""
+    message_tables = ("messaging_message", "messaging_mention")
+    """The tables that grow with every message created"""
+    messages = 5000
+    """The number of messages on the board"""
+    user: User
+    """The user that sends the requests, who is tagged in every message"""
+    middle: int
+    """The id of the message in the middle of the board, used as a cursor"""
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        USER_SERVICE.create_user("Jacob", "testing123")
+        users = [USER_SERVICE.get_user("Jacob")]
+        users += User.objects.bulk_create(
+            [
+                User(
+                    username=f"user{i}", hashed_password="", password_salt=uuid.uuid4()
+                )
+                for i in range(100)
+            ]
+        )
+        generator = random.Random(0)
+        for start in range(0, cls.messages, 1000):
+            MESSAGE_SERVICE.create_messages_in_bulk(
+                [
+                    (
+                        generator.choice(users),
+                        f"hello @Jacob @user{generator.randrange(100)} number {i}",
+                    )
+                    for i in range(start, start + 1000)
+                ]
+            )
+        cls.user = users[0]
+        cls.middle = Message.objects.order_by("id")[cls.messages // 2].id
+
+    def setUp(self) -> None:
+        super().setUp()
+        CREDENTIAL_CACHE.clear()
+
+    def _get_requests(self) -> dict[str, Callable[[], Any]]:
+        """Returns a function that sends a typical request to each endpoint
+        that responds without streaming, by the name of its URL pattern"""
+        client, headers = self.client, self.headers
+        user = {"username": "Jake", "password": "testing123"}
+        login = {"username": "Jacob", "password": "testing123"}
+        return {
+            "docs": lambda: client.get("/messaging/"),
+            "user": lambda: client.post(
+                "/messaging/user", user, content_type="application/json"
+            ),
+            "login": lambda: client.post(
+                "/messaging/login", login, content_type="application/json"
+            ),
+            "message": lambda: client.get(
+                "/messaging/message", {"before": self.middle}, headers=headers
+            ),
+            "poll": lambda: client.get(
+                "/messaging/message/poll", {"since": self.middle}, headers=headers
+            ),
+            "search": lambda: client.get(
+                "/messaging/message/search", {"q": "hello"}, headers=headers
+            ),
+            "me": lambda: client.get(
+                "/messaging/message/me", {"before": self.middle}, headers=headers
+            ),
+            "tagged": lambda: client.get(
+                "/messaging/message/tagged", {"before": self.middle}, headers=headers
+            ),
+            "create": lambda: client.post(
+                "/messaging/message/create",
+                {"message": "hello @user1"},
+                content_type="application/json",
+                headers=headers,
+            ),
+            "batch": lambda: client.post(
+                "/messaging/message/batch",
+                {"messages": ["hello @user1", "hello @user2"]},
+                content_type="application/json",
+                headers=headers,
+            ),
+            "nuke": lambda: client.delete("/messaging/message/nuke", headers=headers),
+        }
+
+    def _get_plan_problems(self, sql: str) -> list[str]:
+        """Returns the steps of the query plan of a statement that read a whole
+        table, or sort every matching row of a table that grows with every
+        message. Walking a table in primary key order is not a problem when
+        the statement has a `LIMIT` and no `WHERE` clause, since it stops
+        after that many rows"""
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            steps = [row[3] for row in cursor.fetchall()]
+        sorted_in_memory = "USE TEMP B-TREE FOR ORDER BY" in steps
+        bounded = re.search(r"LIMIT \d+", sql) and " WHERE " not in sql
+        tables = connection.introspection.table_names()
+        problems = []
+        for step in steps:
+            scan = re.fullmatch(r"SCAN (\w+)", step)
+            if scan and scan[1] in tables and (sorted_in_memory or not bounded):
+                problems.append(step)
+        if sorted_in_memory and any(
+            f'"{table}"' in sql for table in self.message_tables
+        ):
+            problems.append("USE TEMP B-TREE FOR ORDER BY")
+        return problems
+
+    def _assert_indexed(self, queries: list[dict[str, str]]) -> None:
+        """Checks the query plans of the captured statements that read rows"""
+        for query in queries:
+            sql = query["sql"]
+            if sql.startswith(("SELECT", "UPDATE", "DELETE")):
+                self.assertEqual(self._get_plan_problems(sql), [], sql)
+
+    def test_every_endpoint_has_a_budget(self) -> None:
+        """Endpoints added to the URL patterns must be given a budget"""
+        names = {pattern.name for pattern in urlpatterns}
+        self.assertEqual(names, set(self.budgets))
+        self.assertEqual(names, set(self._get_requests()) | {"stream", "export"})
+
+    def test_endpoints_are_within_budget(self) -> None:
+        """Every endpoint that responds without streaming stays within its
+        budget, reading from the database rather than the message tail"""
+        with mock.patch.dict(os.environ, {"SUPERUSER": "Jacob"}):
+            for name, send in self._get_requests().items():
+                with self.subTest(name):
+                    MESSAGE_TAIL.reset()
+                    CREDENTIAL_CACHE.clear()
+                    with CaptureQueriesContext(connection) as context:
+                        response = send()
+                    self.assertLess(response.status_code, 300)
+                    budget = self.budgets[name]
+                    if name == "nuke":
+                        budget *= math.ceil(
+                            self.messages / settings.MESSAGING_PURGE_BATCH_SIZE
+                        )
+                    self.assertLessEqual(len(context.captured_queries), budget)
+                    self._assert_indexed(context.captured_queries)
+
+    def _count_streamed_queries(self, path: str, chunks: int) -> int:
+        """Returns the number of queries issued by a GET to `path` until the
+        first `chunks` chunks of its body are read"""
+
+        async def read(content: AsyncIterator[bytes]) -> None:
+            read = 0
+            async for _ in content:
+                read += 1
+                if read == chunks:
+                    break
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(path, headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            streaming = cast(StreamingHttpResponse, response).streaming_content
+            async_to_sync(read)(cast(AsyncIterator[bytes], streaming))
+        self._assert_indexed(context.captured_queries)
+        return len(context.captured_queries)
+
+    @override_settings(MESSAGING_STREAM_CHUNK_SIZE=1000)
+    def test_streaming_endpoints_are_within_budget(self) -> None:
+        """Streams stay within their budget until their first events are sent,
+        and exports read one chunk per query"""
+        MESSAGE_TAIL.reset()
+        queries = self._count_streamed_queries("/messaging/message/stream", 1)
+        self.assertLessEqual(queries, self.budgets["stream"])
+        with mock.patch.dict(os.environ, {"SUPERUSER": "Jacob"}):
+            queries = self._count_streamed_queries("/messaging/export", 1000)
+        self.assertLessEqual(queries, self.budgets["export"])
+
+    def test_service_queries_use_indexes(self) -> None:
+        """No read of the service layer scans a whole table or sorts every
+        message it matches"""
+
+        async def read_page(page: Awaitable[MessageStream]) -> None:
+            async for _ in (await page).messages:
+                pass
+
+        def stream(page: Callable[[], Awaitable[MessageStream]]) -> None:
+            async_to_sync(read_page)(page())
+
+        user, middle = self.user, self.middle
+        reads: list[Callable[[], Any]] = [
+            lambda: MESSAGE_SERVICE.get_all_messages(50, None),
+            lambda: MESSAGE_SERVICE.get_all_messages(50, 10, middle),
+            lambda: MESSAGE_SERVICE.get_messages_since(middle, 50),
+            MESSAGE_SERVICE.get_version,
+            lambda: MESSAGE_SERVICE.get_user_messages(user, 50, None),
+            lambda: MESSAGE_SERVICE.get_user_messages(user, 50, None, middle),
+            lambda: MESSAGE_SERVICE.get_user_message_count(user),
+            lambda: MESSAGE_SERVICE.get_tagged_messages(user, 50, None),
+            lambda: MESSAGE_SERVICE.get_tagged_messages(user, 50, None, middle),
+            lambda: MESSAGE_SERVICE.search_messages("hello number", 50, 0),
+            lambda: USER_SERVICE.does_user_exist("Jacob"),
+            lambda: USER_SERVICE.authenticate("Jacob", "testing123"),
+            lambda: USER_SERVICE.get_user_from_token(
+                USER_SERVICE.create_token(user)[0]
+            ),
+            lambda: MESSAGE_SERVICE.create_message(user, "hello @user1"),
+            lambda: stream(
+                lambda: MESSAGE_SERVICE.astream_all_messages(50, None, middle)
+            ),
+            lambda: stream(
+                lambda: MESSAGE_SERVICE.astream_user_messages(user, 50, None, middle)
+            ),
+            lambda: stream(
+                lambda: MESSAGE_SERVICE.astream_tagged_messages(user, 50, None, middle)
+            ),
+        ]
+        for read in reads:
+            MESSAGE_TAIL.reset()
+            with CaptureQueriesContext(connection) as context:
+                read()
+            self.assertTrue(context.captured_queries)
+            self._assert_indexed(context.captured_queries)
@@ -7,10 +7,16 @@ from . import views
 urlpatterns = [
     path("", views.get_docs, name="docs"),
     path("user", views.create_user, name="user"),
+    path("login", views.login, name="login"),
     path("message", views.get_all_messages, name="message"),
+    path("message/stream", views.stream_messages, name="stream"),
+    path("message/poll", views.poll_messages, name="poll"),
+    path("message/search", views.search_messages, name="search"),
     path("message/me", views.get_my_messages, name="me"),
     path("message/tagged", views.get_tagged_messages, name="tagged"),
     path("message/create", views.create_message, name="create"),
+    path("message/batch", views.create_messages, name="batch"),
     path("message/nuke", views.delete_messages, name="nuke"),
+    path("export", views.export_board, name="export"),
     path("message/tagged", views.get_tagged_messages, name="tagged"),
 ]
@@ -1,28 +1,32 @@
 """The views of the application. Each function corresponds
 to a view, which is a single endpoint of the app"""
 
+import asyncio
+import hashlib
 import json
 import os
-from typing import Any, Optional
-from django.http import HttpRequest, HttpResponse, JsonResponse
-from django.template import loader
+import re
+from typing import Any, AsyncIterator, NamedTuple, Optional, TypeVar, Union
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.http.response import HttpResponseBase
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
 from django.views.decorators.csrf import csrf_exempt
-import markdown
-
-from .services import USER_SERVICE, MESSAGE_SERVICE
-from .models import User
-
-
-def _get_docs_content() -> str:
-    """Returns the docs markdown page as a single string"""
-    with open("messaging/messaging.md", "r", encoding="utf-8") as f:
-        content = f.read()
-        return content.replace(
-            "json", ""
-        )  # `markdown` does not remove language indicators from code blocks
-
-
-DOCS_CONTENT = _get_docs_content()
+from django.views.decorators.gzip import gzip_page
+
+from .auth import CREDENTIAL_CACHE
+from .broadcast import BROADCASTER
+from .docs import get_docs_page
+from .metrics import METRICS
+from .services import USER_SERVICE, MESSAGE_SERVICE, MessageStream
+from .snapshot import aexport_board
+from .tail import MESSAGE_TAIL
+from .writer import MESSAGE_WRITER
+from .models import MESSAGE_MAX_LENGTH, EncodedMessage, User
 
 # Views
 
@@ -31,10 +35,22 @@ DOCS_CONTENT = _get_docs_content()
 def get_docs(request: HttpRequest) -> HttpResponse:
     """GET /messaging
     Returns the documentation for the API"""
-    template = loader.get_template("messaging/docs.html")
-    html = markdown.markdown(DOCS_CONTENT)
-    context = {"html": html}
-    return HttpResponse(template.render(context, request))
+    page = get_docs_page()
+    not_modified = get_conditional_response(request, etag=page.etag)
+    if not_modified is not None:  # If the client has the page, return 304
+        response = not_modified
+    else:
+        response = HttpResponse(page.html)
+        accepted = request.headers.get("Accept-Encoding", "")
+        for coding, content in page.encoded.items():
+            if re.search(rf"\b{coding}\b", accepted):
+                response = HttpResponse(content)
+                response["Content-Encoding"] = coding
+                break
+    response["ETag"] = page.etag
+    patch_vary_headers(response, ["Accept-Encoding"])
+    patch_cache_control(response, public=True, max_age=settings.MESSAGING_DOCS_MAX_AGE)
+    return response
 
 
 @csrf_exempt
@@ -62,17 +78,127 @@ def create_user(request: HttpRequest) -> HttpResponse:
         return JsonResponse(  # If password is not correct, we return an error
             {"error": "Username has already been taken"}, status=409
         )
-    USER_SERVICE.create_user(
-        username, password
-    )  # If user does not exist, create new user
+    try:  # If user does not exist, create new user
+        USER_SERVICE.create_user(username, password)
+    except USER_SERVICE.InvalidUsernameException:  # Tags could not name the user
+        return JsonResponse(
+            {"error": "Username may only contain letters, digits and underscores"},
+            status=400,
+        )
     return HttpResponse(status=201)
 
 
 @csrf_exempt
-def get_all_messages(request: HttpRequest) -> HttpResponse:
-    """GET /messaging/message?limit={limit}&since={since}
+def login(request: HttpRequest) -> HttpResponse:
+    """POST /messaging/login
+    Issues a bearer token that authenticates subsequent requests in place of
+    the `Username` and `Password` headers
+
+    Request
+    -------
+    {
+        "username": str,
+        "password": str
+    }
+
+    Response
+    --------
+    {
+        "token": str,
+        "expires_at": str
+    }"""
+    if request.method != "POST":
+        return HttpResponse(status=405)
+    body: dict[str, str] = _get_json_data(request)
+    # If we are missing username or password, return 400
+    if "username" not in body or "password" not in body:
+        return JsonResponse({"error": "Missing username or password"}, status=400)
+    user = USER_SERVICE.authenticate(body["username"], body["password"])
+    if user is None:
+        return JsonResponse({"error": "Incorrect username or password"}, status=401)
+    token, expires_at = USER_SERVICE.create_token(user)
+    return JsonResponse(
+        {"token": token, "expires_at": expires_at.isoformat()}, status=201
+    )
+
+
+@csrf_exempt
+@gzip_page
+async def get_all_messages(request: HttpRequest) -> HttpResponseBase:
+    """GET /messaging/message?limit={limit}&since={since}&before={before}
     Returns all of the messages in the system
 
+    Response
+    --------
+    {
+        "messages": [
+            {
+                "id": int,
+                "username": str,
+                "message": str
+            }
+        ],
+        "next_cursor": Optional[int]
+    }"""
+    if request.method != "GET":
+        return HttpResponse(status=405)
+    params = _get_paging_params(request)
+    if isinstance(params, HttpResponse):  # If the params are invalid, return 400
+        return params
+    etag = await _aget_list_etag(request, None)
+    not_modified = _get_not_modified_response(request, etag)
+    if not_modified:  # If the client has the latest messages, return 304
+        return not_modified
+    if params.limit > settings.MESSAGING_STREAM_THRESHOLD:  # Too large to buffer
+        stream = await MESSAGE_SERVICE.astream_all_messages(
+            params.limit, params.since, params.before
+        )
+        return _set_etag(_get_streaming_page_response(stream), etag)
+    messages = await MESSAGE_SERVICE.aget_all_messages(
+        params.limit, params.since, params.before
+    )
+    return _set_etag(_get_page_response(messages, params), etag)
+
+
+@csrf_exempt
+async def stream_messages(request: HttpRequest) -> HttpResponseBase:
+    """GET /messaging/message/stream?limit={limit}&since={since}
+    Streams new messages as Server-Sent Events as soon as they are created.
+    Each event has the message's `id` as its id, so a reconnecting client
+    resumes from its `Last-Event-ID` header
+
+    Response
+    --------
+    id: int
+    event: message
+    data: {"id": int, "username": str, "message": str}"""
+    if request.method != "GET":
+        return HttpResponse(status=405)
+    params = _get_paging_params(request)
+    if isinstance(params, HttpResponse):  # If the params are invalid, return 400
+        return params
+    since = params.since
+    try:
+        last_event_id = request.META.get("HTTP_LAST_EVENT_ID")
+        if last_event_id:
+            since = int(last_event_id)
+    except ValueError:
+        return JsonResponse({"error": "Invalid `Last-Event-ID` header"}, status=400)
+    response = StreamingHttpResponse(
+        _stream_message_events(since, params.limit),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # Stop proxies from buffering events
+    return response
+
+
+@csrf_exempt
+async def poll_messages(request: HttpRequest) -> HttpResponse:
+    """GET /messaging/message/poll?limit={limit}&since={since}&wait={wait}
+    Returns the oldest `limit` messages created after `since`. If there are
+    none, waits up to `wait` seconds for one to be created
+
     Response
     --------
     {
@@ -86,29 +212,68 @@ def get_all_messages(request: HttpRequest) -> HttpResponse:
     }"""
     if request.method != "GET":
         return HttpResponse(status=405)
+    params = _get_paging_params(request)
+    if isinstance(params, HttpResponse):  # If the params are invalid, return 400
+        return params
+    try:
+        wait = float(request.GET.get("wait", 0))  # Grab `wait` query param
+    except ValueError:
+        return JsonResponse({"error": "Invalid `wait` param"}, status=400)
+    wait = max(0.0, min(wait, settings.MESSAGING_MAX_POLL_WAIT))
+    if params.since is None:  # Without a cursor there is nothing to wait for
+        messages = await MESSAGE_SERVICE.aget_all_messages(params.limit, None)
+        return _get_messages_response(messages, {})
+    messages = await MESSAGE_SERVICE.aget_messages_since(params.since, params.limit)
+    if not messages and wait > 0:
+        await MESSAGE_SERVICE.await_message(params.since, wait)
+        messages = await MESSAGE_SERVICE.aget_messages_since(params.since, params.limit)
+    return _get_messages_response(messages, {})
+
+
+@csrf_exempt
+def search_messages(request: HttpRequest) -> HttpResponse:
+    """GET /messaging/message/search?q={q}&limit={limit}&cursor={cursor}
+    Returns the messages that contain every word of the query, best match
+    first
+
+    Response
+    --------
+    {
+        "messages": [
+            {
+                "id": int,
+                "username": str,
+                "message": str
+            }
+        ],
+        "next_cursor": Optional[int]
+    }"""
+    if request.method != "GET":
+        return HttpResponse(status=405)
+    query = request.GET.get("q", "")  # Grab `q` query param
+    # If we are missing the query, return 400
+    if not query.strip():
+        return JsonResponse({"error": "Missing `q` param"}, status=400)
     try:
         limit = int(request.GET.get("limit", 100))  # Grab `limit` query param
     except ValueError:
         return JsonResponse({"error": "Invalid `limit` param"}, status=400)
-    since: Optional[int] = None
     try:
-        since_str = request.GET.get("since")  # Grab `since` query param
-        if since_str:
-            since = int(since_str)
+        cursor = int(request.GET.get("cursor", 0))  # Grab `cursor` query param
     except ValueError:
-        return JsonResponse({"error": "Invalid `since` param"}, status=400)
-    messages = MESSAGE_SERVICE.get_all_messages(limit, since)  # Get all messages
-    return JsonResponse(
-        {
-            "messages": [message.json() for message in messages]
-        }  # Convert messages to JSON
-    )
+        return JsonResponse({"error": "Invalid `cursor` param"}, status=400)
+    if limit < 0 or cursor < 0:
+        return JsonResponse({"error": "Invalid `limit` or `cursor` param"}, status=400)
+    messages = MESSAGE_SERVICE.search_messages(query, limit, cursor)
+    next_cursor = cursor + limit if messages and len(messages) == limit else None
+    return _get_messages_response(messages, {"next_cursor": next_cursor})
 
 
 @csrf_exempt
-def get_my_messages(request: HttpRequest) -> HttpResponse:
-    """GET /messaging/message/me
-    Returns all of the messages that you have sent
+@gzip_page
+async def get_my_messages(request: HttpRequest) -> HttpResponseBase:
+    """GET /messaging/message/me?limit={limit}&since={since}&before={before}
+    Returns all of the messages that you have sent, and how many there are
 
     Response
     --------
@@ -119,25 +284,38 @@ def get_my_messages(request: HttpRequest) -> HttpResponse:
                 "username": str,
                 "message": str
             }
-        ]
+        ],
+        "next_cursor": Optional[int],
+        "count": int
     }"""
     if request.method != "GET":
         return HttpResponse(status=405)
-    auth_error = _check_auth_headers(request)
-    if auth_error:  # If there is an error with authentication, return it immediately
-        return auth_error
-    user = _get_user_from_auth(request)  # Query user from auth headers
-    messages = MESSAGE_SERVICE.get_user_messages(user)  # Get messages from user
-    return JsonResponse(
-        {
-            "messages": [message.json() for message in messages]
-        }  # Convert messages to JSON
+    user = await _acheck_auth_headers(request)  # Query user from auth headers
+    if isinstance(user, HttpResponse):  # If authentication failed, return the error
+        return user
+    params = _get_paging_params(request)
+    if isinstance(params, HttpResponse):  # If the params are invalid, return 400
+        return params
+    etag = await _aget_list_etag(request, user)
+    not_modified = _get_not_modified_response(request, etag)
+    if not_modified:  # If the client has the latest messages, return 304
+        return not_modified
+    count = await MESSAGE_SERVICE.aget_user_message_count(user)
+    if params.limit > settings.MESSAGING_STREAM_THRESHOLD:  # Too large to buffer
+        stream = await MESSAGE_SERVICE.astream_user_messages(
+            user, params.limit, params.since, params.before
+        )
+        return _set_etag(_get_streaming_page_response(stream, count=count), etag)
+    messages = await MESSAGE_SERVICE.aget_user_messages(  # Get messages from user
+        user, params.limit, params.since, params.before
     )
+    return _set_etag(_get_page_response(messages, params, count=count), etag)
 
 
 @csrf_exempt
-def get_tagged_messages(request: HttpRequest) -> HttpResponse:
-    """GET /messaging/message/tagged
+@gzip_page
+async def get_tagged_messages(request: HttpRequest) -> HttpResponseBase:
+    """GET /messaging/message/tagged?limit={limit}&since={since}&before={before}
     Returns all of the messages that have tagged you
 
     Response
@@ -149,45 +327,133 @@ def get_tagged_messages(request: HttpRequest) -> HttpResponse:
                 "username": str,
                 "message": str
             }
-        ]
+        ],
+        "next_cursor": Optional[int]
     }"""
     if request.method != "GET":
         return HttpResponse(status=405)
-    auth_error = _check_auth_headers(request)
-    if auth_error:  # If there is an error with authentication, return it immediately
-        return auth_error
-    user = _get_user_from_auth(request)  # Query user from auth headers
-    messages = MESSAGE_SERVICE.get_tagged_messages(user)  # Get messages from user
-    return JsonResponse(
-        {
-            "messages": [message.json() for message in messages]
-        }  # Convert messages to JSON
+    user = await _acheck_auth_headers(request)  # Query user from auth headers
+    if isinstance(user, HttpResponse):  # If authentication failed, return the error
+        return user
+    params = _get_paging_params(request)
+    if isinstance(params, HttpResponse):  # If the params are invalid, return 400
+        return params
+    etag = await _aget_list_etag(request, user)
+    not_modified = _get_not_modified_response(request, etag)
+    if not_modified:  # If the client has the latest messages, return 304
+        return not_modified
+    if params.limit > settings.MESSAGING_STREAM_THRESHOLD:  # Too large to buffer
+        stream = await MESSAGE_SERVICE.astream_tagged_messages(
+            user, params.limit, params.since, params.before
+        )
+        return _set_etag(_get_streaming_page_response(stream), etag)
+    messages = await MESSAGE_SERVICE.aget_tagged_messages(
+        user, params.limit, params.since, params.before
     )
+    return _set_etag(_get_page_response(messages, params), etag)
 
 
 @csrf_exempt
-def create_message(request: HttpRequest) -> HttpResponse:
+async def create_message(request: HttpRequest) -> HttpResponse:
     """POST /messaging/message/create
     Creates a new message
 
+    Send `Prefer: respond-async` to get `202 Accepted` without waiting for
+    the message to be written, when the write queue is enabled
+
     Request
     --------
     {
         "message": str
+    }
+
+    Response
+    --------
+    {
+        "id": int
     }"""
     if request.method != "POST":
         return HttpResponse(status=405)
-    auth_error = _check_auth_headers(request)
-    if auth_error:  # If there is an error with authentication, return it immediately
-        return auth_error
-    user = _get_user_from_auth(request)  # Query user from auth headers
+    user = await _acheck_auth_headers(request)  # Query user from auth headers
+    if isinstance(user, HttpResponse):  # If authentication failed, return the error
+        return user
     body: dict[str, str] = _get_json_data(request)
     # If we are missing message, return 400
     if "message" not in body:
         return JsonResponse({"error": "Missing message"}, status=400)
     message = body["message"]
-    MESSAGE_SERVICE.create_message(user, message)
-    return HttpResponse(status=201)
+    error = _get_message_error(message)
+    if error is not None:  # Rejected before it can fail a queued batch
+        return JsonResponse({"error": error}, status=400)
+    if not settings.MESSAGING_WRITE_QUEUE_ENABLED:
+        message_id = await MESSAGE_SERVICE.acreate_message(user, message)
+        return JsonResponse({"id": message_id}, status=201)
+    try:
+        future = MESSAGE_WRITER.submit(user, message)
+    except MESSAGE_WRITER.QueueFullException:  # If the queue is full, shed load
+        response = JsonResponse({"error": "Too many pending messages"}, status=503)
+        response["Retry-After"] = "1"
+        return response
+    if "respond-async" in request.headers.get("Prefer", ""):  # Fire and forget
+        return HttpResponse(status=202)
+    message_id = await asyncio.wrap_future(future)
+    return JsonResponse({"id": message_id}, status=201)
+
+
+@csrf_exempt
+async def create_messages(request: HttpRequest) -> HttpResponse:
+    """POST /messaging/message/batch
+    Creates many messages at once. Invalid messages are skipped and reported,
+    unless `atomic` is true, in which case no message is created if any of
+    them is invalid
+
+    Request
+    --------
+    {
+        "messages": [str],
+        "atomic": bool
+    }
+
+    Response
+    --------
+    {
+        "ids": [Optional[int]],
+        "errors": [
+            {
+                "index": int,
+                "error": str
+            }
+        ]
+    }"""
+    if request.method != "POST":
+        return HttpResponse(status=405)
+    user = await _acheck_auth_headers(request)  # Query user from auth headers
+    if isinstance(user, HttpResponse):  # If authentication failed, return the error
+        return user
+    body: dict[str, Any] = _get_json_data(request)
+    messages = body.get("messages")
+    # If we are missing messages, return 400
+    if not isinstance(messages, list):
+        return JsonResponse({"error": "Missing messages"}, status=400)
+    if len(messages) > settings.MESSAGING_MAX_BATCH_SIZE:
+        return JsonResponse({"error": "Too many messages"}, status=400)
+    atomic = body.get("atomic", False)
+    if not isinstance(atomic, bool):  # Only true or false switch it
+        return JsonResponse({"error": "Invalid `atomic` param"}, status=400)
+    errors = [
+        {"index": index, "error": error}
+        for index, error in enumerate(map(_get_message_error, messages))
+        if error is not None
+    ]
+    if errors and atomic:  # Reject the whole batch
+        return JsonResponse({"ids": [], "errors": errors}, status=400)
+    invalid = {error["index"] for error in errors}
+    valid = [message for index, message in enumerate(messages) if index not in invalid]
+    created = iter(await MESSAGE_SERVICE.acreate_messages(user, valid))
+    ids = [
+        None if index in invalid else next(created) for index in range(len(messages))
+    ]
+    return JsonResponse({"ids": ids, "errors": errors}, status=201)
 
 
 @csrf_exempt
@@ -196,10 +462,9 @@ def delete_messages(request: HttpRequest) -> HttpResponse:
     Deletes all messages in the system"""
     if request.method != "DELETE":
         return HttpResponse(status=405)
-    auth_error = _check_auth_headers(request)
-    if auth_error:  # If there is an error with authentication, return it immediately
-        return auth_error
-    user = _get_user_from_auth(request)  # Query user from auth headers
+    user = _check_auth_headers(request)  # Query user from auth headers
+    if isinstance(user, HttpResponse):  # If authentication failed, return the error
+        return user
     correct_username = os.environ["SUPERUSER"]
     if user.username != correct_username:
         return HttpResponse(status=403)
@@ -207,6 +472,89 @@ def delete_messages(request: HttpRequest) -> HttpResponse:
     return HttpResponse(status=200)
 
 
+@csrf_exempt
+async def export_board(request: HttpRequest) -> HttpResponseBase:
+    """GET /messaging/export
+    Streams a snapshot of every user and message as newline-delimited JSON,
+    in the format read by the `import_board` command. Only the superuser can
+    export the board
+
+    Response
+    --------
+    {"type": "user", "username": str, "hashed_password": str, ...}
+    {"type": "message", "id": int, "username": str, "message": str, ...}"""
+    if request.method != "GET":
+        return HttpResponse(status=405)
+    user = await _acheck_auth_headers(request)  # Query user from auth headers
+    if isinstance(user, HttpResponse):  # If authentication failed, return the error
+        return user
+    correct_username = os.environ["SUPERUSER"]
+    if user.username != correct_username:
+        return HttpResponse(status=403)
+    response = StreamingHttpResponse(
+        aexport_board(settings.MESSAGING_STREAM_CHUNK_SIZE),
+        content_type="application/x-ndjson",
+    )
+    response["Content-Disposition"] = 'attachment; filename="board.ndjson"'
+    return response
+
+
+@csrf_exempt
+def get_metrics(request: HttpRequest) -> HttpResponse:
+    """GET /metrics
+    Returns the performance metrics of the server in the Prometheus text
+    format"""
+    if request.method != "GET":
+        return HttpResponse(status=405)
+    credentials = CREDENTIAL_CACHE.stats()
+    tail = MESSAGE_TAIL.stats()
+    values: dict[str, tuple[str, str, float]] = {
+        "messaging_credential_cache_hits_total": (
+            "counter",
+            "The number of lookups that found a verified credential",
+            credentials["hits"],
+        ),
+        "messaging_credential_cache_misses_total": (
+            "counter",
+            "The number of lookups that did not find a verified credential",
+            credentials["misses"],
+        ),
+        "messaging_credential_cache_size": (
+            "gauge",
+            "The number of credentials cached",
+            credentials["size"],
+        ),
+        "messaging_tail_hits_total": (
+            "counter",
+            "The number of reads answered from the message tail",
+            tail["hits"],
+        ),
+        "messaging_tail_misses_total": (
+            "counter",
+            "The number of reads that fell through to the database",
+            tail["misses"],
+        ),
+        "messaging_tail_size": (
+            "gauge",
+            "The number of messages in the tail",
+            tail["size"],
+        ),
+        "messaging_tail_bytes": (
+            "gauge",
+            "The memory used by the tail",
+            tail["bytes"],
+        ),
+        "messaging_write_queue_depth": (
+            "gauge",
+            "The number of messages waiting to be written",
+            MESSAGE_WRITER.get_depth(),
+        ),
+    }
+    return HttpResponse(
+        METRICS.render(values), content_type="text/plain; version=0.0.4"
+    )
+
+
 # Helpers
 
 
@@ -215,25 +563,232 @@ def _get_json_data(request: HttpRequest) -> Any:
     return json.loads(request.body.decode("utf-8"))
 
 
-def _check_auth_headers(request: HttpRequest) -> Optional[HttpResponse]:
-    """Checks if there exists a user with the given `Username` and `Password`
-    headers. If there is not, then return an `HttpResponse` containing an
-    error message and `401 Unauthorized` code"""
+def _get_message_error(message: Any) -> Optional[str]:
+    """Returns why the given message cannot be created, or `None` if it is
+    valid"""
+    if not isinstance(message, str):
+        return "Message is not a string"
+    if len(message) > MESSAGE_MAX_LENGTH:
+        return f"Message is longer than {MESSAGE_MAX_LENGTH} characters"
+    return None
+
+
+class _PagingParams(NamedTuple):
+    """The `limit`, `since` and `before` query params of a paginated list
+    endpoint"""
+
+    limit: int
+    since: Optional[int]
+    before: Optional[int]
+
+
+def _get_paging_params(request: HttpRequest) -> Union[_PagingParams, HttpResponse]:
+    """Parses the `limit`, `since` and `before` query params of the request.
+    If any of them are invalid, return an `HttpResponse` containing an
+    error message and `400 Bad Request` code"""
+    try:
+        limit = int(request.GET.get("limit", 100))  # Grab `limit` query param
+    except ValueError:
+        return JsonResponse({"error": "Invalid `limit` param"}, status=400)
+    if limit < 0:
+        return JsonResponse({"error": "Invalid `limit` param"}, status=400)
+    try:
+        since = _get_optional_int_param(request, "since")  # Grab `since` query param
+    except ValueError:
+        return JsonResponse({"error": "Invalid `since` param"}, status=400)
+    try:
+        before = _get_optional_int_param(request, "before")  # Grab `before` param
+    except ValueError:
+        return JsonResponse({"error": "Invalid `before` param"}, status=400)
+    return _PagingParams(limit, since, before)
+
+
+def _get_optional_int_param(request: HttpRequest, name: str) -> Optional[int]:
+    """Returns the integer value of the query param `name`, or `None` if it
+    was not supplied. Raises `ValueError` if the value is not an integer"""
+    value = request.GET.get(name)
+    if not value:
+        return None
+    return int(value)
+
+
+def _get_page_response(
+    messages: list[EncodedMessage], params: _PagingParams, **extra: Any
+) -> HttpResponse:
+    """Returns the response of a paginated list endpoint, containing the
+    messages, the cursor of the previous page and any `extra` fields"""
+    next_cursor = _get_next_cursor(messages, params.limit)
+    return _get_messages_response(messages, {"next_cursor": next_cursor, **extra})
+
+
+def _get_messages_response(
+    messages: list[EncodedMessage], extra: dict[str, Any]
+) -> HttpResponse:
+    """Returns a JSON response containing the messages followed by the
+    `extra` fields. The stored representations of the messages are joined,
+    so only the `extra` fields are encoded"""
+    with METRICS.time("serialize"):
+        fields = json.dumps(extra).encode()[1:] if extra else b"}"
+        joined = b", ".join([message.json for message in messages])
+        content = b'{"messages": [' + joined + (b"], " if extra else b"]") + fields
+    return HttpResponse(content, content_type="application/json")
+
+
+def _get_streaming_page_response(
+    stream: MessageStream, **extra: Any
+) -> StreamingHttpResponse:
+    """Returns the response of a paginated list endpoint that encodes the
+    messages while they are read from the database. The body is the same as
+    the one of `_get_page_response`"""
+    return StreamingHttpResponse(
+        _encode_page(stream, extra), content_type="application/json"
+    )
+
+
+async def _encode_page(
+    stream: MessageStream, extra: dict[str, Any]
+) -> AsyncIterator[bytes]:
+    """Yields the JSON document of a page of messages in chunks"""
+    yield b'{"messages": ['
+    chunk: list[bytes] = []
+    separator = b""
+    async for message in stream.messages:
+        chunk.append(separator + message.json)
+        separator = b", "
+        if len(chunk) >= settings.MESSAGING_STREAM_CHUNK_SIZE:
+            yield b"".join(chunk)
+            chunk.clear()
+    fields = json.dumps({"next_cursor": stream.next_cursor, **extra})
+    yield b"".join(chunk) + b"], " + fields[1:].encode()
+
+
+def _get_next_cursor(messages: list[EncodedMessage], limit: int) -> Optional[int]:
+    """Returns the `before` cursor that fetches the page of messages preceding
+    `messages`, or `None` if there are no older messages to fetch"""
+    if not messages or len(messages) < limit:
+        return None
+    return messages[0].id
+
+
+async def _aget_list_etag(request: HttpRequest, user: Optional[User]) -> str:
+    """Returns the ETag of the response of a message list endpoint. It is
+    derived from the version of the board, the requesting user and the
+    request params, so it is computed without running the list query"""
+    version = await MESSAGE_SERVICE.aget_version()
+    user_id = user.pk if user is not None else 0
+    path = hashlib.blake2b(request.get_full_path().encode(), digest_size=8)
+    return f'"{version}.{user_id}.{path.hexdigest()}"'
+
+
+def _get_not_modified_response(
+    request: HttpRequest, etag: str
+) -> Optional[HttpResponse]:
+    """Returns a `304 Not Modified` response if the request's
+    `If-None-Match` header matches `etag`, otherwise `None`"""
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        return None
+    return _set_etag(response, etag)
+
+
+_Response = TypeVar("_Response", bound=HttpResponseBase)
+
+
+def _set_etag(response: _Response, etag: str) -> _Response:
+    """Sets the ETag of the response, and asks clients to revalidate it
+    before reusing a cached copy"""
+    response["ETag"] = etag
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+async def _stream_message_events(
+    since: Optional[int], limit: int
+) -> AsyncIterator[bytes]:
+    """Yields the Server-Sent Events of every message created after `since`,
+    or of the most recent `limit` messages if `since` is not given, followed
+    by the events of new messages as they are created"""
+    generation = BROADCASTER.generation
+    if since is None:
+        messages = await MESSAGE_SERVICE.aget_all_messages(limit, None)
+    else:
+        messages = await MESSAGE_SERVICE.aget_messages_since(since, limit)
+    cursor = since or 0
+    while True:
+        for message in messages:
+            yield b"id: %d\nevent: message\ndata: %s\n\n" % (message.id, message.json)
+        if messages:
+            cursor = messages[-1].id
+        elif not await MESSAGE_SERVICE.await_message(
+            cursor, settings.MESSAGING_STREAM_KEEPALIVE
+        ):
+            yield b": keepalive\n\n"  # Stop proxies from closing idle connections
+        if BROADCASTER.generation != generation:  # All messages were removed
+            generation = BROADCASTER.generation
+            cursor = 0
+            yield b"event: reset\ndata: {}\n\n"
+        messages = await MESSAGE_SERVICE.aget_messages_since(cursor, limit)
+
+
+class _AuthHeaders(NamedTuple):
+    """The credentials supplied in the headers of a request. Either `token`
+    is set, or both `username` and `password` are"""
+
+    token: Optional[str]
+    username: str
+    password: str
+
+
+def _get_auth_headers(request: HttpRequest) -> Union[_AuthHeaders, HttpResponse]:
+    """Returns the `Authorization: Bearer` token, or the `Username` and
+    `Password` headers of the request. If neither was supplied, then
+    return an `HttpResponse` containing an error message and
+    `401 Unauthorized` code"""
+    authorization = request.META.get("HTTP_AUTHORIZATION")
+    if authorization:
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() != "bearer" or not token.strip():
+            return JsonResponse({"error": "Invalid authorization header"}, status=401)
+        return _AuthHeaders(token.strip(), "", "")
     username = request.META.get("HTTP_USERNAME")
     password = request.META.get("HTTP_PASSWORD")
     if not username or not password:
         return JsonResponse(
             {"error": "Missing username or password header"}, status=401
         )
-    if not USER_SERVICE.check_user_login(username, password):
-        return JsonResponse({"error": "Incorrect username or password"}, status=401)
-    return None
-
-
-def _get_user_from_auth(request: HttpRequest) -> User:
-    """Returns the `User` object representing the user as defined in the
-    headers of the request"""
-    username = request.META.get("HTTP_USERNAME")
-    if not username:
-        raise ValueError()
-    return USER_SERVICE.get_user(username)
+    return _AuthHeaders(None, username, password)
+
+
+def _get_auth_error(headers: _AuthHeaders) -> HttpResponse:
+    """Returns the `401 Unauthorized` response of credentials that do not
+    belong to any user"""
+    if headers.token is not None:
+        return JsonResponse({"error": "Invalid or expired token"}, status=401)
+    return JsonResponse({"error": "Incorrect username or password"}, status=401)
+
+
+def _check_auth_headers(request: HttpRequest) -> Union[User, HttpResponse]:
+    """Returns the user with the given `Authorization: Bearer` token, or with
+    the given `Username` and `Password` headers. If there is not one, then
+    return an `HttpResponse` containing an error message and
+    `401 Unauthorized` code"""
+    headers = _get_auth_headers(request)
+    if isinstance(headers, HttpResponse):
+        return headers
+    if headers.token is not None:
+        user = USER_SERVICE.get_user_from_token(headers.token)
+    else:
+        user = USER_SERVICE.authenticate(headers.username, headers.password)
+    return user if user is not None else _get_auth_error(headers)
+
+
+async def _acheck_auth_headers(request: HttpRequest) -> Union[User, HttpResponse]:
+    """Asynchronous version of `_check_auth_headers`"""
+    headers = _get_auth_headers(request)
+    if isinstance(headers, HttpResponse):
+        return headers
+    if headers.token is not None:
+        user = await USER_SERVICE.aget_user_from_token(headers.token)
+    else:
+        user = await USER_SERVICE.aauthenticate(headers.username, headers.password)
+    return user if user is not None else _get_auth_error(headers)
@@ -0,0 +1,127 @@
+"""A write-behind queue that groups concurrently created messages into
+batched transactions, so that posters do not serialize on SQLite's write
+lock with one transaction each"""
+
+import atexit
+from concurrent.futures import Future
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from .models import User
+from .services import MESSAGE_SERVICE
+
+logger = logging.getLogger(__name__)
+
+_PendingMessage = tuple[User, str, "Future[int]"]
+"""A message waiting to be written, with the future of its id"""
+
+
+class _MessageWriter:
+    """Queues messages and writes them from a single background thread. The
+    thread waits up to the flush interval for more messages after the first
+    one arrives, then creates them all in one transaction"""
+
+    class QueueFullException(Exception):
+        """An exception thrown if a message is submitted while the queue
+        is full"""
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float) -> None:
+        self._queue: queue.Queue[Optional[_PendingMessage]] = queue.Queue(max_size)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, user: User, message: str) -> "Future[int]":
+        """Queues a message from the given user to be created. Returns a
+        future of the id of the message. Raises `QueueFullException` if the
+        queue is full"""
+        self._start()
+        future: Future[int] = Future()
+        try:
+            self._queue.put_nowait((user, message, future))
+        except queue.Full:
+            raise _MessageWriter.QueueFullException() from None
+        return future
+
+    def get_depth(self) -> int:
+        """Returns the number of messages waiting to be written"""
+        return self._queue.qsize()
+
+    def stop(self) -> None:
+        """Writes the queued messages and stops the background thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _start(self) -> None:
+        """Starts the background thread if it is not running"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="message-writer", daemon=True
+            )
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self) -> None:
+        """Writes batches of queued messages until stopped"""
+        try:
+            self._write_batches()
+        finally:
+            connections.close_all()  # Close the connection of this thread
+
+    def _write_batches(self) -> None:
+        """Writes batches of queued messages until the stop marker is read"""
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._batch_size:
+                try:
+                    pending = self._queue.get(
+                        timeout=max(0.0, deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+            self._write(batch)
+
+    def _write(self, batch: list[_PendingMessage]) -> None:
+        """Creates a batch of messages in one transaction and resolves the
+        futures of their ids"""
+        close_old_connections()
+        try:
+            ids = MESSAGE_SERVICE.create_messages_in_bulk(
+                [(user, message) for user, message, _ in batch]
+            )
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.exception("Failed to write %d messages", len(batch))
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), message_id in zip(batch, ids):
+            future.set_result(message_id)
+
+
+MESSAGE_WRITER = _MessageWriter(
+    settings.MESSAGING_WRITE_QUEUE_SIZE,
+    settings.MESSAGING_WRITE_QUEUE_BATCH_SIZE,
+    settings.MESSAGING_WRITE_QUEUE_FLUSH_INTERVAL,
+)
+"""The single instance of the message writer"""
@@ -0,0 +1,6 @@
+"""A Python client of the message board API"""
+
+from .cache import Message, MessageCache
+from .client import ClientStats, MessageBoardClient
+
+__all__ = ["ClientStats", "Message", "MessageBoardClient", "MessageCache"]
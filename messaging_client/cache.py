@@ -0,0 +1,75 @@
+"""An on-disk cache of the messages a client has already seen"""
+
+import os
+import sqlite3
+from types import TracebackType
+from typing import Iterable, NamedTuple, Optional, Union
+
+
+class Message(NamedTuple):
+    """A message of the board, as returned by the API"""
+
+    id: int
+    """The unique id of the message, which grows with every message"""
+    username: str
+    """The username of the user that sent the message"""
+    message: str
+    """The text of the message"""
+
+
+class MessageCache:
+    """The messages that a client has seen, stored in a SQLite database so
+    that a new session resumes syncing after the newest message of the last
+    one. The cache must be used from the thread that opened it"""
+
+    def __init__(self, path: Union[str, "os.PathLike[str]"] = ":memory:") -> None:
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS message "
+            "(id INTEGER PRIMARY KEY, username TEXT NOT NULL, message TEXT NOT NULL)"
+        )
+        self._connection.commit()
+
+    def get_high_water_mark(self) -> int:
+        """Returns the id of the newest message seen, or 0 if there is none"""
+        row = self._connection.execute("SELECT MAX(id) FROM message").fetchone()
+        return int(row[0] or 0)
+
+    def add(self, messages: Iterable[Message]) -> int:
+        """Stores the given messages. Messages already seen are skipped.
+        Returns the number of messages stored"""
+        before = self._connection.total_changes
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO message (id, username, message) VALUES (?, ?, ?)",
+                messages,
+            )
+        return self._connection.total_changes - before
+
+    def get_messages(self, limit: int) -> list[Message]:
+        """Returns the newest `limit` messages seen, ordered by creation time"""
+        rows = self._connection.execute(
+            "SELECT id, username, message FROM message ORDER BY id DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+        return [Message(*row) for row in reversed(rows)]
+
+    def clear(self) -> None:
+        """Forgets every message seen, such as after the board was reset"""
+        with self._connection:
+            self._connection.execute("DELETE FROM message")
+
+    def close(self) -> None:
+        """Closes the database"""
+        self._connection.close()
+
+    def __enter__(self) -> "MessageCache":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
@@ -0,0 +1,282 @@
+"""A client of the message board API that keeps its connections alive
+between requests and syncs only the messages it has not seen yet"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from types import TracebackType
+from typing import Any, Optional, TypedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .cache import Message, MessageCache
+
+_SHED_STATUSES = frozenset({429, 503})
+"""The statuses with which the server sheds requests without processing
+them, so they are sent again whatever their method"""
+
+_RETRY_READ_STATUSES = _SHED_STATUSES | {502, 504}
+"""The statuses of `GET` requests that are sent again. A gateway may answer
+`502` or `504` after the server processed the request, so other methods are
+not sent again, which could create messages twice"""
+
+
+class ClientStats(TypedDict):
+    """The traffic of a client since it was created"""
+
+    requests: int
+    """The number of requests sent, including retries"""
+    retries: int
+    """The number of requests that were sent again after failing"""
+    bytes_received: int
+    """The number of bytes of response bodies received, as sent over the
+    network before they are decompressed"""
+
+
+class MessageBoardClient:
+    """A client of the message board API. Requests share a pool of
+    keep-alive connections, with one connection per concurrent fetch.
+    Failed requests are retried with exponential backoff, and `sync` keeps
+    a high-water mark of the newest message seen so that it only fetches
+    newer messages. Use it as a context manager, or call `close` when done"""
+
+    class RequestFailedException(Exception):
+        """An exception thrown if the server answers with an error, or cannot
+        be reached after every retry"""
+
+    def __init__(
+        self,
+        url: str,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        cache: Optional[MessageCache] = None,
+        page_size: int = 1000,
+        concurrency: int = 4,
+        retries: int = 3,
+        backoff: float = 0.25,
+        max_backoff: float = 5.0,
+        timeout: float = 30.0,
+    ) -> None:
+        self._base_url = url.rstrip("/") + "/messaging"
+        self._username = username
+        self._password = password
+        self._cache = cache if cache is not None else MessageCache()
+        self._page_size = page_size
+        self._concurrency = concurrency
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._timeout = timeout
+        self._session = requests.Session()
+        # Keep one connection alive for every thread that fetches at once
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._token: Optional[str] = None
+        self._page: Optional[tuple[str, int, list[Message]]] = None
+        self._stats = ClientStats(requests=0, retries=0, bytes_received=0)
+        self._lock = threading.Lock()
+
+    def login(self) -> None:
+        """Exchanges the username and password for a bearer token, which
+        authenticates later requests without the server hashing the
+        password again"""
+        body = {"username": self._username, "password": self._password}
+        response = self._send("POST", "/login", json=body)
+        self._token = response.json()["token"]
+
+    def create_message(self, message: str) -> int:
+        """Creates a message. Returns its id"""
+        response = self._send_authenticated(
+            "POST", "/message/create", json={"message": message}
+        )
+        message_id: int = response.json()["id"]
+        return message_id
+
+    def create_messages(self, messages: list[str]) -> list[Optional[int]]:
+        """Creates many messages in one request. Returns the id of every
+        message, or `None` for the invalid ones that were skipped"""
+        response = self._send_authenticated(
+            "POST", "/message/batch", json={"messages": messages}
+        )
+        ids: list[Optional[int]] = response.json()["ids"]
+        return ids
+
+    def get_messages(self, limit: int = 100) -> list[Message]:
+        """Returns the newest `limit` messages, ordered by creation time. If
+        no message was created since the last call with the same `limit`,
+        the server answers `304 Not Modified` and the last page is returned
+        again without downloading it"""
+        headers: dict[str, str] = {}
+        if self._page is not None and self._page[1] == limit:
+            headers["If-None-Match"] = self._page[0]
+        response = self._send(
+            "GET", "/message", params={"limit": limit}, headers=headers
+        )
+        if response.status_code == 304 and self._page is not None:
+            return self._page[2]
+        messages = _get_messages(response)
+        etag = response.headers.get("ETag")
+        self._page = (etag, limit, messages) if etag else None
+        return messages
+
+    def sync(self, wait: float = 0.0) -> list[Message]:
+        """Returns the messages created since the newest message in the
+        cache, ordered by creation time, and adds them to the cache. If the
+        cache is empty, only the newest `page_size` messages are fetched. If
+        no message is new, waits up to `wait` seconds for one to be created.
+        When more than a page of messages is new, the remaining pages are
+        fetched `concurrency` at a time"""
+        since = self._cache.get_high_water_mark()
+        if not since:
+            messages = self.get_messages(self._page_size)
+        else:
+            params = {"since": since, "limit": self._page_size, "wait": wait}
+            response = self._send("GET", "/message/poll", params=params)
+            messages = _get_messages(response)
+            if len(messages) == self._page_size:  # There may be more
+                messages += self._catch_up(messages[-1].id)
+        self._cache.add(messages)
+        return messages
+
+    def get_high_water_mark(self) -> int:
+        """Returns the id of the newest message synced, or 0 if there is
+        none"""
+        return self._cache.get_high_water_mark()
+
+    def stats(self) -> ClientStats:
+        """Returns the traffic of the client since it was created"""
+        with self._lock:
+            return self._stats.copy()
+
+    def close(self) -> None:
+        """Closes the pooled connections"""
+        self._session.close()
+
+    def __enter__(self) -> "MessageBoardClient":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    def _catch_up(self, since: int) -> list[Message]:
+        """Returns every message created after `since`, up to the newest
+        message when this is called. The ids between them are split into
+        ranges of `page_size` ids, which hold at most a page of messages
+        each, and the ranges are fetched concurrently"""
+        newest = self._send("GET", "/message", params={"limit": 1})
+        newest_messages = _get_messages(newest)
+        if not newest_messages or newest_messages[-1].id <= since:
+            return []
+        end = newest_messages[-1].id
+
+        def get_range(start: int) -> list[Message]:
+            stop = min(start + self._page_size, end)
+            params = {"since": start, "before": stop + 1, "limit": self._page_size}
+            return _get_messages(self._send("GET", "/message", params=params))
+
+        starts = range(since, end, self._page_size)
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            pages = list(executor.map(get_range, starts))
+        return [message for page in pages for message in page]
+
+    def _send_authenticated(
+        self, method: str, path: str, **kwargs: Any
+    ) -> requests.Response:
+        """Sends a request with the bearer token of the client, logging in
+        first if there is none, and again if it expired"""
+        if self._token is None:
+            self.login()
+        response = self._send(
+            method, path, self._token, allow_unauthorized=True, **kwargs
+        )
+        if response.status_code == 401:  # The token expired
+            self.login()
+            response = self._send(method, path, self._token, **kwargs)
+        return response
+
+    def _send(
+        self,
+        method: str,
+        path: str,
+        token: Optional[str] = None,
+        allow_unauthorized: bool = False,
+        **kwargs: Any,
+    ) -> requests.Response:
+        """Sends a request over the pooled connections. Requests that the
+        server shed without processing are sent again, as are `GET` requests
+        that failed because of the network or a gateway, after waiting for the
+        `Retry-After` header or an exponential backoff. Raises
+        `RequestFailedException` if the last attempt fails, unless it failed
+        with `401 Unauthorized` and `allow_unauthorized` is set"""
+        if token is not None:
+            kwargs["headers"] = {
+                **kwargs.get("headers", {}),
+                "Authorization": f"Bearer {token}",
+            }
+        url = self._base_url + path
+        retry_statuses = _RETRY_READ_STATUSES if method == "GET" else _SHED_STATUSES
+        attempt = 0
+        while True:
+            try:
+                response = self._session.request(
+                    method, url, timeout=self._timeout, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as error:
+                self._count_request(0)
+                if method != "GET" or attempt == self._retries:
+                    raise MessageBoardClient.RequestFailedException(
+                        f"{method} {path} failed: {error}"
+                    ) from error
+                delay = self._get_backoff(attempt, None)
+            else:
+                # The body was read, so this is its size before decompression
+                self._count_request(response.raw.tell())
+                if (
+                    response.status_code not in retry_statuses
+                    or attempt == self._retries
+                ):
+                    break
+                delay = self._get_backoff(attempt, response)
+            time.sleep(delay)
+            attempt += 1
+            with self._lock:
+                self._stats["retries"] += 1
+        if response.status_code == 401 and allow_unauthorized:
+            return response
+        if response.status_code >= 400:
+            raise MessageBoardClient.RequestFailedException(
+                f"{method} {path} failed with {response.status_code}: {response.text}"
+            )
+        return response
+
+    def _count_request(self, bytes_received: int) -> None:
+        """Adds a request to the traffic of the client"""
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["bytes_received"] += bytes_received
+
+    def _get_backoff(
+        self, attempt: int, response: Optional[requests.Response]
+    ) -> float:
+        """Returns the number of seconds to wait before sending a failed
+        request again, as asked by the server or doubling with every
+        attempt, but never more than `max_backoff`"""
+        # Responses with an error status are falsy, so compare with `None`
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return min(float(response.headers["Retry-After"]), self._max_backoff)
+        return min(self._backoff * 2.0**attempt, self._max_backoff)
+
+
+def _get_messages(response: requests.Response) -> list[Message]:
+    """Returns the messages of a response of the API"""
+    return [
+        Message(message["id"], message["username"], message["message"])
+        for message in response.json()["messages"]
+    ]
@@ -0,0 +1,151 @@
+"""Tests for the Python client of the message board API"""
+
+from io import BytesIO
+from pathlib import Path
+import tempfile
+from typing import Any
+from unittest import mock
+
+from django.test import LiveServerTestCase, override_settings
+import requests
+
+from messaging.ratelimit import RATE_LIMITER, _RateLimiter
+from messaging.services import USER_SERVICE
+from messaging.tail import MESSAGE_TAIL
+
+from .cache import MessageCache
+from .client import MessageBoardClient
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class MessageBoardClientTests(LiveServerTestCase):
+    """Checks the client against the app served by a live server"""
+
+    databases = {"default", "read"}
+
+    def setUp(self) -> None:
+        MESSAGE_TAIL.reset()  # Forget messages of previous tests
+        RATE_LIMITER.clear()
+        USER_SERVICE.create_user("Jacob", "testing123")
+        self.board = self._connect()
+
+    def _connect(self, **options: Any) -> MessageBoardClient:
+        """Returns a client of the live server, closed after the test"""
+        options = {"page_size": 10, "backoff": 0.0, **options}
+        board = MessageBoardClient(
+            self.live_server_url, "Jacob", "testing123", **options
+        )
+        self.addCleanup(board.close)
+        return board
+
+    def test_sync_fetches_only_new_messages(self) -> None:
+        """Each sync returns the messages created since the last one, and a
+        sync without new messages costs one small request"""
+        ids = self.board.create_messages([f"message {i}" for i in range(5)])
+        self.assertEqual([message.id for message in self.board.sync()], ids)
+        new_id = self.board.create_message("@Jacob another")
+        synced = self.board.sync()
+        self.assertEqual([(m.id, m.username) for m in synced], [(new_id, "Jacob")])
+        before = self.board.stats()
+        self.assertEqual(self.board.sync(), [])
+        after = self.board.stats()
+        self.assertEqual(after["requests"], before["requests"] + 1)
+        self.assertEqual(self.board.get_high_water_mark(), new_id)
+
+    def test_logs_in_once(self) -> None:
+        """Writes are authenticated by a token issued once"""
+        self.board.create_message("first")
+        self.board.create_message("second")
+        self.assertEqual(self.board.stats()["requests"], 3)
+
+    def test_sync_catches_up_concurrently(self) -> None:
+        """When more than a page is new, the rest is fetched in ranges of
+        ids, without gaps or duplicates"""
+        self.board.create_message("first")
+        self.assertEqual(len(self.board.sync()), 1)
+        ids = self.board.create_messages([f"message {i}" for i in range(35)])
+        before = self.board.stats()["requests"]
+        self.assertEqual([message.id for message in self.board.sync()], ids)
+        # The first page, the newest id, then three ranges of ten ids
+        self.assertEqual(self.board.stats()["requests"] - before, 5)
+
+    def test_cache_resumes_from_disk(self) -> None:
+        """A new client with the same cache file only syncs newer messages"""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / "messages.sqlite3"
+        self.board.create_messages(["one", "two", "three"])
+        with MessageCache(path) as cache:
+            self.assertEqual(len(self._connect(cache=cache).sync()), 3)
+        new_ids = self.board.create_messages(["four", "five"])
+        with MessageCache(path) as cache:
+            synced = self._connect(cache=cache).sync()
+            self.assertEqual([message.id for message in synced], new_ids)
+            self.assertEqual(len(cache.get_messages(10)), 5)
+
+    def test_unchanged_page_is_not_downloaded(self) -> None:
+        """Getting the same page again is answered with `304 Not Modified`"""
+        self.board.create_messages(["one", "two"])
+        messages = self.board.get_messages(5)
+        received = self.board.stats()["bytes_received"]
+        self.assertEqual(self.board.get_messages(5), messages)
+        self.assertEqual(self.board.stats()["bytes_received"], received)
+
+    def test_network_errors_are_retried(self) -> None:
+        """Reads that fail because of the network are sent again, but writes
+        are not, since the server may have processed them"""
+        request = requests.Session.request
+        failures = [requests.ConnectionError("Connection reset")]
+
+        def flaky_request(session: requests.Session, *args: Any, **kwargs: Any) -> Any:
+            if failures:
+                raise failures.pop()
+            return request(session, *args, **kwargs)
+
+        with mock.patch.object(requests.Session, "request", flaky_request):
+            self.assertEqual(self.board.sync(), [])
+            self.assertEqual(self.board.stats()["retries"], 1)
+            failures.append(requests.ConnectionError("Connection reset"))
+            with self.assertRaises(MessageBoardClient.RequestFailedException):
+                self.board.create_message("hello")
+
+    def test_gateway_errors_are_retried_for_reads(self) -> None:
+        """A `502` from a gateway is retried for reads, but not for writes,
+        which the server may have processed"""
+        request = requests.Session.request
+        failures: list[requests.Response] = []
+
+        def flaky_request(session: requests.Session, *args: Any, **kwargs: Any) -> Any:
+            if failures:
+                return failures.pop()
+            return request(session, *args, **kwargs)
+
+        def bad_gateway() -> requests.Response:
+            response = requests.Response()
+            response.status_code = 502
+            response.raw = BytesIO(b"")
+            return response
+
+        self.board.login()
+        with mock.patch.object(requests.Session, "request", flaky_request):
+            failures.append(bad_gateway())
+            self.assertEqual(self.board.sync(), [])
+            self.assertEqual(self.board.stats()["retries"], 1)
+            failures.append(bad_gateway())
+            with self.assertRaises(MessageBoardClient.RequestFailedException):
+                self.board.create_message("hello")
+            self.assertEqual(self.board.stats()["retries"], 1)
+
+    def test_shed_requests_are_retried(self) -> None:
+        """Requests shed with `503` are sent again until the retries run out"""
+        with override_settings(MESSAGING_MAX_CONCURRENT_WRITES=1):
+            limiter = _RateLimiter()
+        limiter.start_write()  # Another write is being served
+        board = self._connect(retries=2, max_backoff=0.0)
+        board.login()
+        with mock.patch("messaging.middleware.RATE_LIMITER", limiter):
+            with self.assertRaises(MessageBoardClient.RequestFailedException):
+                board.create_message("hello")
+            self.assertEqual(board.stats()["retries"], 2)
+            limiter.finish_write()
+            board.create_message("hello")